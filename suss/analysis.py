@@ -6,18 +6,456 @@ of ClusterDatasets (i.e. putative clusters) to stimuli by aligning to
 stimulus arrival times and filtering stimuli by their properties
 """
 
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
+from scipy.sparse import csr_matrix
+
+
+def align_times(times, stimulus_times, t_start, t_stop):
+    """Align sorted event times to every stimulus at once
+
+    Finds the events in [stimulus_time + t_start, stimulus_time + t_stop)
+    for each stimulus with two searchsorted calls. The result is ragged,
+    stored like a CSR matrix: the events of stimulus i are
+    relative_times[offsets[i]:offsets[i + 1]].
+
+    Args
+        times: Sorted array of event times
+        stimulus_times: Array of stimulus times
+        t_start: Start of window relative to each stimulus
+        t_stop: End of window relative to each stimulus
+
+    Returns
+        offsets: Array of length len(stimulus_times) + 1
+        relative_times: Event times relative to their stimulus
+        indices: Index into times of each aligned event
+    """
+    stimulus_times = np.asarray(stimulus_times, dtype=float).reshape(-1)
+    starts = np.searchsorted(times, stimulus_times + t_start, side="left")
+    stops = np.searchsorted(times, stimulus_times + t_stop, side="left")
+    counts = np.maximum(stops - starts, 0)
+
+    offsets = np.zeros(len(stimulus_times) + 1, dtype=int)
+    np.cumsum(counts, out=offsets[1:])
+
+    # Position of each aligned event within its window, plus the window start
+    indices = (
+        np.arange(offsets[-1]) +
+        np.repeat(starts - offsets[:-1], counts)
+    )
+    relative_times = times[indices] - np.repeat(stimulus_times, counts)
+
+    return offsets, relative_times, indices
+
+
+def split_aligned(offsets, values):
+    """Split a ragged array from align_times() into a list of arrays"""
+    return np.split(values, offsets[1:-1])
 
 
 def align(cluster, stimulus_times, t_start, t_stop):
-    aligned_spikes = []
-    aligned_waveforms = []
-    for stimulus_time in stimulus_times:
-        _t_start = stimulus_time + t_start
-        _t_stop = stimulus_time + t_stop
-        window = cluster.select((cluster.times >= _t_start) & (cluster.times < _t_stop))
+    """Spike times and waveforms of a cluster around each stimulus
+
+    Returns
+        Object arrays with one entry per stimulus, of spike times relative
+        to the stimulus and of the spikes' waveforms
+    """
+    offsets, relative_times, indices = align_times(
+        cluster.times,
+        stimulus_times,
+        t_start,
+        t_stop
+    )
+    aligned_spikes = np.empty(len(offsets) - 1, dtype=object)
+    aligned_spikes[:] = split_aligned(offsets, relative_times)
+    aligned_waveforms = np.empty(len(offsets) - 1, dtype=object)
+    aligned_waveforms[:] = split_aligned(offsets, cluster.waveforms[indices])
+
+    return aligned_spikes, aligned_waveforms
+
+
+def spike_trains(dataset, samples=False):
+    """Times of the spikes of all clusters of a dataset, in time order
+
+    Args
+        dataset: ClusterDataset
+        samples: Return integer sample indices instead of seconds
+
+    Returns
+        times: Sorted spike times of all clusters
+        cluster_idx: Position in dataset of the cluster of each spike
+    """
+    node_times = [
+        node.flatten().samples if samples else node.flatten().times
+        for node in dataset.nodes
+    ]
+    if not len(node_times):
+        return np.zeros(0), np.zeros(0, dtype=int)
+
+    times = np.concatenate(node_times)
+    cluster_idx = np.repeat(
+        np.arange(len(node_times)),
+        [len(t) for t in node_times]
+    )
+    order = np.argsort(times, kind="mergesort")
+    return times[order], cluster_idx[order]
+
+
+def psth(
+        dataset,
+        stimulus_times,
+        bin_edges,
+        sparse=False,
+        n_jobs=None,
+        chunk_size=1000):
+    """Spike counts of every cluster in time bins around every stimulus
+
+    All clusters are counted together from the time sorted spikes of
+    the dataset, stimuli are processed in chunks, optionally on a pool
+    of threads. Bins are half open, [bin_edges[i], bin_edges[i + 1]).
+
+    Args
+        dataset: ClusterDataset
+        stimulus_times: Array of stimulus times
+        bin_edges: Bin edges relative to each stimulus time
+        sparse: Return a scipy.sparse matrix instead of a dense array
+        n_jobs: Number of threads to count chunks of stimuli on
+        chunk_size: Number of stimuli per chunk
+
+    Returns
+        Array of counts of shape (n_clusters, n_stimuli, n_bins). If sparse
+        is True, a csr_matrix of shape (n_clusters, n_stimuli * n_bins)
+        (i.e. the last two axes flattened).
+    """
+    times, cluster_idx = spike_trains(dataset)
+    stimulus_times = np.asarray(stimulus_times, dtype=float).reshape(-1)
+    bin_edges = np.asarray(bin_edges, dtype=float)
+    n_clusters = len(dataset)
+    n_stimuli = len(stimulus_times)
+    n_bins = len(bin_edges) - 1
+
+    def _count(stimulus_idx):
+        offsets, relative_times, indices = align_times(
+            times,
+            stimulus_times[stimulus_idx],
+            bin_edges[0],
+            bin_edges[-1]
+        )
+        bins = np.searchsorted(bin_edges, relative_times, side="right") - 1
+        stimuli = np.repeat(stimulus_idx, np.diff(offsets))
+        return cluster_idx[indices], stimuli * n_bins + bins
+
+    chunks = np.array_split(
+        np.arange(n_stimuli),
+        max(1, int(np.ceil(n_stimuli / chunk_size)))
+    )
+    if n_jobs is not None and n_jobs > 1:
+        with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+            results = list(executor.map(_count, chunks))
+    else:
+        results = [_count(chunk) for chunk in chunks]
+
+    rows = np.concatenate([r[0] for r in results])
+    cols = np.concatenate([r[1] for r in results])
+
+    if sparse:
+        return csr_matrix(
+            (np.ones(len(rows), dtype=int), (rows, cols)),
+            shape=(n_clusters, n_stimuli * n_bins)
+        )
+
+    return np.bincount(
+        rows * (n_stimuli * n_bins) + cols,
+        minlength=n_clusters * n_stimuli * n_bins
+    ).reshape(n_clusters, n_stimuli, n_bins)
+
+
+# Correlograms of pairs of nodes already computed, for each set of
+# (window, bin_size) parameters: {params: {node_a: {node_b: counts}}}.
+# Entries go away with the nodes.
+_correlogram_cache = {}
+
+
+def correlogram_bins(window=0.05, bin_size=0.001):
+    """Bin edges of correlograms from -window to window"""
+    n_bins = int(round(2 * window / bin_size))
+    return np.linspace(-window, window, n_bins + 1)
+
+
+def _correlogram_sweep(times, cluster_idx, n_clusters, bin_edges, include=None):
+    """Count lags between all pairs of spikes closer than the bin range
+
+    Steps through the time sorted spikes comparing each spike with the
+    spike lag positions later, for increasing lag, until no pair is within
+    range. The cost is linear in the number of spikes times the largest
+    lag needed, plus the number of coincident pairs.
+
+    Args
+        include: Optional boolean array over clusters; only pairs with at
+            least one included cluster are counted
+
+    Returns
+        Array of counts of shape (n_clusters, n_clusters, n_bins), where
+        [a, b] is the histogram of (time of b spike) - (time of a spike)
+    """
+    n_bins = len(bin_edges) - 1
+    window = max(-bin_edges[0], bin_edges[-1])
+    flat_idx = []
+    lag = 1
+    while lag < len(times):
+        close = np.where(times[lag:] - times[:-lag] <= window)[0]
+        if not len(close):
+            break
+        a = cluster_idx[close]
+        b = cluster_idx[close + lag]
+        dt = times[close + lag] - times[close]
+        if include is not None:
+            keep = include[a] | include[b]
+            a, b, dt = a[keep], b[keep], dt[keep]
+
+        for first, second, lags in ((a, b, dt), (b, a, -dt)):
+            bins = np.searchsorted(bin_edges, lags, side="right") - 1
+            valid = (bins >= 0) & (bins < n_bins)
+            flat_idx.append(((first * n_clusters + second) * n_bins + bins)[valid])
+        lag += 1
+
+    flat_idx = np.concatenate(flat_idx) if flat_idx else np.zeros(0, dtype=int)
+    return np.bincount(
+        flat_idx,
+        minlength=n_clusters * n_clusters * n_bins
+    ).reshape(n_clusters, n_clusters, n_bins)
+
+
+def correlograms(dataset, window=0.05, bin_size=0.001):
+    """Auto- and cross-correlograms of all pairs of clusters in a dataset
+
+    Correlograms are cached per pair of nodes, so after an edit only the
+    pairs involving new nodes are counted.
+
+    Args
+        dataset: ClusterDataset
+        window: Largest lag, in seconds
+        bin_size: Size of lag bins, in seconds
+
+    Returns
+        counts: Array of shape (n_clusters, n_clusters, n_bins). counts[a, b]
+            is the histogram of lags (time of a spike of b minus time of a
+            spike of a); counts[a, a] is the autocorrelogram of a, which
+            leaves out the zero lag of each spike with itself.
+        bin_edges: Lag bin edges
+    """
+    bin_edges = correlogram_bins(window, bin_size)
+    # Recordings with sample index times are compared in whole samples
+    samples = len(dataset) > 0 and dataset.has_sample_times
+    if samples:
+        sample_rate = dataset.recording.sample_rate
+        sweep_edges = np.round(bin_edges * sample_rate)
+        bin_edges = sweep_edges / sample_rate
+    else:
+        sweep_edges = bin_edges
+    n_clusters = len(dataset)
+    n_bins = len(bin_edges) - 1
+    nodes = list(dataset.nodes)
+
+    cache = _correlogram_cache.setdefault((window, bin_size), weakref.WeakKeyDictionary())
+    missing = np.array([
+        any(other not in cache.get(node, {}) for other in nodes)
+        for node in nodes
+    ], dtype=bool)
+
+    if np.any(missing):
+        times, cluster_idx = spike_trains(dataset, samples=samples)
+        new_counts = _correlogram_sweep(
+            times,
+            cluster_idx,
+            n_clusters,
+            sweep_edges,
+            include=None if np.all(missing) else missing
+        )
+        for a in np.where(missing)[0]:
+            row = cache.setdefault(nodes[a], weakref.WeakKeyDictionary())
+            for b, other in enumerate(nodes):
+                row[other] = new_counts[a, b]
+                cache.setdefault(other, weakref.WeakKeyDictionary())[nodes[a]] = new_counts[b, a]
+
+    counts = np.zeros((n_clusters, n_clusters, n_bins), dtype=int)
+    for a, node in enumerate(nodes):
+        row = cache[node]
+        for b, other in enumerate(nodes):
+            counts[a, b] = row[other]
+
+    return counts, bin_edges
+
+
+def intervals(dataset):
+    """Inter-spike intervals of a dataset's spikes
+
+    Returns
+        Intervals in seconds, or as integer numbers of samples if the
+        recording stores times as sample indices
+    """
+    flat = dataset.flatten()
+    if flat.has_sample_times:
+        return np.diff(flat.samples.astype(np.int64))
+    return np.diff(flat.times)
+
+
+def _to_interval_units(dataset, seconds):
+    """A duration in the units of intervals(dataset)"""
+    if dataset.has_sample_times:
+        return int(round(seconds * dataset.recording.sample_rate))
+    return seconds
+
+
+def isi_violations(dataset, refractory_period=0.001):
+    """Fraction of inter-spike intervals shorter than the refractory period
+
+    Returns nan when the dataset has less than two spikes
+    """
+    isi = intervals(dataset)
+    if not len(isi):
+        return np.nan
+    return np.mean(isi < _to_interval_units(dataset, refractory_period))
+
+
+def isi_histogram(dataset, t_max=0.05, bin_size=0.001):
+    """Histogram of the inter-spike intervals shorter than t_max
+
+    With sample index times, intervals are binned by integer division by
+    the bin size in samples.
+
+    Returns
+        counts: Number of intervals in each bin
+        bin_edges: Bin edges in seconds
+    """
+    isi = intervals(dataset)
+    if dataset.has_sample_times:
+        sample_rate = dataset.recording.sample_rate
+        bin_samples = max(1, _to_interval_units(dataset, bin_size))
+        n_bins = _to_interval_units(dataset, t_max) // bin_samples
+        bins = isi // bin_samples
+        counts = np.bincount(bins[bins < n_bins], minlength=n_bins)
+        return counts, np.arange(n_bins + 1) * bin_samples / sample_rate
+
+    n_bins = int(round(t_max / bin_size))
+    return np.histogram(isi, bins=n_bins, range=(0, n_bins * bin_size))
+
+
+def refractory_counts(counts, bin_edges, refractory_period=0.001):
+    """Number of spike pairs closer than the refractory period
+
+    Args
+        counts: Correlograms from correlograms()
+        bin_edges: Their bin edges
+        refractory_period: In seconds; bins that lie entirely within
+            (-refractory_period, refractory_period) are counted
+
+    Returns
+        Array of shape (n_clusters, n_clusters). The diagonal counts the
+        refractory violations of each cluster, the rest the violations
+        each pair of clusters would add if merged (counted in both
+        directions).
+    """
+    inside = (
+        (bin_edges[:-1] >= -refractory_period - 1e-12) &
+        (bin_edges[1:] <= refractory_period + 1e-12)
+    )
+    return np.sum(counts[:, :, inside], axis=2)
+
+
+def bin_spikes(
+        times,
+        labels,
+        bin_size=0.001,
+        t_start=0.0,
+        t_stop=None,
+        row_labels=None,
+        chunk_duration=60.0):
+    """Sparse matrix of spike counts of each label in time bins
+
+    Spikes are processed in chunks of chunk_duration seconds, and only
+    the nonzero counts of each chunk are kept, so memory use is bounded
+    by the number of spikes and not by the number of bins.
+
+    Args
+        times: Sorted spike times
+        labels: Label of each spike
+        bin_size: Size of time bins, in seconds
+        t_start: Start of the first bin
+        t_stop: End of the last bin (defaults to just after the last spike)
+        row_labels: Label of each row of the matrix. Defaults to the
+            sorted unique labels; spikes with other labels are left out.
+        chunk_duration: Seconds of spikes binned at a time
+
+    Returns
+        counts: csr_matrix of shape (len(row_labels), n_bins)
+        bins: (t_start, bin_size, n_bins); bin i is
+            [t_start + i * bin_size, t_start + (i + 1) * bin_size)
+    """
+    times = np.asarray(times)
+    labels = np.asarray(labels)
+    if row_labels is None:
+        row_labels = np.unique(labels)
+    row_labels = np.asarray(row_labels)
+    if t_stop is None:
+        t_stop = (times[-1] if len(times) else t_start) + bin_size
+
+    n_bins = int(np.ceil((t_stop - t_start) / bin_size))
+
+    sorter = np.argsort(row_labels)
+    bins_per_chunk = max(1, int(chunk_duration // bin_size))
+    # Bounds of the chunks, computed from the chunk index rather than
+    # from bin edges so that nothing grows with the number of bins
+    n_chunks = int(np.ceil(n_bins / bins_per_chunk))
+    chunk_bins = np.minimum(np.arange(n_chunks + 1) * bins_per_chunk, n_bins)
+    chunk_edges = np.searchsorted(times, t_start + chunk_bins * bin_size)
+
+    rows, cols, data = [], [], []
+    for start, stop in zip(chunk_edges[:-1], chunk_edges[1:]):
+        if start == stop:
+            continue
+        chunk_labels = labels[start:stop]
+        positions = np.searchsorted(row_labels, chunk_labels, sorter=sorter).clip(
+            max=len(row_labels) - 1)
+        row = sorter[positions]
+        valid = row_labels[row] == chunk_labels
+        col = ((times[start:stop] - t_start) // bin_size).astype(np.int64).clip(
+            max=n_bins - 1)
+
+        # Sum the spikes that fall in the same bin within the chunk
+        flat, count = np.unique(
+            row[valid].astype(np.int64) * n_bins + col[valid],
+            return_counts=True
+        )
+        rows.append(flat // n_bins)
+        cols.append(flat % n_bins)
+        data.append(count)
+
+    bins = (t_start, bin_size, n_bins)
+    if not len(rows):
+        return csr_matrix((len(row_labels), n_bins), dtype=int), bins
+
+    counts = csr_matrix(
+        (np.concatenate(data), (np.concatenate(rows), np.concatenate(cols))),
+        shape=(len(row_labels), n_bins)
+    )
+    return counts, bins
+
 
-        aligned_spikes.append(window.times - stimulus_time)
-        aligned_waveforms.append(window.waveforms)
+def binned_counts(dataset, bin_size=0.001, t_start=0.0, t_stop=None, chunk_duration=60.0):
+    """Sparse (n_clusters, n_bins) spike count matrix of a ClusterDataset
 
-    return np.array(aligned_spikes), np.array(aligned_waveforms)
+    Rows are in the order of dataset.nodes. See bin_spikes().
+    """
+    times, cluster_idx = spike_trains(dataset)
+    return bin_spikes(
+        times,
+        cluster_idx,
+        bin_size=bin_size,
+        t_start=t_start,
+        t_stop=t_stop,
+        row_labels=np.arange(len(dataset)),
+        chunk_duration=chunk_duration
+    )
@@ -0,0 +1,284 @@
+"""Sorting many channels across a pool of worker processes
+
+Each channel is a pickled SpikeDataset or a channel of a ChannelGroup
+file (see channels.py), whose sort result is saved back into the group.
+Channels are scheduled on a process pool so that the estimated memory of
+the channels being sorted at once stays under a limit, channels whose
+output already exists are skipped, and a failing channel is recorded
+without stopping the batch.
+"""
+
+import csv
+import glob
+import os
+import time
+import traceback
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+
+import suss.io
+from suss.channels import (
+        EXTENSION,
+        ChannelGroup,
+        channel_filename,
+        channel_path,
+        split_channel_path
+)
+from suss.features import load_or_fit_basis
+from suss.sort3 import sort
+
+
+SUMMARY_FIELDS = [
+    "input",
+    "output",
+    "status",
+    "seconds",
+    "n_spikes",
+    "n_clusters",
+    "error"
+]
+
+
+def output_filename(path):
+    """Default location of the sort result of a channel
+
+    The sort result of a channel of a group is saved in the group
+    """
+    if split_channel_path(path) is not None:
+        return path
+    filename, ext = os.path.splitext(path)
+    return "{}-sorted{}".format(filename, ext)
+
+
+def output_exists(output_path):
+    channel = split_channel_path(output_path)
+    if channel is None:
+        return os.path.exists(output_path)
+    filename, channel = channel
+    if not os.path.exists(filename):
+        return False
+    group = ChannelGroup(filename)
+    return channel in group and group.has_sorted(channel)
+
+
+def input_exists(path):
+    channel = split_channel_path(path)
+    if channel is None:
+        return os.path.exists(path)
+    filename, channel = channel
+    return os.path.exists(filename) and channel in ChannelGroup(filename)
+
+
+def sort_file(path, output_path=None, **sort_kwargs):
+    """Sort a single dataset and save the final sort result
+
+    A pickled dataset's result is written to a temporary file first and
+    moved into place when complete, so an existing output is always a
+    finished sort. Channels of a group are read from and saved to the
+    group (see channels.channel_path()). The dataset's feature basis is
+    loaded from next to the input, or fit and saved there, so that the
+    sort and later curation share it (see features.load_or_fit_basis()).
+
+    Returns
+        The final ClusterDataset
+    """
+    output_path = output_path or output_filename(path)
+    group_channel = split_channel_path(path)
+    if group_channel is None:
+        dataset = suss.io.read_pickle(path)
+        load_or_fit_basis(dataset, path)
+    else:
+        group = ChannelGroup(group_channel[0])
+        dataset = group.open(group_channel[1])
+        # Named like the files the gui keeps for a channel of a group
+        load_or_fit_basis(dataset, channel_filename(*group_channel))
+
+    for sort_result in sort(dataset, **sort_kwargs):
+        pass
+
+    output_channel = split_channel_path(output_path)
+    if output_channel is not None:
+        if group_channel is None or output_channel[0] != group_channel[0]:
+            group = ChannelGroup(output_channel[0])
+        group.save_sorted(output_channel[1], sort_result)
+    else:
+        tmp_path = "{}.tmp".format(output_path)
+        suss.io.save_pickle(tmp_path, sort_result)
+        os.replace(tmp_path, output_path)
+    return sort_result
+
+
+def _sort_job(path, output_path, sort_kwargs):
+    """Worker entry point; never raises so the batch keeps going"""
+    _start = time.time()
+    result = dict(input=path, output=output_path)
+    try:
+        sort_result = sort_file(path, output_path, **sort_kwargs)
+    except Exception as e:
+        traceback.print_exc()
+        result.update(status="failed", error=repr(e))
+    else:
+        result.update(
+            status="done",
+            n_spikes=sort_result.count,
+            n_clusters=len(sort_result)
+        )
+    result["seconds"] = "{:.1f}".format(time.time() - _start)
+    return result
+
+
+def find_jobs(patterns=(), manifest=None):
+    """List (input, output) paths from glob patterns and/or a manifest
+
+    A manifest is a text file with one input path per line, optionally
+    followed by whitespace and an output path. Blank lines and lines
+    starting with # are ignored. Files matched by the patterns that are
+    themselves sort outputs (see output_filename()) are left out. Group
+    files (ending in channels.EXTENSION) add a job for each of their
+    channels; a single channel is given as channels.channel_path().
+    """
+    jobs = []
+    for pattern in patterns:
+        if split_channel_path(pattern) is not None:
+            jobs.append((pattern, pattern))
+            continue
+        for path in sorted(glob.glob(pattern)):
+            if os.path.splitext(path)[0].endswith("-sorted"):
+                continue
+            if path.endswith(EXTENSION):
+                jobs.extend(
+                    (channel_path(path, channel), channel_path(path, channel))
+                    for channel in ChannelGroup(path).channels
+                )
+            else:
+                jobs.append((path, output_filename(path)))
+
+    if manifest is not None:
+        with open(manifest, "r") as manifest_file:
+            for line in manifest_file:
+                line = line.strip()
+                if not line or line.startswith("#"):
+                    continue
+                parts = line.split()
+                path = parts[0]
+                output_path = parts[1] if len(parts) > 1 else output_filename(path)
+                jobs.append((path, output_path))
+
+    return jobs
+
+
+def available_memory():
+    """Bytes of memory currently available to new processes"""
+    try:
+        with open("/proc/meminfo", "r") as meminfo:
+            for line in meminfo:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except IOError:
+        pass
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_AVPHYS_PAGES")
+
+
+def estimate_memory(path, factor=20.0):
+    """Rough peak memory needed to sort a channel, from its file size"""
+    channel = split_channel_path(path)
+    if channel is not None:
+        return factor * ChannelGroup(channel[0]).nbytes(channel[1])
+    return factor * os.path.getsize(path)
+
+
+def run_batch(
+        jobs,
+        n_jobs=None,
+        memory_limit=None,
+        memory_factor=20.0,
+        overwrite=False,
+        summary_file="sort-summary.csv",
+        **sort_kwargs):
+    """Sort channels in parallel, keeping estimated memory under a limit
+
+    Args
+        jobs: List of (input, output) paths, e.g. from find_jobs()
+        n_jobs: Maximum number of worker processes (defaults to cpu count)
+        memory_limit: Bytes of memory the running jobs may use together.
+            Defaults to 80% of the currently available memory. A job
+            larger than the limit still runs, but only by itself.
+        memory_factor: Multiple of the input file size used as the
+            memory estimate of a job
+        overwrite: Sort channels even if their output already exists
+        summary_file: CSV file where the status and timing of each
+            channel is written as the channels finish
+        **sort_kwargs: Passed to sort3.sort()
+
+    Returns
+        List of summary rows (dicts), one per job
+    """
+    _fn_start = time.time()
+    if memory_limit is None:
+        memory_limit = 0.8 * available_memory()
+
+    summary = []
+    summary_fd = open(summary_file, "w", newline="")
+    writer = csv.DictWriter(summary_fd, fieldnames=SUMMARY_FIELDS)
+    writer.writeheader()
+
+    def record(row):
+        summary.append(row)
+        writer.writerow(row)
+        summary_fd.flush()
+        print("[{}/{}] {} {} ({:.1f}s elapsed)".format(
+            len(summary), len(jobs), row["status"], row["input"],
+            time.time() - _fn_start))
+
+    pending = []
+    for path, output_path in jobs:
+        if not overwrite and output_exists(output_path):
+            record(dict(input=path, output=output_path, status="skipped"))
+        elif not input_exists(path):
+            record(dict(input=path, output=output_path, status="failed",
+                error="Input file not found"))
+        else:
+            pending.append((estimate_memory(path, memory_factor), path, output_path))
+
+    # Start the largest jobs first so small ones can fill in around them
+    pending.sort(key=lambda job: job[0], reverse=True)
+
+    n_jobs = n_jobs or os.cpu_count()
+    executor = ProcessPoolExecutor(max_workers=n_jobs)
+    running = {}
+    try:
+        while pending or running:
+            used = sum(job[0] for job in running.values())
+            for job in list(pending):
+                if len(running) >= n_jobs:
+                    break
+                memory, path, output_path = job
+                if running and used + memory > memory_limit:
+                    continue
+                future = executor.submit(_sort_job, path, output_path, sort_kwargs)
+                running[future] = job
+                used += memory
+                pending.remove(job)
+
+            done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+            broken = False
+            for future in done:
+                _, path, output_path = running.pop(future)
+                try:
+                    row = future.result()
+                except BrokenProcessPool as e:
+                    # A worker died (e.g. killed for running out of memory).
+                    # Every job running in the pool fails with it.
+                    row = dict(input=path, output=output_path, status="failed",
+                        error=repr(e))
+                    broken = True
+                record(row)
+
+            if broken:
+                executor.shutdown(wait=False)
+                executor = ProcessPoolExecutor(max_workers=n_jobs)
+    finally:
+        executor.shutdown(wait=True)
+        summary_fd.close()
+
+    return summary
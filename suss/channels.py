@@ -0,0 +1,410 @@
+"""Many channels of a recording site in one file
+
+A ChannelGroup file holds the SpikeDatasets of many channels and their
+sort results. Each channel's records (times, waveforms, labels, ...) are
+written as one raw block so that opening a channel memory maps just that
+block, and sort results are pickled with references to their channel in
+place of a copy of its waveforms.
+
+Layout of the file:
+
+    magic (8 bytes), header offset and size (2 x uint64)
+    blocks of channel records, pickled channel attributes (sample rate,
+    storage, feature basis, ...) and pickled sort results, in write order
+    header: pickled index of every channel's blocks
+
+New blocks and a new header are always appended, and the offset of the
+header at the start of the file is updated last, so a reader never sees
+a partially written channel. The header only holds the location of each
+block (a few numbers per channel), so opening a channel takes the same
+time however many channels and spikes the file holds. Replaced blocks
+and headers are left in the file until compact() rewrites it.
+"""
+
+import io
+import os
+import pickle
+import struct
+import weakref
+from contextlib import contextmanager
+
+import numpy as np
+
+from suss.core import SpikeDataset, SubDataset
+
+
+MAGIC = b"SUSSGRP1"
+_POINTER = struct.Struct("<QQ")
+EXTENSION = ".suss"
+# Byte locked by writers on Windows, past the end of any file so that
+# reading the file is not blocked
+_LOCK_OFFSET = 2 ** 62
+# Bytes copied at a time by compact()
+_COPY_SIZE = 64 * 1024 * 1024
+
+
+def _new_subdataset():
+    return SubDataset.__new__(SubDataset)
+
+
+def _set_subdataset_state(dataset, state):
+    """Rebuild the records of a SubDataset from its source's records"""
+    attrs, ids, labels = state
+    vars(dataset).update(attrs)
+    dataset._data = dataset.source._data[ids]
+    dataset._data["labels"] = labels
+
+
+class _Pickler(pickle.Pickler):
+    """Pickles datasets opened from a group as references to their channel
+
+    Bottom level SubDatasets of those datasets are pickled as the ids and
+    labels of their spikes rather than a copy of their records.
+    """
+
+    def __init__(self, file, channels):
+        super().__init__(file, protocol=pickle.HIGHEST_PROTOCOL)
+        self.channels = channels
+
+    def persistent_id(self, obj):
+        if isinstance(obj, SpikeDataset):
+            return self.channels.get(id(obj))
+        return None
+
+    def reducer_override(self, obj):
+        if (type(obj) is SubDataset and
+                id(obj.source) in self.channels and
+                not obj.has_children):
+            attrs = {key: value for key, value in vars(obj).items() if key != "_data"}
+            state = (attrs, np.array(obj.ids), np.array(obj.labels))
+            # The state is pickled after the dataset is memoized, so it
+            # may refer back to it (e.g. through its parent's nodes)
+            return _new_subdataset, (), state, None, None, _set_subdataset_state
+        return NotImplemented
+
+
+class _Unpickler(pickle.Unpickler):
+
+    def __init__(self, file, group):
+        super().__init__(file)
+        self.group = group
+
+    def persistent_load(self, channel):
+        return self.group.open(channel)
+
+
+class ChannelGroup(object):
+    """File of the SpikeDatasets and sort results of many channels
+
+    Example
+    >>> group = ChannelGroup.create("site1.suss", {"ch0": dataset0, "ch1": dataset1})
+    >>> dataset = group.open("ch1")
+    >>> group.save_sorted("ch1", sort_result)
+    >>> ChannelGroup("site1.suss").load_sorted("ch1")
+    """
+
+    def __init__(self, filename):
+        """Open an existing group file, reading only its header"""
+        self.filename = filename
+        # Datasets returned by open() and still in use, by channel
+        self._opened = weakref.WeakValueDictionary()
+        self.header = self._read_header()
+
+    @classmethod
+    def create(cls, filename, datasets=None):
+        """Create a group file, replacing any existing file
+
+        Args
+            filename: Path of the new file
+            datasets: Optional dict (or list of pairs) of channel name
+                to SpikeDataset to add
+        """
+        with open(filename, "wb") as f:
+            f.write(MAGIC)
+            f.write(_POINTER.pack(0, 0))
+            header = dict(channels={})
+            _append_header(f, header)
+
+        group = cls(filename)
+        if datasets is not None:
+            items = datasets.items() if isinstance(datasets, dict) else datasets
+            for channel, dataset in items:
+                group.add(channel, dataset)
+        return group
+
+    def _read_header(self):
+        with open(self.filename, "rb") as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError("{} is not a channel group file".format(self.filename))
+            offset, size = _POINTER.unpack(f.read(_POINTER.size))
+            f.seek(offset)
+            return pickle.loads(f.read(size))
+
+    def _read_block(self, location):
+        offset, size = location
+        with open(self.filename, "rb") as f:
+            f.seek(offset)
+            return f.read(size)
+
+    @contextmanager
+    def _locked(self):
+        """The file opened for writing, locked against other writers
+
+        Opens the file again if it was replaced by compact() while
+        waiting for the lock.
+        """
+        while True:
+            with open(self.filename, "r+b") as f:
+                with _file_lock(f):
+                    if os.path.samestat(os.fstat(f.fileno()), os.stat(self.filename)):
+                        yield f
+                        return
+
+    @contextmanager
+    def _writing(self):
+        """Exclusive access to append to the file, with the latest header
+
+        Lets worker processes save the sorts of different channels of the
+        same file at once.
+        """
+        with self._locked() as f:
+            self.header = self._read_header()
+            f.seek(0, os.SEEK_END)
+            yield f
+            _append_header(f, self.header)
+
+    @property
+    def channels(self):
+        """Names of the channels, in the order they were added"""
+        return list(self.header["channels"])
+
+    def __len__(self):
+        return len(self.header["channels"])
+
+    def __contains__(self, channel):
+        return channel in self.header["channels"]
+
+    def _entry(self, channel):
+        try:
+            return self.header["channels"][channel]
+        except KeyError:
+            raise ValueError("No channel {} in {}".format(channel, self.filename))
+
+    def nbytes(self, channel):
+        """Size of a channel's records"""
+        entry = self._entry(channel)
+        return entry["length"] * entry["dtype"].itemsize
+
+    def add(self, channel, dataset):
+        """Write a channel's SpikeDataset to the file
+
+        Args
+            channel: Name of the channel (must not be in the group yet)
+            dataset: A SpikeDataset, or any dataset derived from one (the
+                whole recording is written)
+        """
+        recording = dataset.recording
+        if not isinstance(recording, SpikeDataset):
+            raise ValueError("Only SpikeDatasets can be added to a group")
+
+        # Everything but the records (e.g. sample_rate, storage, the
+        # feature basis) is pickled in a block of its own, read by open()
+        attrs = pickle.dumps({
+            key: value for key, value in vars(recording).items()
+            if key not in ("_data", "source")
+        }, protocol=pickle.HIGHEST_PROTOCOL)
+        data = np.ascontiguousarray(recording._data)
+
+        with self._writing() as f:
+            if channel in self.header["channels"]:
+                raise ValueError("Channel {} is already in {}".format(channel, self.filename))
+            offset = f.tell()
+            f.write(data.tobytes())
+            attrs_offset = f.tell()
+            f.write(attrs)
+            self.header["channels"][channel] = dict(
+                offset=offset,
+                dtype=data.dtype,
+                length=len(data),
+                attrs=(attrs_offset, len(attrs)),
+                sorted=None
+            )
+
+    def open(self, channel):
+        """The SpikeDataset of a channel, with its records memory mapped
+
+        The records are mapped copy-on-write: changes to them are never
+        written back to the file. Opening the same channel again returns
+        the same dataset while it is in use.
+        """
+        dataset = self._opened.get(channel)
+        if dataset is not None:
+            return dataset
+
+        # The header is small; reading it again finds blocks moved by
+        # compact() in another process
+        self.header = self._read_header()
+        entry = self._entry(channel)
+        dataset = SpikeDataset.__new__(SpikeDataset)
+        vars(dataset).update(pickle.loads(self._read_block(entry["attrs"])))
+        dataset.source = dataset
+        if entry["length"]:
+            dataset._data = np.memmap(
+                self.filename,
+                dtype=entry["dtype"],
+                mode="c",
+                offset=entry["offset"],
+                shape=(entry["length"],))
+        else:
+            dataset._data = np.zeros(0, dtype=entry["dtype"])
+
+        self._opened[channel] = dataset
+        return dataset
+
+    def has_sorted(self, channel):
+        return self._entry(channel)["sorted"] is not None
+
+    def save_sorted(self, channel, result):
+        """Save the sort result (e.g. a ClusterDataset) of a channel
+
+        Replaces any result saved before. The channel's dataset is only
+        referenced if result was derived from the dataset returned by
+        open(); results of other datasets (e.g. realigned waveforms)
+        are saved whole.
+        """
+        channels = {id(dataset): name for name, dataset in self._opened.items()}
+        buffer = io.BytesIO()
+        _Pickler(buffer, channels).dump(result)
+
+        with self._writing() as f:
+            entry = self._entry(channel)
+            offset = f.tell()
+            f.write(buffer.getvalue())
+            entry["sorted"] = (offset, buffer.tell())
+
+    def load_sorted(self, channel):
+        """The sort result of a channel, or None if it was not sorted yet"""
+        self.header = self._read_header()
+        location = self._entry(channel)["sorted"]
+        if location is None:
+            return None
+        return _Unpickler(io.BytesIO(self._read_block(location)), self).load()
+
+    def compact(self):
+        """Rewrite the file without the blocks that were replaced
+
+        Every save_sorted() appends a new sort result and header and
+        leaves the previous ones in the file. The blocks still in use are
+        copied to a new file, which then replaces the file. Datasets
+        opened before keep reading the old file. Not supported on
+        Windows, where a file cannot be replaced while it is open.
+
+        Returns
+            Number of bytes freed
+        """
+        with self._locked() as f:
+            header = self._read_header()
+            size = os.fstat(f.fileno()).st_size
+            compacted = "{}.compact".format(self.filename)
+            with open(compacted, "wb") as out:
+                out.write(MAGIC)
+                out.write(_POINTER.pack(0, 0))
+                for entry in header["channels"].values():
+                    offset = out.tell()
+                    _copy_block(f, out, entry["offset"], entry["length"] * entry["dtype"].itemsize)
+                    entry["offset"] = offset
+                    for key in ("attrs", "sorted"):
+                        location = entry[key]
+                        if location is not None:
+                            entry[key] = (out.tell(), location[1])
+                            _copy_block(f, out, *location)
+                _append_header(out, header)
+                os.fsync(out.fileno())
+            os.replace(compacted, self.filename)
+            self.header = header
+            return size - os.path.getsize(self.filename)
+
+
+def _append_header(f, header):
+    """Write header at the end of f and point the start of the file to it"""
+    f.seek(0, os.SEEK_END)
+    offset = f.tell()
+    data = pickle.dumps(header, protocol=pickle.HIGHEST_PROTOCOL)
+    f.write(data)
+    f.flush()
+    os.fsync(f.fileno())
+    f.seek(len(MAGIC))
+    f.write(_POINTER.pack(offset, len(data)))
+    f.flush()
+
+
+@contextmanager
+def _file_lock(f):
+    """Exclusive lock of an open file against other processes
+
+    Uses flock where it is available and msvcrt on Windows. Without
+    either, the file is not locked.
+    """
+    try:
+        import fcntl
+    except ImportError:
+        fcntl = None
+    try:
+        import msvcrt
+    except ImportError:
+        msvcrt = None
+
+    if fcntl is not None:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+    elif msvcrt is not None:
+        f.seek(_LOCK_OFFSET)
+        while True:
+            try:
+                # Gives up after 10 attempts, 1 second apart
+                msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                break
+            except OSError:
+                pass
+        try:
+            yield
+        finally:
+            f.seek(_LOCK_OFFSET)
+            msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+    else:
+        yield
+
+
+def _copy_block(src, dst, offset, size):
+    """Copy size bytes of src from offset to the current position of dst"""
+    src.seek(offset)
+    while size > 0:
+        data = src.read(min(size, _COPY_SIZE))
+        dst.write(data)
+        size -= len(data)
+
+
+def channel_path(filename, channel):
+    """Path naming one channel of a group file, e.g. site1.suss#ch3"""
+    return "{}#{}".format(filename, channel)
+
+
+def split_channel_path(path):
+    """The group filename and channel of a channel_path(), or None"""
+    filename, sep, channel = path.rpartition("#")
+    if not sep or not filename.endswith(EXTENSION):
+        return None
+    return filename, channel
+
+
+def channel_filename(filename, channel):
+    """A separate filename for one channel of a group file
+
+    Used to name files that belong to a single channel (e.g. the saved
+    feature basis or curation journal), site1.suss -> site1-ch3.suss
+    """
+    root, ext = os.path.splitext(filename)
+    return "{}-{}{}".format(root, channel, ext)
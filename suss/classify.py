@@ -0,0 +1,177 @@
+"""Classifying new spikes with the templates of a curated sort
+
+A TemplateClassifier holds the mean of every curated cluster in a fixed
+FeatureBasis projection, computed separately in windows of time so that
+slow drifts of the waveforms are followed. New spikes are assigned to
+the closest template of their time window (or of the nearest window, for
+spikes outside the curated time range), measured relative to the spread
+of each cluster around its templates. Spikes too far from every template
+are rejected.
+"""
+
+import numpy as np
+
+import suss.io
+from suss.features import FeatureBasis
+
+
+class TemplateClassifier(object):
+    """Nearest template classification of spikes"""
+
+    def __init__(self, basis, labels, window_edges, templates, spreads, reject_label=-1):
+        """
+        Args
+            basis: FeatureBasis the templates are computed in
+            labels: Label of each cluster
+            window_edges: Times separating the windows (n_windows - 1)
+            templates: (n_windows, n_clusters, n_components) templates
+            spreads: RMS distance of each cluster's spikes to its templates
+            reject_label: Label given to rejected spikes
+        """
+        self.basis = basis
+        self.labels = np.asarray(labels)
+        self.window_edges = np.asarray(window_edges, dtype=float)
+        self.templates = np.asarray(templates, dtype=float)
+        self.spreads = np.asarray(spreads, dtype=float)
+        self.reject_label = reject_label
+
+    def __repr__(self):
+        return "TemplateClassifier of {} clusters in {} time windows".format(
+            len(self.labels), len(self.templates))
+
+    @classmethod
+    def fit(cls, dataset, n_components=6, window=600.0, min_count=20, basis=None):
+        """Compute templates of the clusters of a curated ClusterDataset
+
+        Args
+            dataset: Curated ClusterDataset
+            n_components: Number of basis components the templates use
+            window: Duration (seconds) of the time windows templates are
+                computed in
+            min_count: Clusters with fewer spikes in a window use their
+                template of the whole recording in that window
+            basis: FeatureBasis to use (defaults to the recording's,
+                fitting one if it has none)
+        """
+        if not len(dataset):
+            raise ValueError("Cannot fit a classifier on an empty dataset")
+
+        basis = basis or dataset.feature_basis
+        if basis is None:
+            basis = FeatureBasis.fit(dataset.recording)
+        n_components = min(n_components, basis.n_components)
+        basis = FeatureBasis(
+            basis.mean,
+            basis.components[:n_components],
+            basis.explained_variance[:n_components])
+
+        flat = dataset.flatten()
+        labels, cluster_idx = np.unique(flat.labels, return_inverse=True)
+        features = basis.project(flat)
+        times = flat.times
+
+        n_windows = max(1, int(np.ceil((times[-1] - times[0]) / window)))
+        window_edges = times[0] + window * np.arange(1, n_windows)
+        window_idx = np.searchsorted(window_edges, times, side="right")
+
+        # Sums and counts of every (window, cluster) in one pass
+        n_clusters = len(labels)
+        flat_idx = window_idx * n_clusters + cluster_idx
+        counts = np.bincount(flat_idx, minlength=n_windows * n_clusters)
+        sums = np.stack([
+            np.bincount(flat_idx, weights=features[:, i], minlength=n_windows * n_clusters)
+            for i in range(n_components)
+        ], axis=1)
+
+        global_counts = counts.reshape(n_windows, n_clusters).sum(axis=0)
+        global_means = (
+            sums.reshape(n_windows, n_clusters, n_components).sum(axis=0) /
+            global_counts[:, None]
+        )
+        counts = counts.reshape(n_windows, n_clusters)
+        templates = np.where(
+            (counts >= min_count)[:, :, None],
+            sums.reshape(n_windows, n_clusters, n_components) /
+                np.maximum(counts, 1)[:, :, None],
+            global_means[None]
+        )
+
+        residuals = features - templates[window_idx, cluster_idx]
+        spreads = np.sqrt(
+            np.bincount(cluster_idx, weights=np.sum(residuals ** 2, axis=1)) /
+            global_counts
+        )
+
+        return cls(basis, labels, window_edges, templates, spreads)
+
+    def distances(self, waveforms, times):
+        """Distance of spikes to every cluster, relative to its spread
+
+        Args
+            waveforms: (n_spikes, n_samples) array
+            times: Sorted spike times
+
+        Returns
+            (n_spikes, n_clusters) array
+        """
+        features = self.basis.transform(waveforms)
+        window_idx = np.searchsorted(self.window_edges, times, side="right")
+        scale = 1.0 / np.maximum(self.spreads, np.finfo(float).eps) ** 2
+
+        dist = np.empty((len(features), len(self.labels)))
+        # Spikes are sorted by time so each window is a contiguous block
+        bounds = np.searchsorted(window_idx, np.arange(len(self.templates) + 1))
+        for window, (start, stop) in enumerate(zip(bounds[:-1], bounds[1:])):
+            if start == stop:
+                continue
+            block = features[start:stop]
+            templates = self.templates[window]
+            dist[start:stop] = (
+                np.sum(block ** 2, axis=1)[:, None] -
+                2 * np.dot(block, templates.T) +
+                np.sum(templates ** 2, axis=1)[None, :]
+            )
+        dist = np.maximum(dist, 0.0)
+        dist *= scale
+        return np.sqrt(dist, out=dist)
+
+    def predict(self, dataset, reject_threshold=3.0, chunk_size=200000):
+        """Label spikes of a SpikeDataset
+
+        Args
+            dataset: SpikeDataset (or any unclustered dataset) of new spikes
+            reject_threshold: Spikes farther than this many spreads from
+                every template are given reject_label. None to disable.
+            chunk_size: Number of spikes classified at once
+
+        Returns
+            Array of labels, one per spike of dataset
+        """
+        waveforms = dataset.waveforms
+        times = dataset.times
+        result = np.empty(len(dataset), dtype=self.labels.dtype)
+        for start in range(0, len(dataset), chunk_size):
+            stop = start + chunk_size
+            dist = self.distances(waveforms[start:stop], times[start:stop])
+            best = np.argmin(dist, axis=1)
+            chunk_labels = self.labels[best]
+            if reject_threshold is not None:
+                rejected = dist[np.arange(len(best)), best] > reject_threshold
+                chunk_labels[rejected] = self.reject_label
+            result[start:stop] = chunk_labels
+
+        return result
+
+    def cluster(self, dataset, reject_threshold=3.0, chunk_size=200000):
+        """Cluster the spikes of a SpikeDataset that are not rejected"""
+        labels = self.predict(
+            dataset, reject_threshold=reject_threshold, chunk_size=chunk_size)
+        kept = labels != self.reject_label
+        return dataset.select(kept).cluster(labels[kept])
+
+    def save(self, filename):
+        suss.io.save_pickle(filename, self)
+
+    @classmethod
+    def load(cls, filename):
+        return suss.io.read_pickle(filename)
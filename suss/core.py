@@ -1,15 +1,19 @@
 import numpy as np
 
+from suss.storage import encode_chunks, make_storage
+
 
 class BaseDataset(object):
     """Dataset of times and raw data (i.e. spike waveforms)"""
-    def __init__(self, times, data_column="datapoints", **columns):
+    def __init__(self, times, data_column="datapoints", time_dtype="float64", **columns):
         """
         Args
             times: Array of times
             data_column: A string used to describe the data being clustered.
                 It it allows direct access to this column of the data
                 through an instance attribute. Defaults to "datapoints".
+            time_dtype: Dtype of the times column. Integer dtypes hold
+                sample indices (see SpikeDataset)
             **columns: Keywords mapping column names to tuple containing
                 the data to be stored and the dtype. For example,
                 >>> BaseDataset(..., labels=(np.array([0, 1, 2]), ("int32")))
@@ -29,18 +33,22 @@ class BaseDataset(object):
         col_datas, col_dtypes = zip(*_col_data_dtype_pairs)
 
         times = np.array(times).flatten()
-        sorter = np.argsort(times)
+        sorter = np.argsort(times, kind="stable")
         _order = np.empty_like(sorter)
         _order[sorter] = np.arange(len(sorter))
 
-        self._data = np.array(
-            list(zip(times, _order, *col_datas)),
-            dtype=([
-                ("times", "float64"),
-                ("ids", "int32")
-            ] + list(zip(col_names, col_dtypes)))
-        )
-        self._data.sort(order="ids")
+        # Filled column by column so that large columns (e.g. waveforms)
+        # are copied once, without intermediate rows
+        self._data = np.empty(len(times), dtype=([
+            ("times", time_dtype),
+            ("ids", "int32")
+        ] + list(zip(col_names, col_dtypes))))
+        self._data["times"] = times
+        self._data["ids"] = _order
+        for col_name, col_data in zip(col_names, col_datas):
+            self._data[col_name] = col_data
+        if np.any(times[1:] < times[:-1]):
+            self._data = self._data[sorter]
         self.data_column = data_column
 
         # List of Tag objects for this dataset or cluster
@@ -64,13 +72,56 @@ class BaseDataset(object):
             self._tags = set()
         return self._tags.remove(tag)
 
+    @property
+    def recording(self):
+        """The bottom level dataset (e.g. SpikeDataset) this was derived from"""
+        dataset = self
+        while True:
+            source = getattr(dataset, "source", dataset)
+            if source is not dataset:
+                dataset = source
+            elif dataset.has_children and len(dataset):
+                dataset = dataset.nodes[0]
+            else:
+                return dataset
+
+    @property
+    def feature_basis(self):
+        """The FeatureBasis shared by all datasets of a recording, or None"""
+        return getattr(self.recording, "_feature_basis", None)
+
+    @feature_basis.setter
+    def feature_basis(self, basis):
+        self.recording._feature_basis = basis
+
     # Set the data_column string as an accessible property
     def _get_data_column(self):
         if not self.has_children:
-            return self._data[self.data_column]
+            return self._decode(self._data[self.data_column])
         else:
             return np.array([node.centroid for node in self.nodes])
 
+    def _decode(self, stored):
+        """Data of the data column in float64 (see storage.py)"""
+        storage = getattr(getattr(self, "source", self), "storage", None)
+        if storage is None:
+            return stored
+        return storage.decode(stored)
+
+    def iter_chunks(self, chunk_size=100000):
+        """Iterate over the data column in chunks of chunk_size rows
+
+        Compactly stored data is only decoded one chunk at a time
+        """
+        if self.has_children:
+            data = self._get_data_column()
+            for start in range(0, len(data), chunk_size):
+                yield data[start:start + chunk_size]
+        else:
+            stored = self._data[self.data_column]
+            for start in range(0, len(stored), chunk_size):
+                yield self._decode(stored[start:start + chunk_size])
+
     def __getattr__(self, attr):
         """Allow access of data_column as an attribute"""
         # hack
@@ -136,7 +187,51 @@ class BaseDataset(object):
 
     @property
     def times(self):
-        return self._data["times"]
+        """Times in seconds"""
+        times = self._data["times"]
+        if times.dtype.kind in "iu":
+            return times / getattr(self, "source", self).sample_rate
+        return times
+
+    @property
+    def has_sample_times(self):
+        """Whether the recording stores times as integer sample indices"""
+        return self.recording._data.dtype["times"].kind in "iu"
+
+    @property
+    def samples(self):
+        """Times as integer sample indices of the recording
+
+        Exact (and free) when the times are stored as sample indices,
+        rounded from the times in seconds otherwise
+        """
+        times = self._data["times"]
+        if times.dtype.kind in "iu":
+            return times
+        sample_rate = getattr(self.recording, "sample_rate", None)
+        if sample_rate is None:
+            raise ValueError("Sample indices need the sample_rate of the recording")
+        return np.round(times * sample_rate).astype(np.int64)
+
+    def time_range(self, t_start, t_stop):
+        """Select the items with times in [t_start, t_stop) seconds
+
+        Found by bisecting the sorted times; with sample indices the
+        bounds are converted to samples and compared as integers.
+        """
+        times = self._data["times"]
+        if times.dtype.kind in "iu":
+            sample_rate = getattr(self, "source", self).sample_rate
+            limits = np.iinfo(times.dtype)
+            bounds = np.clip(
+                np.ceil(np.array([t_start, t_stop]) * sample_rate),
+                limits.min,
+                limits.max
+            ).astype(times.dtype)
+        else:
+            bounds = np.array([t_start, t_stop], dtype=times.dtype)
+        start, stop = np.searchsorted(times, bounds, side="left")
+        return self.select(slice(start, stop))
 
     @property
     def nodes(self):
@@ -153,15 +248,35 @@ class BaseDataset(object):
     def ids(self):
         return self._data["ids"]
 
+    @property
+    def data_shape(self):
+        """Shape of the data column, decoding only its first row"""
+        if self.has_children:
+            return self._get_data_column().shape
+        stored = self._data[self.data_column]
+        return (len(stored),) + self._decode(stored[:1]).shape[1:]
+
     @property
     def centroid(self):
-        """Representative datapoint is the mean"""
-        return np.mean(getattr(self, self.data_column), axis=0)
+        """Representative datapoint is the mean
+
+        Summed chunk by chunk, so compactly stored data is never decoded
+        all at once
+        """
+        if not len(self):
+            return np.mean(getattr(self, self.data_column), axis=0)
+        return np.sum([np.sum(chunk, axis=0) for chunk in self.iter_chunks()], axis=0) / len(self)
 
     @property
     def time(self):
-        """Representative time is the median time"""
-        return np.median(self.times)
+        """Representative time is the median time
+
+        Cached, as a dataset's times do not change after it is created
+        """
+        _time = getattr(self, "_time", None)
+        if _time is None:
+            _time = self._time = np.median(self.times)
+        return _time
 
     def __lt__(self, other):
         """Order objects by their median time
@@ -265,6 +380,41 @@ class ClusterDataset(BaseDataset):
             nodes=(subnodes, np.object),
             labels=(labels, "int32")
         )
+        self._build_index()
+
+    def _build_index(self):
+        label_index = {}
+        for idx, label in enumerate(self.labels.tolist()):
+            label_index.setdefault(label, []).append(idx)
+        self._label_index = label_index
+        self._node_index = dict(
+            (id(node), idx)
+            for idx, node in enumerate(self.nodes)
+        )
+
+    @property
+    def label_index(self):
+        """Dict mapping each label to the positions of nodes with that label"""
+        if getattr(self, "_label_index", None) is None:
+            self._build_index()
+        return self._label_index
+
+    @property
+    def node_index(self):
+        """Dict mapping the id() of each node object to its position
+
+        Nodes are looked up by identity, not by value
+        """
+        if getattr(self, "_node_index", None) is None:
+            self._build_index()
+        return self._node_index
+
+    def __getstate__(self):
+        # Node ids are not valid after unpickling; indexes are rebuilt lazily
+        state = self.__dict__.copy()
+        state.pop("_label_index", None)
+        state.pop("_node_index", None)
+        return state
 
     def select(self, selector, child=True):
         """Select items by selection array
@@ -288,11 +438,49 @@ class ClusterDataset(BaseDataset):
         if child:
             return super().select(selector)
         else:
-            return ClusterDataset(
-                self.nodes[selector],
-                data_column=self.data_column,
-                labels=self.labels[selector]
-            )
+            keep = np.zeros(len(self), dtype=bool)
+            keep[selector] = True
+            return self.derive(remove=np.logical_not(keep))
+
+    def derive(self, remove=None, nodes=(), labels=None):
+        """Create a new ClusterDataset by removing and adding nodes
+
+        Records of the nodes that are kept are copied over and their node
+        objects are shared with this dataset, so only the added nodes need
+        their representative times computed. The result is the same as
+        constructing a ClusterDataset from the kept nodes followed by the
+        added nodes.
+
+        Args
+            remove: Boolean array with length equal to number of clusters
+                in dataset. Clusters corresponding to True are left out.
+            nodes: List of nodes to add
+            labels: Labels of the added nodes
+
+        Returns
+            A new ClusterDataset; this dataset is not modified
+        """
+        kept = self._data if remove is None else self._data[np.logical_not(remove)]
+
+        added = np.zeros(len(nodes), dtype=self._data.dtype)
+        if len(nodes):
+            if labels is None:
+                labels = np.zeros(len(nodes))
+            added["times"] = [node.time for node in nodes]
+            added["nodes"] = list(nodes)
+            added["labels"] = labels
+
+        _data = np.concatenate([kept, added])
+        _data = _data[np.argsort(_data["times"], kind="stable")]
+        _data["ids"] = np.arange(len(_data))
+
+        new_dataset = ClusterDataset.__new__(ClusterDataset)
+        new_dataset.source = new_dataset
+        new_dataset.data_column = self.data_column
+        new_dataset._data = _data
+        new_dataset._tags = set()
+        new_dataset._build_index()
+        return new_dataset
 
 
 class SubDataset(BaseDataset):
@@ -313,7 +501,7 @@ class SubDataset(BaseDataset):
         self._data = self.source._data[ids]
         if labels is not None:
             self._data["labels"] = labels
-        if not all(self.ids[:-1] <= self.ids[1:]):
+        if not np.all(self.ids[:-1] <= self.ids[1:]):
             self._data.sort(order="ids")
         self.data_column = self.parent.data_column
 
@@ -382,15 +570,65 @@ class SubDataset(BaseDataset):
 
 class SpikeDataset(BaseDataset):
 
-    def __init__(self, times, waveforms, sample_rate=None, labels=None):
+    def __init__(
+            self,
+            times,
+            waveforms,
+            sample_rate=None,
+            labels=None,
+            storage="float64",
+            n_components=12,
+            sample_times=False):
+        """
+        Args
+            times: Array of spike times in seconds, or of integer sample
+                indices if sample_times is True
+            waveforms: (n_spikes, n_samples) array of spike waveforms
+            sample_rate: Samples per second of the waveforms
+            labels: Integer label of each spike
+            storage: How waveforms are stored, one of "float64", "float32",
+                "int16" or "pca" (see storage.py). A storage object (e.g.
+                another dataset's .storage) is used as is.
+            n_components: Number of components kept by the "pca" storage
+            sample_times: Store times as integer sample indices (int32
+                when they fit, int64 otherwise). Times given as floats
+                are taken as seconds and rounded to the nearest sample.
+                .times still returns seconds, while .samples returns the
+                stored indices.
+        """
         self.source = self
         self.sample_rate = sample_rate
         if labels is None:
             labels = np.zeros(len(times))
 
+        time_dtype = "float64"
+        if sample_times:
+            if sample_rate is None:
+                raise ValueError("sample_times requires a sample_rate")
+            times = np.asarray(times)
+            if times.dtype.kind not in "iu":
+                times = np.round(times * sample_rate)
+            times = times.astype(np.int64)
+            fits = not len(times) or (
+                times.min() >= np.iinfo(np.int32).min and
+                times.max() <= np.iinfo(np.int32).max)
+            time_dtype = "int32" if fits else "int64"
+
+        if isinstance(storage, str):
+            storage = make_storage(storage, waveforms, n_components=n_components)
+        self.storage = storage
+        if storage is None:
+            column = (waveforms, ("float64", waveforms.shape[1]))
+        else:
+            column = (
+                encode_chunks(storage, waveforms),
+                storage.column_dtype(waveforms.shape[1])
+            )
+
         super().__init__(
             times=times,
             data_column="waveforms",
-            waveforms=(waveforms, ("float64", waveforms.shape[1])),
+            time_dtype=time_dtype,
+            waveforms=column,
             labels=(labels, "int32")
         )
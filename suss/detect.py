@@ -0,0 +1,254 @@
+"""Detecting spikes in continuous recordings
+
+The raw signal is read from a memory mapped file in chunks and bandpass
+filtered, carrying the filter state across chunk boundaries so the
+result is the same as filtering the whole signal at once. Spikes are
+threshold crossings of the filtered signal, with the threshold set from
+a robust estimate of the noise (the median absolute deviation), and
+their waveforms are cut out around the extremum following each crossing.
+Filtering runs in order on the calling thread while the detection in
+each filtered chunk runs on a pool of threads.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import scipy.signal
+
+from suss.core import SpikeDataset
+
+
+def read_raw(filename, dtype="int16", n_channels=1, channel=0, offset=0):
+    """Memory map one channel of a raw binary recording
+
+    Args
+        filename: File of samples interleaved by channel
+            (sample 0 of every channel, then sample 1, ...)
+        dtype: Data type of the samples (e.g. "int16", "float32")
+        n_channels: Number of interleaved channels
+        channel: Channel to read
+        offset: Bytes to skip at the start of the file (e.g. a header)
+
+    Returns
+        A 1-dimensional (strided) view of the channel's samples
+    """
+    data = np.memmap(filename, dtype=dtype, mode="r", offset=offset)
+    n_samples = len(data) // n_channels
+    return data[:n_samples * n_channels].reshape(n_samples, n_channels)[:, channel]
+
+
+def bandpass(sample_rate, low=300.0, high=6000.0, order=3):
+    """Second order sections of a Butterworth bandpass filter"""
+    high = min(high, 0.45 * sample_rate)
+    return scipy.signal.butter(
+        order, [low, high], btype="bandpass", output="sos", fs=sample_rate)
+
+
+def estimate_noise(data, sos, sample_rate, n_windows=20, window=1.0):
+    """Robust estimate of the standard deviation of the filtered noise
+
+    The median absolute deviation of the filtered signal, from windows
+    spread evenly over the recording, scaled to a standard deviation. The
+    median is barely affected by the spikes.
+
+    Args
+        data: Array of raw samples
+        sos: Filter from bandpass()
+        sample_rate: Samples per second
+        n_windows: Number of windows to estimate from
+        window: Duration (seconds) of each window (or the whole
+            recording, if it is shorter)
+    """
+    n = min(int(window * sample_rate), len(data))
+    # Part of each window discarded while the filter settles
+    settle = min(n // 2, int(0.01 * sample_rate))
+    starts = np.linspace(0, max(0, len(data) - n), n_windows).astype(int)
+    filtered = np.concatenate([
+        scipy.signal.sosfilt(sos, np.asarray(data[start:start + n], dtype=np.float32))[settle:]
+        for start in np.unique(starts)
+    ])
+    return np.median(np.abs(filtered - np.median(filtered))) / 0.6745
+
+
+def find_peaks(filtered, threshold, start, stop, search, dead_time, sign="neg"):
+    """Find the extremum following each threshold crossing
+
+    Args
+        filtered: Filtered signal
+        threshold: Positive threshold
+        start, stop: Only peaks in filtered[start:stop] are returned
+        search: Number of samples after a crossing searched for its peak
+        dead_time: Minimum number of samples between peaks
+        sign: "neg", "pos" or "both", the direction of the spikes
+
+    Returns
+        Sorted array of peak indexes into filtered
+    """
+    if sign == "neg":
+        signal = -filtered
+    elif sign == "pos":
+        signal = filtered
+    elif sign == "both":
+        signal = np.abs(filtered)
+    else:
+        raise ValueError("sign must be one of neg, pos or both")
+
+    above = signal > threshold
+    crossings = np.where(above[1:] & ~above[:-1])[0] + 1
+    crossings = crossings[crossings < len(signal) - search]
+    if not len(crossings):
+        return crossings
+
+    windows = crossings[:, None] + np.arange(search)
+    peaks = crossings + np.argmax(signal[windows], axis=1)
+    peaks = np.unique(peaks)
+
+    # Drop peaks closer than dead_time to the previous kept peak. Peaks of
+    # a burst are removed all at once, keeping the first of each group.
+    while len(peaks) > 1:
+        too_close = np.concatenate([[False], np.diff(peaks) < dead_time])
+        too_close[1:] &= ~too_close[:-1]
+        if not np.any(too_close):
+            break
+        peaks = peaks[~too_close]
+
+    return peaks[(peaks >= start) & (peaks < stop)]
+
+
+def _detect(filtered, offset, start, stop, threshold, sample_rate, n_before, n_after, search, dead_time, sign):
+    """Spike times and waveforms in one buffer of filtered signal"""
+    peaks = find_peaks(filtered, threshold, start, stop, search, dead_time, sign=sign)
+    waveforms = filtered[peaks[:, None] + np.arange(-n_before, n_after)]
+    return offset + peaks, waveforms
+
+
+def detect_chunks(
+        data,
+        sample_rate,
+        chunk_duration=10.0,
+        threshold=None,
+        threshold_factor=4.5,
+        low=300.0,
+        high=6000.0,
+        sign="neg",
+        n_before=None,
+        n_after=None,
+        dead_time=0.0005,
+        storage="float64",
+        sample_times=False,
+        n_jobs=4):
+    """Detect spikes in a continuous signal chunk by chunk
+
+    Args
+        data: Array of raw samples (e.g. from read_raw())
+        sample_rate: Samples per second
+        chunk_duration: Seconds of signal per chunk
+        threshold: Detection threshold in units of the filtered signal.
+            Defaults to threshold_factor times the noise estimated with
+            estimate_noise()
+        threshold_factor: Multiple of the noise used as the threshold
+        low, high: Band (Hz) of the bandpass filter
+        sign: "neg", "pos" or "both", the direction of the spikes
+        n_before, n_after: Samples of each waveform before and after its
+            peak (default 0.5ms and 1ms)
+        dead_time: Minimum seconds between spikes
+        storage: Storage mode of the waveforms (see core.SpikeDataset)
+        sample_times: Store spike times as the sample indices of their
+            peaks (see core.SpikeDataset)
+        n_jobs: Number of threads detecting spikes
+
+    Yields
+        A SpikeDataset of the spikes of each chunk, in order
+    """
+    if not len(data):
+        return
+
+    sos = bandpass(sample_rate, low=low, high=high)
+    if threshold is None:
+        threshold = threshold_factor * estimate_noise(data, sos, sample_rate)
+        print("Detecting spikes with threshold {:.2f}".format(threshold))
+
+    n_before, n_after = _waveform_window(sample_rate, n_before, n_after)
+    search = max(1, int(0.0005 * sample_rate))
+    dead_samples = max(1, int(dead_time * sample_rate))
+    chunk_size = int(chunk_duration * sample_rate)
+    # Samples kept from the end of a buffer, which the next buffer starts
+    # with, and those at the end whose peaks are left to the next buffer
+    margin = n_after + search + dead_samples
+    tail = n_before + margin + dead_samples
+
+    def _results(executor):
+        # The filter starts in its steady state for the first sample, so
+        # that a DC offset does not ring like a step at the start
+        zi = (scipy.signal.sosfilt_zi(sos) * data[0]).astype(np.float32)
+        previous = np.zeros(0, dtype=np.float32)
+        for chunk_start in range(0, len(data), chunk_size):
+            chunk = np.asarray(data[chunk_start:chunk_start + chunk_size], dtype=np.float32)
+            filtered, zi = scipy.signal.sosfilt(sos, chunk, zi=zi)
+            buffer = np.concatenate([previous, filtered])
+            offset = chunk_start - len(previous)
+            is_last = chunk_start + chunk_size >= len(data)
+
+            start = max(n_before, len(previous) - margin)
+            stop = len(buffer) - n_after if is_last else len(buffer) - margin
+            yield executor.submit(
+                _detect, buffer, offset, start, stop, threshold, sample_rate,
+                n_before, n_after, search, dead_samples, sign)
+            previous = buffer[-tail:]
+
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        pending = []
+        for future in _results(executor):
+            pending.append(future)
+            # Bound the filtered chunks held in memory
+            if len(pending) > 2 * n_jobs:
+                yield _to_dataset(pending.pop(0).result(), sample_rate, storage, sample_times)
+        for future in pending:
+            yield _to_dataset(future.result(), sample_rate, storage, sample_times)
+
+
+def _waveform_window(sample_rate, n_before=None, n_after=None):
+    """Samples of a waveform before and after its peak (see detect_chunks)"""
+    n_before = int(0.0005 * sample_rate) if n_before is None else n_before
+    n_after = int(0.001 * sample_rate) if n_after is None else n_after
+    return n_before, n_after
+
+
+def _to_dataset(result, sample_rate, storage, sample_times):
+    samples, waveforms = result
+    return SpikeDataset(
+        times=samples if sample_times else samples / sample_rate,
+        waveforms=waveforms.astype(np.float64),
+        sample_rate=sample_rate,
+        storage=storage,
+        sample_times=sample_times)
+
+
+def detect_spikes(data, sample_rate, storage="float64", sample_times=False, **kwargs):
+    """Detect all spikes of a continuous signal as one SpikeDataset
+
+    Args
+        data: Array of raw samples (e.g. from read_raw())
+        sample_rate: Samples per second
+        storage: Storage mode of the waveforms (see core.SpikeDataset)
+        sample_times: Store spike times as sample indices
+        **kwargs: Passed to detect_chunks()
+
+    An empty recording gives an empty dataset, with waveforms of the
+    same width as if spikes had been found.
+    """
+    n_before, n_after = _waveform_window(
+        sample_rate, kwargs.get("n_before"), kwargs.get("n_after"))
+    samples = [np.zeros(0, dtype=np.int64)]
+    waveforms = [np.zeros((0, n_before + n_after), dtype=np.float32)]
+    for chunk in detect_chunks(data, sample_rate, sample_times=True, **kwargs):
+        samples.append(chunk.samples)
+        waveforms.append(chunk.waveforms.astype(np.float32))
+
+    samples = np.concatenate(samples).astype(np.int64)
+    return SpikeDataset(
+        times=samples if sample_times else samples / sample_rate,
+        waveforms=np.concatenate(waveforms),
+        sample_rate=sample_rate,
+        storage=storage,
+        sample_times=sample_times)
@@ -0,0 +1,159 @@
+"""Feature spaces shared by the sorting stages, operations and gui
+
+A FeatureBasis is an incremental PCA of all waveforms of a recording.
+It is fit once (streaming over the waveforms in chunks), attached to the
+recording's SpikeDataset and saved next to the dataset file, and is then
+used as a fixed linear projection wherever a PCA of waveforms is needed.
+Refitting a PCA on a local subset of the data remains available by
+passing refit=True to the functions that project data.
+"""
+
+import os
+
+import numpy as np
+from sklearn.decomposition import PCA, IncrementalPCA
+
+
+class FeatureBasis(object):
+    """Fixed PCA projection of waveforms"""
+
+    def __init__(self, mean, components, explained_variance):
+        self.mean = np.asarray(mean)
+        self.components = np.asarray(components)
+        self.explained_variance = np.asarray(explained_variance)
+
+    def __repr__(self):
+        return "FeatureBasis with {} components of {} samples".format(
+            *self.components.shape)
+
+    @classmethod
+    def from_pca(cls, pca):
+        """Wrap a fitted sklearn PCA (e.g. a local refit) as a FeatureBasis"""
+        return cls(pca.mean_, pca.components_, pca.explained_variance_)
+
+    @property
+    def n_components(self):
+        return len(self.components)
+
+    @classmethod
+    def fit(cls, dataset, n_components=12, chunk_size=10000):
+        """Fit a basis to all waveforms in a dataset in chunks
+
+        Args
+            dataset: An instance of core.BaseDataset with waveforms
+            n_components: Number of principal components to keep
+            chunk_size: Approximate number of waveforms per chunk
+        """
+        ipca = None
+        pending = None
+        # Waveforms are decoded one chunk at a time (see core.iter_chunks);
+        # a short last chunk is fit together with the one before it
+        for chunk in dataset.iter_chunks(chunk_size):
+            if ipca is None:
+                n_components = min(n_components, len(dataset), chunk.shape[1])
+                ipca = IncrementalPCA(n_components=n_components)
+            if pending is not None and len(chunk) >= n_components:
+                ipca.partial_fit(pending)
+                pending = chunk
+            elif pending is not None:
+                pending = np.concatenate([pending, chunk])
+            else:
+                pending = chunk
+        ipca.partial_fit(pending)
+
+        return cls.from_pca(ipca)
+
+    def transform(self, waveforms, n_components=None, whiten=False):
+        """Project waveforms onto the first n_components of the basis"""
+        n_components = n_components or self.n_components
+        projected = np.dot(
+            waveforms - self.mean,
+            self.components[:n_components].T
+        )
+        if whiten:
+            projected /= np.sqrt(self.explained_variance[:n_components])
+        return projected
+
+    def project(self, dataset, n_components=None, whiten=False, chunk_size=100000):
+        """Project a dataset's waveforms, decoding them chunk by chunk"""
+        n_components = n_components or self.n_components
+        projected = [
+            self.transform(chunk, n_components=n_components, whiten=whiten)
+            for chunk in dataset.iter_chunks(chunk_size)
+        ]
+        if not projected:
+            return np.zeros((0, n_components))
+        return np.concatenate(projected)
+
+    def save(self, filename):
+        np.savez(
+            filename,
+            mean=self.mean,
+            components=self.components,
+            explained_variance=self.explained_variance)
+
+    @classmethod
+    def load(cls, filename):
+        with np.load(filename) as data:
+            return cls(
+                data["mean"],
+                data["components"],
+                data["explained_variance"])
+
+
+def basis_filename(filename):
+    """Location of the FeatureBasis saved next to a dataset file"""
+    return "{}.basis.npz".format(os.path.splitext(filename)[0])
+
+
+def load_or_fit_basis(dataset, filename, n_components=12):
+    """Attach the dataset's FeatureBasis, fitting and saving it if missing
+
+    Args
+        dataset: A SpikeDataset or any dataset derived from one
+        filename: Path of the file the dataset was loaded from
+
+    Returns
+        The FeatureBasis attached to the dataset's recording
+    """
+    if dataset.feature_basis is not None:
+        return dataset.feature_basis
+
+    path = basis_filename(filename)
+    if os.path.exists(path):
+        basis = FeatureBasis.load(path)
+    else:
+        basis = FeatureBasis.fit(dataset.recording, n_components=n_components)
+        basis.save(path)
+
+    dataset.feature_basis = basis
+    return basis
+
+
+def get_basis(dataset, basis=None, refit=False):
+    """Find the basis to project a dataset with
+
+    Returns None if the projection should be refit locally, i.e. when
+    refit is True or no basis is available for the dataset.
+    """
+    if refit:
+        return None
+    if basis is not None:
+        return basis
+    return dataset.feature_basis
+
+
+def project(dataset, n_components, basis=None, refit=False, whiten=False):
+    """Project a dataset's waveforms onto n_components principal axes
+
+    Uses the recording's FeatureBasis unless refit is True (or there is
+    no basis), in which case a PCA is fit to dataset's waveforms.
+    """
+    basis = get_basis(dataset, basis=basis, refit=refit)
+    if basis is not None and n_components <= basis.n_components:
+        return basis.project(dataset, n_components=n_components, whiten=whiten)
+
+    return PCA(
+        n_components=n_components,
+        whiten=whiten
+    ).fit_transform(dataset.waveforms)
@@ -8,6 +8,15 @@ from PyQt5.QtCore import QTimer, pyqtSignal
 from PyQt5 import QtGui as gui
 
 import suss.io
+from suss.channels import (
+        EXTENSION,
+        ChannelGroup,
+        channel_filename,
+        channel_path,
+        split_channel_path
+)
+from suss.features import load_or_fit_basis
+from suss.journal import CurationJournal, journal_filename
 
 import suss.gui.config as config
 from suss.gui.cluster_select import ClusterSelector
@@ -18,14 +27,17 @@ from suss.gui.tsne import TSNEPlot
 from suss.gui.waveforms import WaveformsPlot
 from suss.gui.utils import make_color_map, get_changed_labels
 from suss.operations import (
+        CleanupCache,
         add_nodes,
         cleanup_node,
         delete_nodes,
+        fast_recluster_node,
         match_one,
         merge_nodes,
         recluster_node,
         recluster_node_in_time,
-        cleanup_cluster_assignments
+        cleanup_cluster_assignments,
+        suggest_merges
 )
 
 
@@ -39,6 +51,9 @@ class App(widgets.QMainWindow):
         self._closing = False
         self.title = "SUSS Viewer"
         self.suss_viewer = None
+        # ChannelGroup the dataset was opened from, if any; it is saved
+        # back into the group
+        self.group = None
         self.init_actions()
         self.init_ui()
         self.setup_shortcuts()
@@ -86,10 +101,12 @@ class App(widgets.QMainWindow):
     def init_actions(self):
         self.load_action = widgets.QAction("Open...", self)
         self.save_action = widgets.QAction("Save", self)
+        self.replay_action = widgets.QAction("Replay Curation...", self)
         self.close_action = widgets.QAction("Close", self)
 
         self.load_action.triggered.connect(self.run_file_loader)
         self.save_action.triggered.connect(self.run_file_saver)
+        self.replay_action.triggered.connect(self.run_journal_loader)
         self.close_action.triggered.connect(self.close)
 
     def init_ui(self):
@@ -101,6 +118,8 @@ class App(widgets.QMainWindow):
         fileMenu.addAction(self.load_action)
         fileMenu.addSeparator()
         fileMenu.addAction(self.save_action)
+        fileMenu.addSeparator()
+        fileMenu.addAction(self.replay_action)
         # fileMenu.addAction(self.close_action)
 
         self.display_splash()
@@ -136,13 +155,42 @@ class App(widgets.QMainWindow):
             self,
             "Load dataset",
             config.BASE_DIRECTORY or ".",
-            "(*.pkl)",
+            "(*.pkl *{})".format(EXTENSION),
             options=options)
 
-        if selected_file:
+        if selected_file.endswith(EXTENSION):
+            self.load_channel(selected_file)
+        elif selected_file:
+            self.group = None
             self.current_file = selected_file
             self.load_dataset(selected_file)
 
+    def load_channel(self, filename):
+        """Pick one channel of a group file and open its sort result"""
+        group = ChannelGroup(filename)
+        channels = [
+            "{}{}".format(channel, "" if group.has_sorted(channel) else " (not sorted)")
+            for channel in group.channels
+        ]
+        selected, ok = widgets.QInputDialog.getItem(
+            self, "Open channel", "Channel", channels, 0, False)
+        if not ok:
+            return
+
+        channel = group.channels[channels.index(selected)]
+        dataset = group.load_sorted(channel)
+        if dataset is None:
+            widgets.QMessageBox.information(
+                    self,
+                    "Open channel",
+                    "Channel {} has not been sorted yet".format(channel)
+            )
+            return
+
+        self.group = group
+        self.current_file = channel_path(filename, channel)
+        self.show_dataset(dataset, self.current_file)
+
     def run_file_saver(self):
         if not self.suss_viewer:
             return
@@ -155,6 +203,11 @@ class App(widgets.QMainWindow):
             )
             self.suss_viewer.unhide_all()
 
+        if self.group is not None:
+            # Replaces the channel's sort result in its group file
+            self.save_dataset(self.current_file)
+            return
+
         options = widgets.QFileDialog.Options()
         # options |= widgets.QFileDialog.DontUseNativeDialog
         default_name = self.current_file.replace("sorted", "curated")
@@ -170,11 +223,30 @@ class App(widgets.QMainWindow):
         if filename:
             self.save_dataset(filename)
 
+    def run_journal_loader(self):
+        if not self.suss_viewer:
+            return
+
+        options = widgets.QFileDialog.Options()
+        selected_file, _ = widgets.QFileDialog.getOpenFileName(
+            self,
+            "Replay curation",
+            config.BASE_DIRECTORY or ".",
+            "(*.journal.pkl)",
+            options=options)
+
+        if selected_file:
+            self.suss_viewer.replay_journal(CurationJournal.load(selected_file))
+
     def load_dataset(self, filename):
         if filename.endswith("pkl"):
             dataset = suss.io.read_pickle(filename)
         elif filename.endswith("npy"):
             dataset = suss.io.read_numpy(filename)
+        self.show_dataset(dataset, filename)
+
+    def show_dataset(self, dataset, filename):
+        load_or_fit_basis(dataset, _own_filename(filename))
 
         self.title = "SUSS Viewer - {}".format(filename)
         self.setWindowTitle(self.title)
@@ -183,7 +255,12 @@ class App(widgets.QMainWindow):
 
     def save_dataset(self, filename):
         try:
-            suss.io.save_pickle(filename, self.suss_viewer.dataset)
+            group_channel = split_channel_path(filename)
+            if group_channel is not None:
+                self.group.save_sorted(group_channel[1], self.suss_viewer.dataset)
+            else:
+                suss.io.save_pickle(filename, self.suss_viewer.dataset)
+            self.suss_viewer.journal.save(journal_filename(_own_filename(filename)))
         except Exception as e:
             suss.io.save_pickle(
                 "{}.recovery".format(filename),
@@ -209,6 +286,18 @@ class App(widgets.QMainWindow):
             )
 
 
+def _own_filename(filename):
+    """Path that files belonging to a dataset file are named after
+
+    Channels of a group file are named as if they had their own file
+    (see channels.channel_filename())
+    """
+    group_channel = split_channel_path(filename)
+    if group_channel is None:
+        return filename
+    return channel_filename(*group_channel)
+
+
 class Splash(widgets.QWidget):
     """Splash screen displaying initial options"""
 
@@ -249,6 +338,15 @@ class SussViewer(widgets.QFrame):
         self.stack = [("load", dataset)]
         self.redo_stack = []
         self.hidden = []
+        # Journal entries of hide operations, dropped again on unhide
+        self.hide_entries = []
+
+        # Maps id() of each dataset in the history to the dataset and the
+        # CurationJournal entries of the operations that produced it
+        self.journal_entries = {id(dataset): (dataset, [])}
+
+        # Projection and neighbor graph reused by repeated cleanups
+        self.cleanup_cache = CleanupCache()
 
         self.selected = set()
         self._highlights_disabled = False
@@ -298,6 +396,7 @@ class SussViewer(widgets.QFrame):
         self.show_live_auditory_responses_action.setChecked(False)
         self.show_playback_auditory_responses_action.setChecked(False)
         self.cleanup_clusters_action = widgets.QAction("Cleanup Clusters (kneighbors classifier)", self)
+        self.suggest_merges_action = widgets.QAction("Suggest Merges", self)
 
         self.unhide_all_action.triggered.connect(self.unhide_all)
         self.undo_action.triggered.connect(self._undo)
@@ -310,6 +409,7 @@ class SussViewer(widgets.QFrame):
         self.show_live_auditory_responses_action.triggered.connect(partial(self.toggle_auditory, "live"))
         self.show_playback_auditory_responses_action.triggered.connect(partial(self.toggle_auditory, "playback"))
         self.cleanup_clusters_action.triggered.connect(self.cleanup_clusters)
+        self.suggest_merges_action.triggered.connect(self.suggest_merges)
 
     def toggle_auditory(self, category, state):
         if category == "live":
@@ -321,7 +421,11 @@ class SussViewer(widgets.QFrame):
         self.AUDITORY_RESPONSES.emit(category, state)
 
     def cleanup_clusters(self, state):
-        _new_dataset = cleanup_cluster_assignments(self.dataset, n_neighbors=3)
+        _new_dataset = cleanup_cluster_assignments(
+            self.dataset,
+            n_neighbors=3,
+            cache=self.cleanup_cache,
+            max_passes=config.CLEANUP_MAX_PASSES)
         new_labels = set(_new_dataset.labels)
         changed_labels = get_changed_labels(_new_dataset, self.dataset)
 
@@ -331,6 +435,28 @@ class SussViewer(widgets.QFrame):
         self._enstack("clean", _new_dataset)
         self.CLUSTER_SELECT.emit(self.selected, _old_selected)
 
+    def suggest_merges(self):
+        """Show the best merge candidates and select the top pair"""
+        candidates = suggest_merges(self.dataset, n_candidates=10)
+        if not len(candidates):
+            return
+
+        lines = [
+            "{} + {}: distance={:.2f} refractory={:.2f} overlap={:.2f}".format(
+                c["label_a"],
+                c["label_b"],
+                c["template_distance"],
+                c["refractory_ratio"],
+                c["temporal_overlap"])
+            for c in candidates
+        ]
+        self.set_selected(set([candidates[0]["label_a"], candidates[0]["label_b"]]))
+        widgets.QMessageBox.information(
+                self,
+                "Merge candidates",
+                "\n".join(lines)
+        )
+
     @contextmanager
     def temporary_highlight(self, label):
         prev_highlight = self.highlighted
@@ -367,6 +493,10 @@ class SussViewer(widgets.QFrame):
             menu.addAction(_recluster_action)
             _recluster_action.triggered.connect(partial(self.recluster, label, "waveform"))
 
+            _fast_recluster_action = widgets.QAction("Quick Recluster Cluster {}".format(label), self)
+            menu.addAction(_fast_recluster_action)
+            _fast_recluster_action.triggered.connect(partial(self.recluster, label, "fast"))
+
             _cleanup_action = widgets.QAction("Detect noise in Cluster {}".format(label), self)
             menu.addAction(_cleanup_action)
             _cleanup_action.triggered.connect(partial(self.cleanup, label))
@@ -406,8 +536,20 @@ class SussViewer(widgets.QFrame):
             menu.exec_(pos)
 
     def recluster(self, label, mode):
+        entry = None
         if mode == "waveform":
+            entry = CurationJournal.entry(self.dataset, "recluster", [label])
             _new_dataset = recluster_node(self.dataset, label=label)
+        elif mode == "fast":
+            entry = CurationJournal.entry(
+                self.dataset,
+                "fast_recluster",
+                [label],
+                time_budget=config.FAST_RECLUSTER_TIME_BUDGET)
+            _new_dataset = fast_recluster_node(
+                self.dataset,
+                label=label,
+                time_budget=config.FAST_RECLUSTER_TIME_BUDGET)
         elif mode == "time":
             _new_dataset = recluster_node_in_time(self.dataset, label=label)
         new_labels = set(_new_dataset.labels)
@@ -416,10 +558,11 @@ class SussViewer(widgets.QFrame):
         _old_selected = self.selected.copy()
         self.selected = set.intersection(new_labels, changed_labels)
         self.colors = make_color_map(_new_dataset.labels)
-        self._enstack("recluster", _new_dataset)
+        self._enstack("recluster", _new_dataset, entry=entry)
         self.CLUSTER_SELECT.emit(self.selected, _old_selected)
 
     def cleanup(self, label):
+        entry = CurationJournal.entry(self.dataset, "cleanup", [label])
         _new_dataset = cleanup_node(self.dataset, label=label)
         new_labels = set(_new_dataset.labels)
         changed_labels = get_changed_labels(_new_dataset, self.dataset)
@@ -427,7 +570,7 @@ class SussViewer(widgets.QFrame):
         _old_selected = self.selected.copy()
         self.selected = set.intersection(new_labels, changed_labels)
         self.colors = make_color_map(_new_dataset.labels)
-        self._enstack("cleanup", _new_dataset)
+        self._enstack("cleanup", _new_dataset, entry=entry)
         self.CLUSTER_SELECT.emit(self.selected, _old_selected)
 
     @property
@@ -438,6 +581,17 @@ class SussViewer(widgets.QFrame):
     def last_action(self):
         return self.stack[-1][0]
 
+    @property
+    def journal(self):
+        """CurationJournal of the operations that produced the current dataset
+
+        Hidden clusters are recorded as deleted until they are unhidden.
+        Time reclustering, batch edits and whole dataset cleanups are not
+        recorded.
+        """
+        _, entries = self.journal_entries.get(id(self.dataset), (None, []))
+        return CurationJournal(len(self.stack[0][1].recording), entries)
+
     def set_highlight(self, label, temporary=False):
         """Update highlight state and emit signal"""
         if self._highlights_disabled:
@@ -505,19 +659,49 @@ class SussViewer(widgets.QFrame):
         self.merge_action.setShortcut(gui.QKeySequence("Ctrl+M"))
         self.window().addAction(self.merge_action)
 
-    def _enstack(self, action, dataset, clear_redo=True):
+    def _enstack(self, action, dataset, clear_redo=True, entry=None):
         with self.timer_paused():
             _old_dataset = self.dataset
             with self.disable_highlighting():
                 if clear_redo:
                     self.redo_stack = []
                 self.stack.append((action, dataset))
+                self._update_journal(_old_dataset, dataset, entry)
                 self.colors = make_color_map(self.dataset.labels)
                 self.UPDATED_CLUSTERS.emit(
                         self.dataset,
                         _old_dataset,
                 )
 
+    def _update_journal(self, old_dataset, dataset, entry):
+        if id(dataset) not in self.journal_entries:
+            _, entries = self.journal_entries.get(id(old_dataset), (None, []))
+            if entry is not None:
+                entries = entries + [entry]
+            self.journal_entries[id(dataset)] = (dataset, entries)
+
+        history = set(id(ds) for _, ds in self.stack + self.redo_stack)
+        self.journal_entries = dict(
+            (key, value) for key, value in self.journal_entries.items()
+            if key in history
+        )
+
+    def replay_journal(self, journal):
+        """Apply a CurationJournal as a single step in the history"""
+        _new_dataset, skipped = journal.replay(self.dataset)
+        if len(skipped):
+            widgets.QMessageBox.information(
+                    self,
+                    "Replay",
+                    "Skipped {} of {} curation steps whose clusters "
+                    "could not be matched".format(len(skipped), len(journal))
+            )
+        _, entries = self.journal_entries.get(id(self.dataset), (None, []))
+        skipped_ids = set(id(entry) for entry in skipped)
+        replayed = [entry for entry in journal.entries if id(entry) not in skipped_ids]
+        self.journal_entries[id(_new_dataset)] = (_new_dataset, entries + replayed)
+        self._enstack("replay", _new_dataset)
+
     def _redo(self):
         if len(self.redo_stack) == 0:
             print("Nothing left to redo.")
@@ -595,6 +779,13 @@ class SussViewer(widgets.QFrame):
     def unhide_all(self):
         _new_dataset = add_nodes(self.dataset, *self.hidden)
         self.hidden = []
+        # The unhidden clusters are back, so their deletes no longer apply
+        _, entries = self.journal_entries.get(id(self.dataset), (None, []))
+        entries = [
+            entry for entry in entries
+            if not any(entry is hidden for hidden in self.hide_entries)
+        ]
+        self.journal_entries[id(_new_dataset)] = (_new_dataset, entries)
         self._enstack("unhide", _new_dataset)
 
     def merge(self):
@@ -605,6 +796,7 @@ class SussViewer(widgets.QFrame):
                     "Not enough clusters selected to merge")
             return
 
+        entry = CurationJournal.entry(self.dataset, "merge", self.selected)
         _new_dataset = merge_nodes(self.dataset, labels=self.selected)
         new_labels = set(_new_dataset.labels)
         changed_labels = get_changed_labels(_new_dataset, self.dataset)
@@ -612,7 +804,7 @@ class SussViewer(widgets.QFrame):
         _old_selected = self.selected.copy()
         self.selected = set.intersection(new_labels, changed_labels)
         self.colors = make_color_map(_new_dataset.labels)
-        self._enstack("merge", _new_dataset)
+        self._enstack("merge", _new_dataset, entry=entry)
         self.CLUSTER_SELECT.emit(self.selected, _old_selected)
 
     def _delete(self, to_delete, action="delete"):
@@ -623,10 +815,13 @@ class SussViewer(widgets.QFrame):
                     "No clusters selected for deletion")
             return
 
+        entry = CurationJournal.entry(self.dataset, "delete", to_delete)
+        if action == "hide":
+            self.hide_entries.append(entry)
         _new_dataset = delete_nodes(self.dataset, labels=list(to_delete))
 
         plural = "s" if len(to_delete) > 1 else ""
-        self._enstack("{} node".format(action) + plural, _new_dataset)
+        self._enstack("{} node".format(action) + plural, _new_dataset, entry=entry)
 
     def delete(self):
         self._delete(self.selected)
@@ -669,6 +864,7 @@ class SussViewer(widgets.QFrame):
         psth_menu.addAction(self.show_playback_auditory_responses_action)
 
         self.tools_menu.addAction(self.cleanup_clusters_action)
+        self.tools_menu.addAction(self.suggest_merges_action)
 
         self.on_dataset_changed()
         # self.cluster_selector = ClusterSelector(parent=self)
@@ -704,7 +900,7 @@ if __name__ == "__main__":
         result = app.exec_()
     except:
         recovery_file = "{}.recovery.pkl".format(
-                os.path.basename(window.current_file))
+                os.path.basename(_own_filename(window.current_file)))
         print(
             "A horrible error has occured. "
             "Saving recovery file at {}".format(recovery_file))
@@ -1,5 +1,6 @@
 import os
 import sys
+import weakref
 from functools import partial
 
 import numpy as np
@@ -10,7 +11,8 @@ from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
 from matplotlib.figure import Figure
 from matplotlib import ticker
 
-from suss.analysis import align
+from suss.analysis import align_times
+from suss.quality import cluster_quality_table, quality_row
 from suss.gui.utils import clear_axes, get_changed_labels 
 from suss.gui.tags import ClusterTag, UserTag
 
@@ -69,6 +71,9 @@ class ClusterSelector(widgets.QScrollArea):
         super().__init__(parent)
         self.allow_scroll_to = True
         self._cached_cluster_info = {}
+        # Quality table row of each cluster, kept for as long as its node
+        # exists so that only new clusters are scored after an edit
+        self._quality_rows = weakref.WeakKeyDictionary()
         self.show_auditory_responses = False
 
         # TOOD (kevin): make this configurable
@@ -178,6 +183,22 @@ class ClusterSelector(widgets.QScrollArea):
 
         wf_ylims = (np.min(self.dataset.waveforms), np.max(self.dataset.waveforms))
 
+        # New clusters are scored against all the others; the rows of
+        # unchanged clusters are kept from when they were first scored
+        new_labels = [
+            label for label, node in zip(self.dataset.labels, self.dataset.nodes)
+            if node not in self._quality_rows
+        ]
+        if len(new_labels):
+            quality = cluster_quality_table(
+                    self.dataset,
+                    max_points=config.QUALITY_MAX_POINTS,
+                    refit=config.LOCAL_PCA,
+                    labels=new_labels)
+            for label, node in zip(self.dataset.labels, self.dataset.nodes):
+                if label in new_labels:
+                    self._quality_rows[node] = quality_row(quality, label)
+
         progress = widgets.QProgressDialog(
                 "Loading {} clusters".format(
                     len(self.dataset.nodes)
@@ -257,6 +278,7 @@ class ClusterSelector(widgets.QScrollArea):
                         parent=self)
                 self._cached_cluster_info[cluster_label] = plots_widget
                 cluster_layout.addWidget(plots_widget, 1, 1)
+            plots_widget.set_quality(self._quality_rows.get(cluster))
 
             container.setLayout(cluster_layout)
 
@@ -350,8 +372,22 @@ class ClusterInfo(widgets.QWidget):
         self.fr_label = self.ax_wf.text(0, self.ax_wf.get_ylim()[0], "",
                 horizontalalignment="left", verticalalignment="bottom", fontsize=6)
         self.snr_label = None
+        self.quality_label = self.ax_psth.text(0, 1, "",
+                transform=self.ax_psth.transAxes,
+                horizontalalignment="left", verticalalignment="top", fontsize=6)
         clear_axes(self.ax_isi, self.ax_psth)
 
+    def set_quality(self, row):
+        if row is None:
+            self.quality_label.set_text("")
+        else:
+            self.quality_label.set_text(
+                "ID: {:.1f}\nL: {:.2g}\nkNN: {:.2f}".format(
+                    row["isolation_distance"],
+                    row["l_ratio"],
+                    row["knn_purity"]))
+        self.canvas.draw_idle()
+
     def set_ylim(self, ylim):
         self.ylim = ylim
         self.ax_wf.set_ylim(*self.ylim)
@@ -427,16 +463,17 @@ class ClusterInfo(widgets.QWidget):
                 )
                 if cluster.times[0] <= start_time < cluster.times[-1]
             ]
-            psth, _ = align(cluster.flatten(), stimuli_times, -1, 1)
-            if len(psth):
+            _, relative_times, _ = align_times(
+                    cluster.flatten().times, stimuli_times, -1, 1)
+            if len(stimuli_times):
                 hist, bin_edges = np.histogram(
-                        np.concatenate(psth),
+                        relative_times,
                         bins=20,
                         density=False,
                         range=(0, 1))
                 self.ax_psth.bar(
                         (bin_edges[:-1] + bin_edges[1:]) / 2,
-                        hist / len(psth),
+                        hist / len(stimuli_times),
                         width=1 / 20.0,
                         color="Black")
                 self.ax_psth.vlines(
@@ -4,6 +4,20 @@ BASE_DIRECTORY = "/auto/fhome/kevin/Projects/songephys/data/birds/WhiRed9510F/si
 
 SHOW = "pca" # umap or pca
 
+# Refit PCA on the displayed data instead of using the recording's FeatureBasis
+LOCAL_PCA = False
+
+# Seconds the "Quick Recluster" action may take (projection, neighbor search
+# and mixture fit)
+FAST_RECLUSTER_TIME_BUDGET = 2.0
+
+# Passes of neighbor voting made by "Cleanup Clusters" (stops early once no
+# point changes cluster)
+CLEANUP_MAX_PASSES = 1
+
+# Points (stratified over time) used for the quality metrics on cluster cards
+QUALITY_MAX_POINTS = 20000
+
 DEFAULT_SAVE_LOCATION = "../manually_curated"
 
 USERS = [
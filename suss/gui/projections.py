@@ -5,6 +5,8 @@ from matplotlib.figure import Figure
 from sklearn.discriminant_analysis import LinearDiscriminantAnalysis as LDA
 from sklearn.decomposition import PCA
 
+import suss.gui.config as config
+from suss.features import FeatureBasis, get_basis
 from suss.gui.utils import clear_axes
 
 
@@ -80,10 +82,16 @@ class ProjectionsPlot(widgets.QFrame):
             self.canvas.draw_idle()
             return
 
-        self.projector = PCA(n_components=2).fit(selected_data.flatten(1).waveforms)
+        self.projector = get_basis(selected_data, refit=config.LOCAL_PCA)
+        if self.projector is None:
+            self.projector = FeatureBasis.from_pca(
+                PCA(n_components=2).fit(selected_data.flatten(1).waveforms)
+            )
 
         projected = [
-            self.projector.transform(node.flatten().waveforms[::1 if skip > len(node.flatten().waveforms) else skip])
+            self.projector.transform(
+                node.flatten().waveforms[::1 if skip > len(node.flatten().waveforms) else skip],
+                n_components=2)
             for node in selected_data.nodes
         ]
 
@@ -4,7 +4,9 @@ import numpy as np
 from PyQt5 import QtWidgets as widgets
 from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
 from matplotlib.figure import Figure
-from sklearn.decomposition import PCA
+
+import suss.gui.config as config
+from suss.features import project
 
 
 class TimeseriesPlot(widgets.QFrame):
@@ -153,8 +155,11 @@ class TimeseriesPlot(widgets.QFrame):
         skip = max(1, len(self.flattened) // self.max_points)
         self.flattened = self.flattened.select(slice(None, None, skip))
 
-        self.pca = PCA(n_components=self.ndim + 1, whiten=True).fit(self.flattened.waveforms)
-        self.pcs = self.pca.transform(self.flattened.waveforms)
+        self.pcs = project(
+            self.flattened,
+            self.ndim + 1,
+            refit=config.LOCAL_PCA,
+            whiten=True)
 
         s = self.detail_level_scatter_size[self.flatten_level]
         for dim in range(self.ndim):
@@ -19,7 +19,8 @@ import scipy.stats
 from sklearn.decomposition import PCA
 import umap
 
-from suss.gui.config import SHOW
+from suss.gui.config import LOCAL_PCA, SHOW
+from suss.features import get_basis, project
 from suss.sort import tsne_time
 from suss.gui.utils import require_dataset
 
@@ -47,13 +48,18 @@ class BackgroundTSNE(QObject):
             tsne = TSNE(n_components=2).fit_transform(self.dataset.waveforms)
             tsne = np.hstack([
                 scipy.stats.zscore(self.dataset.times[:, None]),
-                PCA(n_components=1, whiten=True).fit_transform(self.dataset.waveforms)
+                project(self.dataset, 1, refit=LOCAL_PCA, whiten=True)
             ])
         else:
+            basis = get_basis(self.dataset, refit=LOCAL_PCA)
+            if basis is not None:
+                pcaed = scipy.stats.zscore(basis.project(self.dataset, n_components=6), axis=0)
+            else:
+                pcaed = PCA(n_components=6).fit_transform(scipy.stats.zscore(self.dataset.waveforms, axis=0))
             tsne = umap.UMAP(n_components=2).fit_transform(
                 np.hstack([
                     self.dataset.times[:, None] / (60.0 * 60.0),
-                    PCA(n_components=6).fit_transform(scipy.stats.zscore(self.dataset.waveforms, axis=0))
+                    pcaed
                 ])
             )
 
@@ -29,9 +29,9 @@ def get_changed_labels(new_dataset, old_dataset):
     for label in new_labels.union(old_labels):
         is_changed = True
         if label in old_labels and label in new_labels:
-            new_node = new_dataset.nodes[new_dataset.labels == label][0]
-            old_node = old_dataset.nodes[old_dataset.labels == label][0]
-            if new_node == old_node:
+            new_node = new_dataset.nodes[new_dataset.label_index[label][0]]
+            old_node = old_dataset.nodes[old_dataset.label_index[label][0]]
+            if new_node is old_node:
                 is_changed = False
         if is_changed:
             changed_labels.add(label)
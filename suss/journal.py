@@ -0,0 +1,201 @@
+"""Recording curation so that it can be replayed onto a new sort
+
+Each entry of a CurationJournal is a curation operation (see
+operations.apply_operations) whose clusters are stored as the spike ids
+they contained, instead of their labels. When the same recording is
+sorted again, each stored cluster is matched to the new cluster it
+overlaps the most, and the operation is applied to those clusters.
+"""
+
+import os
+
+import numpy as np
+
+import suss.io
+from suss.operations import apply_operations
+
+
+def journal_filename(filename):
+    """Location of the CurationJournal saved next to a dataset file"""
+    return "{}.journal.pkl".format(os.path.splitext(filename)[0])
+
+
+def spike_ids(node):
+    """Ids of the datapoints of the recording contained in a node"""
+    return node.flatten().ids
+
+
+class CurationJournal(object):
+    """Ordered list of curation operations on clusters of spike ids"""
+
+    def __init__(self, n_spikes, entries=None):
+        """
+        Args
+            n_spikes: Number of datapoints in the recording that was sorted
+            entries: List of entries, e.g. from CurationJournal.entry()
+        """
+        self.n_spikes = n_spikes
+        self.entries = list(entries or [])
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __repr__(self):
+        return "CurationJournal with {} entries".format(len(self))
+
+    @staticmethod
+    def entry(dataset, name, labels, **kwargs):
+        """Describe an operation on the clusters of dataset with given labels
+
+        Args
+            dataset: ClusterDataset the operation is applied to
+            name: One of "merge", "delete", "recluster", "fast_recluster",
+                "cleanup"
+            labels: Labels of the clusters the operation is applied to
+            **kwargs: Other arguments of the operation (e.g. n_clusters)
+        """
+        label_index = dataset.label_index
+        return dict(
+            name=name,
+            clusters=[
+                spike_ids(dataset.nodes[label_index[label][0]])
+                for label in labels
+            ],
+            kwargs=kwargs
+        )
+
+    def record(self, dataset, name, labels, **kwargs):
+        entry = self.entry(dataset, name, labels, **kwargs)
+        self.entries.append(entry)
+        return entry
+
+    def save(self, filename):
+        suss.io.save_pickle(filename, self)
+
+    @classmethod
+    def load(cls, filename):
+        return suss.io.read_pickle(filename)
+
+    def replay(self, dataset, min_overlap=0.5):
+        """Apply the journal to a new sort of the same recording
+
+        A stored cluster is matched to the current cluster sharing the most
+        spikes with it, if their overlap (intersection over union) is at
+        least min_overlap. Operations are skipped if any of their clusters
+        is unmatched, and merges whose clusters all match the same
+        cluster are skipped as already done. Recluster and cleanup
+        operations are rerun on the matched cluster.
+
+        Args
+            dataset: ClusterDataset of a sort of the recording the journal
+                was recorded on
+            min_overlap: Minimum intersection over union of the spikes of a
+                stored cluster and its matched cluster
+
+        Returns
+            The curated ClusterDataset and a list of skipped entries
+        """
+        if len(dataset.recording) != self.n_spikes:
+            raise ValueError(
+                "Journal was recorded on a recording of {} spikes; "
+                "dataset has {}".format(self.n_spikes, len(dataset.recording)))
+
+        if len(dataset) and np.min(dataset.labels) < 0:
+            raise ValueError("Cannot replay onto a dataset with negative labels")
+
+        # Current label of every spike (-1 if not in any cluster) and the
+        # spikes of every current label, updated as operations are applied
+        # so that each entry is matched without rebuilding the dataset.
+        spike_labels = -np.ones(self.n_spikes, dtype=int)
+        members = {}
+        for label, node in dataset.labeled_nodes:
+            members[label] = spike_ids(node)
+            spike_labels[members[label]] = label
+
+        def _next_label():
+            # Labels are assigned as in operations.replace_nodes()
+            return max(members) + 1 if members else 1
+
+        def _remove(label):
+            spike_labels[members[label]] = -1
+            return members.pop(label)
+
+        pending = []
+        skipped = []
+        for entry in self.entries:
+            labels = self._match(entry["clusters"], spike_labels, members, min_overlap)
+            if labels is None:
+                skipped.append(entry)
+                continue
+
+            name = entry["name"]
+            if name == "merge":
+                labels = list(np.unique(labels))
+                if len(labels) < 2:
+                    continue
+                merged = np.concatenate([_remove(label) for label in labels])
+                new_label = _next_label()
+                members[new_label] = merged
+                spike_labels[merged] = new_label
+            elif name == "delete":
+                for label in np.unique(labels):
+                    _remove(label)
+            elif name in ("recluster", "fast_recluster", "cleanup"):
+                _remove(labels[0])
+                pending.append((name, dict(entry["kwargs"], label=labels[0])))
+                # The new clusters are only known once the operation runs
+                dataset, changed_labels = apply_operations(dataset, pending)
+                pending = []
+                label_index = dataset.label_index
+                for label in changed_labels:
+                    if label in label_index and label not in members:
+                        node = dataset.nodes[label_index[label][0]]
+                        members[label] = spike_ids(node)
+                        spike_labels[members[label]] = label
+                continue
+            else:
+                raise ValueError("Unknown operation {}".format(name))
+
+            pending.append((name, dict(entry["kwargs"], labels=labels)))
+
+        if len(pending):
+            dataset, _ = apply_operations(dataset, pending)
+
+        print("Replayed {}/{} curation steps".format(
+            len(self) - len(skipped), len(self)))
+        return dataset, skipped
+
+    @staticmethod
+    def _match(clusters, spike_labels, members, min_overlap):
+        """Find the current label best matching each stored cluster
+
+        Builds the contingency table of stored clusters against current
+        labels in one bincount. Returns None if any cluster is unmatched.
+        """
+        if not len(clusters):
+            return None
+
+        sizes = np.array([len(ids) for ids in clusters])
+        ids = np.concatenate(clusters)
+        rows = np.repeat(np.arange(len(clusters)), sizes)
+
+        # Shift labels by one so unassigned spikes (-1) land in column 0
+        n_cols = (max(members) if members else 0) + 2
+        table = np.bincount(
+            rows * n_cols + spike_labels[ids] + 1,
+            minlength=len(clusters) * n_cols
+        ).reshape(len(clusters), n_cols)
+        table[:, 0] = 0
+
+        best = np.argmax(table, axis=1)
+        intersection = table[np.arange(len(clusters)), best]
+        matched_sizes = np.array([
+            len(members[label - 1]) if label - 1 in members else 0
+            for label in best
+        ])
+        union = sizes + matched_sizes - intersection
+        overlap = intersection / np.maximum(union, 1)
+        if np.any(overlap < min_overlap) or np.any(intersection == 0):
+            return None
+
+        return [int(label) - 1 for label in best]
@@ -0,0 +1,269 @@
+"""Matching curated units across recording sessions
+
+A TemplateIndex summarizes every unit (top level cluster) of curated
+ClusterDatasets from many sessions with its mean waveform (centroid),
+waveform standard deviation, firing statistics and tags. Units are
+compared through one noise normalized distance matrix computed over the
+whole index, and tracked across sessions by assigning the units of each
+session to the tracks found so far.
+"""
+
+import numpy as np
+from scipy.optimize import linear_sum_assignment
+from scipy.spatial.distance import cdist
+
+import suss.io
+from suss.analysis import isi_violations
+
+
+def unit_summary(node):
+    """Template and firing statistics of one unit
+
+    Returns
+        Dict with the unit's centroid and std waveforms, spike count,
+        firing rate (Hz) and fraction of inter-spike intervals < 1ms
+    """
+    flat = node.flatten()
+    times = flat.times
+    duration = times[-1] - times[0] if len(times) > 1 else 0.0
+    centroid = flat.centroid
+    # Waveforms are decoded chunk by chunk (see core.BaseDataset.iter_chunks)
+    squares = np.sum([
+        np.sum((chunk - centroid) ** 2, axis=0) for chunk in flat.iter_chunks()
+    ], axis=0)
+    return dict(
+        centroid=centroid,
+        std=np.sqrt(squares / len(flat)),
+        count=len(flat),
+        firing_rate=len(flat) / duration if duration > 0 else np.nan,
+        isi_violations=isi_violations(flat)
+    )
+
+
+class TemplateIndex(object):
+    """Templates of curated units from many sessions"""
+
+    def __init__(
+            self,
+            sessions,
+            labels,
+            centroids,
+            stds,
+            counts,
+            firing_rates,
+            isi_violations,
+            tags,
+            session_names=None):
+        """
+        Args
+            sessions: Session index of each unit
+            labels: Label of each unit within its session
+            centroids: (n_units, n_samples) mean waveforms
+            stds: (n_units, n_samples) waveform standard deviations
+            counts: Number of spikes of each unit
+            firing_rates: Firing rate (Hz) of each unit
+            isi_violations: Fraction of inter-spike intervals < 1ms
+            tags: List of the set of tags of each unit
+            session_names: Name of each session (defaults to its index)
+        """
+        self.sessions = np.asarray(sessions, dtype=int)
+        self.labels = np.asarray(labels)
+        self.centroids = np.asarray(centroids, dtype=float)
+        self.stds = np.asarray(stds, dtype=float)
+        self.counts = np.asarray(counts, dtype=int)
+        self.firing_rates = np.asarray(firing_rates, dtype=float)
+        self.isi_violations = np.asarray(isi_violations, dtype=float)
+        self.tags = [set(unit_tags) for unit_tags in tags]
+        n_sessions = np.max(self.sessions) + 1 if len(self.sessions) else 0
+        self.session_names = list(
+            session_names if session_names is not None else range(n_sessions))
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def __repr__(self):
+        return "TemplateIndex with {} units from {} sessions".format(
+            len(self), len(self.session_names))
+
+    @classmethod
+    def from_datasets(cls, datasets, session_names=None, include_tags=None, exclude_tags=None):
+        """Build an index from curated ClusterDatasets, one per session
+
+        Args
+            datasets: List of ClusterDatasets, in recording order
+            session_names: Name of each session (e.g. its file name)
+            include_tags: Only index units with at least one of these tags
+                (e.g. [ClusterTag.SINGLEUNIT])
+            exclude_tags: Leave out units with any of these tags
+                (e.g. [ClusterTag.NOISY])
+        """
+        include_tags = set(include_tags or [])
+        exclude_tags = set(exclude_tags or [])
+
+        columns = dict(
+            sessions=[],
+            labels=[],
+            centroids=[],
+            stds=[],
+            counts=[],
+            firing_rates=[],
+            isi_violations=[],
+            tags=[]
+        )
+        n_samples = None
+        for session, dataset in enumerate(datasets):
+            for label, node in dataset.labeled_nodes:
+                if include_tags and not (node.tags & include_tags):
+                    continue
+                if node.tags & exclude_tags:
+                    continue
+
+                summary = unit_summary(node)
+                if n_samples is None:
+                    n_samples = len(summary["centroid"])
+                elif len(summary["centroid"]) != n_samples:
+                    raise ValueError(
+                        "Waveforms of session {} have {} samples; expected {}".format(
+                            session, len(summary["centroid"]), n_samples))
+
+                columns["sessions"].append(session)
+                columns["labels"].append(label)
+                columns["centroids"].append(summary["centroid"])
+                columns["stds"].append(summary["std"])
+                columns["counts"].append(summary["count"])
+                columns["firing_rates"].append(summary["firing_rate"])
+                columns["isi_violations"].append(summary["isi_violations"])
+                columns["tags"].append(set(node.tags))
+
+        if n_samples is None:
+            columns["centroids"] = columns["stds"] = np.zeros((0, 0))
+
+        if session_names is None:
+            session_names = list(range(len(datasets)))
+        return cls(session_names=session_names, **columns)
+
+    def save(self, filename):
+        suss.io.save_pickle(filename, self)
+
+    @classmethod
+    def load(cls, filename):
+        return suss.io.read_pickle(filename)
+
+    @property
+    def noise(self):
+        """Typical waveform standard deviation at each sample"""
+        return np.median(self.stds, axis=0)
+
+    def units(self, session):
+        """Indexes of the units of a session"""
+        return np.where(self.sessions == session)[0]
+
+    def tagged(self, *tags):
+        """Indexes of the units with any of the given tags"""
+        tags = set(tags)
+        return np.array(
+            [idx for idx, unit_tags in enumerate(self.tags) if unit_tags & tags],
+            dtype=int)
+
+    def distances(self, rows=None, cols=None, rate_weight=0.0):
+        """Distance matrix between the units at rows and the units at cols
+
+        The template distance is the root mean square difference of the
+        centroids in units of the index's typical noise. With rate_weight,
+        the absolute log ratio of firing rates is added, scaled by
+        rate_weight.
+
+        Args
+            rows, cols: Indexes of units (default to all units)
+            rate_weight: Weight of the firing rate difference
+        """
+        rows = np.arange(len(self)) if rows is None else np.asarray(rows)
+        cols = np.arange(len(self)) if cols is None else np.asarray(cols)
+
+        scale = np.sqrt(self.centroids.shape[1]) * np.maximum(
+            self.noise, np.finfo(float).eps)
+        normalized = self.centroids / scale
+        dist = cdist(normalized[rows], normalized[cols])
+
+        if rate_weight:
+            log_rates = np.log(self.firing_rates)
+            rate_dist = np.abs(log_rates[rows, None] - log_rates[None, cols])
+            dist += rate_weight * np.nan_to_num(rate_dist, nan=0.0)
+
+        return dist
+
+    def match_sessions(self, session_a, session_b, max_distance=1.0, rate_weight=0.0):
+        """One-to-one matching of the units of two sessions
+
+        Returns
+            List of (label_a, label_b, distance) of matched units, with
+            distances below max_distance
+        """
+        units_a = self.units(session_a)
+        units_b = self.units(session_b)
+        dist = self.distances(units_a, units_b, rate_weight=rate_weight)
+        rows, cols = _assign(dist, max_distance)
+        return [
+            (self.labels[units_a[row]], self.labels[units_b[col]], dist[row, col])
+            for row, col in zip(rows, cols)
+        ]
+
+    def track(self, max_distance=1.0, rate_weight=0.0, max_gap=None):
+        """Follow units across sessions
+
+        Sessions are visited in order. The units of each session are
+        assigned one-to-one to the existing tracks, compared to the most
+        recent unit of each track so that slow changes of the waveform
+        are followed; unassigned units start new tracks.
+
+        Args
+            max_distance: Largest distance of a unit to a track it joins
+            rate_weight: Weight of the firing rate difference
+            max_gap: Number of sessions a track may be missing from before
+                it can no longer be joined (default: no limit)
+
+        Returns
+            Array of the track number of each unit of the index
+        """
+        track_ids = -np.ones(len(self), dtype=int)
+        # Most recent unit and session of each track
+        last_unit = []
+        last_session = []
+        for session in range(len(self.session_names)):
+            units = self.units(session)
+            if not len(units):
+                continue
+
+            open_tracks = np.arange(len(last_unit))
+            if max_gap is not None and len(open_tracks):
+                open_tracks = open_tracks[
+                    session - np.array(last_session) <= max_gap + 1]
+
+            matched = np.zeros(len(units), dtype=bool)
+            if len(open_tracks):
+                dist = self.distances(
+                    np.array(last_unit)[open_tracks], units, rate_weight=rate_weight)
+                rows, cols = _assign(dist, max_distance)
+                track_ids[units[cols]] = open_tracks[rows]
+                matched[cols] = True
+
+            for unit in units[np.logical_not(matched)]:
+                track_ids[unit] = len(last_unit)
+                last_unit.append(unit)
+                last_session.append(session)
+            for unit in units[matched]:
+                last_unit[track_ids[unit]] = unit
+                last_session[track_ids[unit]] = session
+
+        return track_ids
+
+
+def _assign(dist, max_distance):
+    """Minimum cost one-to-one assignment keeping pairs under max_distance"""
+    if not dist.size:
+        return np.array([], dtype=int), np.array([], dtype=int)
+    # Pairs that are too far apart are made too costly to be worth matching
+    cost = np.where(dist < max_distance, dist, max_distance * 10 + np.max(dist))
+    rows, cols = linear_sum_assignment(cost)
+    keep = dist[rows, cols] < max_distance
+    return rows[keep], cols[keep]
@@ -1,19 +1,29 @@
 """Operations for modifying the clusters in a dataset
 """
+import time
+import warnings
+import weakref
+
 import networkx as nx
 import numpy as np
 from sklearn.cluster import KMeans
 from sklearn.decomposition import PCA
+from sklearn.exceptions import ConvergenceWarning
 from sklearn.mixture import BayesianGaussianMixture, GaussianMixture
 from sklearn.neighbors import KNeighborsClassifier, NearestNeighbors, kneighbors_graph
 from sklearn.neighbors import LocalOutlierFactor
 
 import scipy
+from scipy.sparse import csr_matrix
 from scipy.sparse.csgraph import minimum_spanning_tree
+from scipy.spatial.distance import cdist
 import umap
 
+from suss.analysis import correlograms, refractory_counts
 from suss.core import ClusterDataset, SubDataset
+from suss.features import project
 from suss.sort import pca_time, cleanup_clusters, tsne_time, _vote_on_labels, cleanup_clusters
+from suss.sort import propagate_labels, sample_neighbors, stratified_subsample
 
 
 def get_mknn(X, n_neighbors=10):
@@ -73,16 +83,33 @@ def force_single_kwarg(**kwargs):
     return new_kwargs
 
 
+def _label_positions(dataset, labels):
+    if hasattr(dataset, "label_index"):
+        label_index = dataset.label_index
+        return [idx for label in labels for idx in label_index.get(label, [])]
+    return np.where(np.isin(dataset.labels, list(labels)))[0]
+
+
+def _node_positions(dataset, nodes):
+    if hasattr(dataset, "node_index"):
+        node_index = dataset.node_index
+        return [node_index[id(node)] for node in nodes if id(node) in node_index]
+    return [
+        idx for idx, node in enumerate(dataset.nodes)
+        if any(node is other for other in nodes)
+    ]
+
+
 def match_several(dataset, labels=None, nodes=None, idxs=None):
     force_single_kwarg(labels=labels, idxs=idxs, nodes=nodes)
     if labels is not None:
-        match = np.where(np.isin(dataset.labels, list(labels)))[0]
+        match = _label_positions(dataset, labels)
     elif nodes is not None:
-        match = np.where(np.isin(dataset.nodes, list(nodes)))[0]
+        match = _node_positions(dataset, nodes)
     elif idxs is not None:
         match = idxs
 
-    selector = np.zeros(len(dataset)).astype(np.bool)
+    selector = np.zeros(len(dataset), dtype=bool)
     selector[match] = True
     return selector
 
@@ -90,9 +117,9 @@ def match_several(dataset, labels=None, nodes=None, idxs=None):
 def match_one(dataset, label=None, node=None, idx=None):
     kw = force_single_kwarg(label=label, idx=idx, node=node)
     if label is not None:
-        match = np.where(dataset.labels == label)[0]
+        match = _label_positions(dataset, [label])
     elif node is not None:
-        match = np.where(dataset.nodes == node)[0]
+        match = _node_positions(dataset, [node])
     elif idx is not None:
         match = [idx]
 
@@ -103,7 +130,8 @@ def match_one(dataset, label=None, node=None, idx=None):
     else:
         idx = match[0]
 
-    selector = np.eye(len(dataset))[idx].astype(np.bool)
+    selector = np.zeros(len(dataset), dtype=bool)
+    selector[idx] = True
     return selector
 
 
@@ -130,65 +158,78 @@ def _merge(*nodes):
 
     return SubDataset(
         parents[0],
-        ids=np.concatenate([node.ids for node in nodes]),
+        ids=np.sort(np.concatenate([node.ids for node in nodes])),
         source_dataset=sources[0]
     )
 
 
-def add_nodes(dataset, *nodes):
-    """Add new nodes to a dataset"""
-    if not len(dataset.labels):
+def replace_nodes(dataset, selector, *nodes):
+    """Replace the selected nodes of a dataset with new nodes
+
+    The new nodes are labeled after the largest label that remains. Only
+    the new nodes get new records; all other nodes are shared with the
+    original dataset (see ClusterDataset.derive()).
+    """
+    if selector is None:
+        selector = np.zeros(len(dataset), dtype=bool)
+
+    remaining_labels = dataset.labels[np.logical_not(selector)]
+    if not len(remaining_labels):
         start_at = 0
     else:
-        start_at = np.max(dataset.labels)
+        start_at = np.max(remaining_labels)
 
     new_labels = np.arange(
         start_at + 1,
         start_at + len(nodes) + 1
     )
-    return ClusterDataset(
-        np.concatenate([dataset.nodes, nodes]),
-        data_column=dataset.data_column,
-        labels=np.concatenate([dataset.labels, new_labels])
-    )
+    return dataset.derive(remove=selector, nodes=nodes, labels=new_labels)
+
+
+def add_nodes(dataset, *nodes):
+    """Add new nodes to a dataset"""
+    return replace_nodes(dataset, None, *nodes)
 
 
 def delete_nodes(dataset, nodes=None, idxs=None, labels=None):
     selector = match_several(dataset, nodes=nodes, idxs=idxs, labels=labels)
-    return dataset.select(np.logical_not(selector), child=False)
+    return replace_nodes(dataset, selector)
 
 
 def delete_node(dataset, node=None, idx=None, label=None):
     selector = match_one(dataset, node=node, idx=idx, label=label)
-    return dataset.select(np.logical_not(selector), child=False)
+    return replace_nodes(dataset, selector)
 
 
 def merge_nodes(dataset, nodes=None, idxs=None, labels=None):
     """Merge nodes of a dataset together.
     """
     selector = match_several(dataset, labels=labels, idxs=idxs, nodes=nodes)
+    return replace_nodes(dataset, selector, _merge(*dataset.nodes[selector]))
 
-    new_dataset = dataset.select(np.logical_not(selector), child=False)
-    nodes_to_combine  = dataset.select(selector).nodes
-    return add_nodes(new_dataset, _merge(*nodes_to_combine))
 
+def _flatten_node(node):
+    """The datapoints of a single node, as in dataset.select(...).flatten(1)"""
+    return SubDataset(
+        node.source,
+        ids=node.ids,
+        labels=np.zeros(len(node.ids))
+    )
 
-def recluster_node(dataset, node=None, idx=None, label=None, n_clusters=4):
-    selector = match_one(dataset, label=label, idx=idx, node=node)
 
-    # Get the node you want to recluster and flatten it
-    selected_data = dataset.select(selector).flatten(1)
+def _recluster(selected_data, n_clusters=4, refit=False):
+    """Split flattened data into new nodes by waveform shape"""
     if len(selected_data) >= 100:
-        cluster_on = tsne_time(selected_data, pcs=6, t_scale=2 * 60 * 60.0)
+        cluster_on = tsne_time(selected_data, pcs=6, t_scale=2 * 60 * 60.0, refit=refit)
     else:
-        cluster_on = PCA(
-            n_components=min(6, len(selected_data))
-        ).fit_transform(selected_data.waveforms)
+        cluster_on = project(
+            selected_data,
+            min(6, len(selected_data)),
+            refit=refit
+        )
 
     n_clusters = min(n_clusters, len(cluster_on))
 
-    weight = np.array([node.count for node in selected_data.nodes])
-
     # kmeans = KMeans(n_clusters=n_clusters).fit(cluster_on, sample_weight=weight)
     # labels = kmeans.predict(cluster_on, sample_weight=weight)
     if len(cluster_on) < 2:
@@ -196,29 +237,213 @@ def recluster_node(dataset, node=None, idx=None, label=None, n_clusters=4):
     else:
         gmm = BayesianGaussianMixture(n_components=n_clusters).fit(cluster_on)
         labels = gmm.predict(cluster_on)
-    reclustered = selected_data.cluster(labels)
+    return selected_data.cluster(labels).nodes
+
+
+def _fast_recluster(
+        selected_data,
+        n_clusters=4,
+        max_points=2000,
+        time_budget=2.0,
+        t_scale=2 * 60 * 60.0,
+        refit=False):
+    """Split flattened data into new nodes using a subsample
+
+    The mixture is fit to at most max_points points spread over time,
+    projected onto the recording's FeatureBasis (plus scaled time), and
+    the remaining points are labeled by their nearest sampled neighbors.
+
+    The neighbor search is done before the mixture is fit, so that
+    time_budget covers the whole call: mixture iterations stop once
+    time_budget seconds have passed since the start, leaving only the
+    vote of the neighbors. At least one round of 10 iterations is run.
+    """
+    _fn_start = time.time()
+    if len(selected_data) < 2:
+        return selected_data.cluster(np.arange(len(selected_data))).nodes
+
+    pcs = min(6, len(selected_data), selected_data.data_shape[1])
+    projected = project(selected_data, pcs, refit=refit, whiten=True)
+    features = np.hstack([
+        projected,
+        ((selected_data.times - np.median(selected_data.times)) / t_scale)[:, None]
+    ])
+
+    sample_idx = stratified_subsample(selected_data, max_points)
+    sample = features[sample_idx]
+    n_clusters = min(n_clusters, len(sample))
+    neighbors = sample_neighbors(features, sample_idx)
+
+    gmm = BayesianGaussianMixture(
+        n_components=n_clusters,
+        max_iter=10,
+        warm_start=True
+    )
+    with warnings.catch_warnings():
+        # Each partial fit of 10 iterations warns that it has not converged
+        warnings.simplefilter("ignore", ConvergenceWarning)
+        while True:
+            gmm.fit(sample)
+            if gmm.converged_ or time.time() - _fn_start > time_budget:
+                break
 
-    new_dataset = dataset.select(np.logical_not(selector), child=False)
-    return add_nodes(new_dataset, *reclustered.nodes)
+    labels = propagate_labels(
+        features, sample_idx, gmm.predict(sample), neighbors=neighbors)
+    return selected_data.cluster(labels).nodes
 
 
-def cleanup_node(dataset, node=None, idx=None, label=None, n_clusters=3):
+def _cleanup(selected_data, refit=False):
+    """Split flattened data into new nodes of inliers and outliers"""
+    # proj = umap.UMAP(n_components=6).fit_transform(selected_data.waveforms)
+    if len(selected_data) > 3:
+        proj = project(selected_data, 3, refit=refit)
+        outliers = label_outliers(proj, p=0.01)
+    else:
+        outliers = np.arange(len(selected_data))
+    return selected_data.cluster(outliers).nodes
+
+
+def recluster_node(dataset, node=None, idx=None, label=None, n_clusters=4, refit=False):
     selector = match_one(dataset, label=label, idx=idx, node=node)
 
     # Get the node you want to recluster and flatten it
     selected_data = dataset.select(selector).flatten(1)
-    # proj = umap.UMAP(n_components=6).fit_transform(selected_data.waveforms)
-    if len(selected_data.waveforms) > 3:
-        proj = PCA(n_components=3).fit_transform(selected_data.waveforms)
-        outliers = label_outliers(proj, p=0.01)
-    else:
-        outliers = np.arange(len(selected_data.waveforms))
+    return replace_nodes(
+            dataset,
+            selector,
+            *_recluster(selected_data, n_clusters=n_clusters, refit=refit)
+    )
 
-    new_dataset = dataset.select(np.logical_not(selector), child=False)
-    return add_nodes(
-            new_dataset,
-            *selected_data.cluster(outliers).nodes
+
+def fast_recluster_node(
+        dataset,
+        node=None,
+        idx=None,
+        label=None,
+        n_clusters=4,
+        max_points=2000,
+        time_budget=2.0,
+        refit=False):
+    """Recluster a node quickly enough for interactive use
+
+    Unlike recluster_node, no t-SNE embedding is computed. A mixture is
+    fit on a time stratified subsample of at most max_points points in
+    the recording's PCA basis and its labels are propagated to the other
+    points by kNN, all in about time_budget seconds.
+    """
+    selector = match_one(dataset, label=label, idx=idx, node=node)
+
+    selected_data = dataset.select(selector).flatten(1)
+    return replace_nodes(
+            dataset,
+            selector,
+            *_fast_recluster(
+                selected_data,
+                n_clusters=n_clusters,
+                max_points=max_points,
+                time_budget=time_budget,
+                refit=refit
+            )
+    )
+
+
+def cleanup_node(dataset, node=None, idx=None, label=None, n_clusters=3, refit=False):
+    selector = match_one(dataset, label=label, idx=idx, node=node)
+
+    # Get the node you want to recluster and flatten it
+    selected_data = dataset.select(selector).flatten(1)
+    return replace_nodes(
+            dataset,
+            selector,
+            *_cleanup(selected_data, refit=refit)
+    )
+
+
+def apply_operations(dataset, operations, refit=False):
+    """Apply a sequence of curation operations with a single rebuild
+
+    The result is the same as calling merge_nodes, delete_nodes,
+    recluster_node and cleanup_node one after the other, but the
+    intermediate datasets are never built; nodes are tracked by label
+    and the final dataset is derived from the original one in one step.
+
+    Args
+        dataset: ClusterDataset with unique labels
+        operations: List of (name, kwargs) tuples, applied in order.
+            The supported operations are
+            ("merge", dict(labels=[...])),
+            ("delete", dict(labels=[...])),
+            ("recluster", dict(label=..., n_clusters=4)),
+            ("fast_recluster", dict(label=..., max_points=2000, time_budget=2.0)),
+            ("cleanup", dict(label=...))
+        refit: Refit local PCAs when reclustering (see features.project)
+
+    Returns
+        The new ClusterDataset and the set of labels whose nodes were
+        added or removed
+    """
+    if len(dataset.label_index) != len(dataset):
+        raise ValueError("apply_operations requires a dataset with unique labels")
+
+    # Merged nodes are kept as lists of the nodes they combine and only
+    # built once they are final, so chains of merges copy the data once
+    current = dict(dataset.labeled_nodes)
+    removed = set()
+    added = {}
+
+    def _build(node):
+        return _merge(*node) if isinstance(node, list) else node
+
+    def _pop(label):
+        if label in added:
+            added.pop(label)
+        else:
+            removed.add(label)
+        return current.pop(label)
+
+    def _add(*nodes):
+        start_at = max(current) if current else 0
+        for label, node in enumerate(nodes, start_at + 1):
+            current[label] = node
+            added[label] = node
+
+    def _get_one(label):
+        if label not in current:
+            raise ValueError("No node matched {}".format(dict(label=label)))
+        return _pop(label)
+
+    for name, kwargs in operations:
+        kwargs = dict(kwargs)
+        if name == "merge":
+            nodes = [_pop(label) for label in kwargs["labels"] if label in current]
+            if not len(nodes):
+                raise ValueError("No nodes matched {}".format(kwargs))
+            parts = []
+            for node in nodes:
+                parts.extend(node if isinstance(node, list) else [node])
+            _add(parts)
+        elif name == "delete":
+            for label in kwargs["labels"]:
+                if label in current:
+                    _pop(label)
+        elif name == "recluster":
+            node = _build(_get_one(kwargs.pop("label")))
+            _add(*_recluster(_flatten_node(node), refit=refit, **kwargs))
+        elif name == "fast_recluster":
+            node = _build(_get_one(kwargs.pop("label")))
+            _add(*_fast_recluster(_flatten_node(node), refit=refit, **kwargs))
+        elif name == "cleanup":
+            node = _build(_get_one(kwargs.pop("label")))
+            _add(*_cleanup(_flatten_node(node), refit=refit))
+        else:
+            raise ValueError("Unknown operation {}".format(name))
+
+    new_dataset = dataset.derive(
+        remove=np.isin(dataset.labels, list(removed)),
+        nodes=[_build(node) for node in added.values()],
+        labels=list(added.keys())
     )
+    return new_dataset, removed.union(added)
 
 
 def recluster_node_in_time(dataset, node=None, idx=None, label=None, n_clusters=3):
@@ -238,8 +463,6 @@ def recluster_node_in_time(dataset, node=None, idx=None, label=None, n_clusters=
 
     n_clusters = min(n_clusters, len(cluster_on))
 
-    new_dataset = dataset.select(np.logical_not(selector), child=False)
-
     if len(cluster_on):
         kmeans = KMeans(n_clusters=n_clusters).fit(cluster_on, sample_weight=weight)
         labels = kmeans.predict(cluster_on, sample_weight=weight)
@@ -248,18 +471,291 @@ def recluster_node_in_time(dataset, node=None, idx=None, label=None, n_clusters=
         reclustered = selected_data.cluster(np.array([]))
 
     if len(outlier_data) and len(reclustered):
-        return add_nodes(new_dataset, outlier_data, *reclustered.nodes)
+        return replace_nodes(dataset, selector, outlier_data, *reclustered.nodes)
     else:
-        return add_nodes(new_dataset, *reclustered.nodes)
+        return replace_nodes(dataset, selector, *reclustered.nodes)
+
 
+class CleanupCache(object):
+    """Projection and neighbor graph reused by cleanup_cluster_assignments
 
-def cleanup_cluster_assignments(dataset, n_neighbors=3):
+    Holds the pca_time projection of the flattened datapoints, the
+    n_neighbors nearest neighbors of every point in it, the labels the
+    last cleanup returned and the points it would have re-evaluated in
+    another pass. Only those points, and the points near a label that
+    changed since then, can change label, so only those are re-evaluated.
+
+    The cache is rebuilt when the dataset has datapoints it has not seen.
+    Datapoints that were removed (e.g. by deleting a cluster) are left
+    out of the votes of their neighbors rather than triggering a rebuild.
+    """
+
+    def __init__(self):
+        self.source = None
+        self.ids = None
+        self.labels = None
+
+    def _is_valid(self, flat, n_neighbors, refit):
+        if self.ids is None or (self.n_neighbors, self.refit) != (n_neighbors, refit):
+            return False
+        if self.source is None or self.source() is not flat.source:
+            return False
+        positions = np.searchsorted(self.ids, flat.ids).clip(max=len(self.ids) - 1)
+        return np.all(self.ids[positions] == flat.ids)
+
+    def prepare(self, flat, n_neighbors=3, refit=False):
+        """Build the projection and neighbor graph of flat if needed
+
+        Returns
+            Positions of the datapoints of flat in the cache
+        """
+        if not self._is_valid(flat, n_neighbors, refit):
+            projection = pca_time(flat, pcs=6, t_scale=1 * 60 * 60.0, refit=refit)
+            k = n_neighbors if len(flat) > n_neighbors else 2
+            k = min(k, len(flat))
+            _, neighbors = NearestNeighbors(n_neighbors=k).fit(projection).kneighbors(projection)
+
+            self.source = weakref.ref(flat.source)
+            self.ids = flat.ids.copy()
+            self.n_neighbors = n_neighbors
+            self.refit = refit
+            self.neighbors = neighbors
+            # Row j lists the points that have j as a neighbor
+            self.reverse = csr_matrix(
+                (
+                    np.ones(neighbors.size, dtype=bool),
+                    (neighbors.ravel(), np.repeat(np.arange(len(neighbors)), k))
+                ),
+                shape=(len(neighbors), len(neighbors))
+            )
+            self.labels = None
+            self.pending = None
+
+        return np.searchsorted(self.ids, flat.ids)
+
+    def _affected(self, changed):
+        return np.unique(np.concatenate([changed, self.reverse[changed].indices]))
+
+    def _vote(self, labels, points):
+        """Majority label of the neighbors of points, ignoring removed points
+
+        Ties go to the smallest label, as in KNeighborsClassifier
+        """
+        classes, encoded = np.unique(labels, return_inverse=True)
+        votes = encoded[self.neighbors[points]]
+        counts = np.bincount(
+            (np.arange(len(points))[:, None] * len(classes) + votes).ravel(),
+            minlength=len(points) * len(classes)
+        ).reshape(len(points), len(classes))
+        if classes[0] == -1:
+            counts[:, 0] = 0
+        return classes[np.argmax(counts, axis=1)]
+
+    def cleanup(self, positions, labels, max_passes=1):
+        """Relabel points by the majority label of their neighbors
+
+        Args
+            positions: Positions of the labeled points in the cache
+            labels: Current label of each point
+            max_passes: Repeat until no label changes or this many passes
+
+        Returns
+            The new label of each point
+        """
+        current = -np.ones(len(self.ids), dtype=np.int64)
+        current[positions] = labels
+        if self.labels is None:
+            # Only points with a differently labeled neighbor can flip
+            candidates = np.where(np.any(
+                current[self.neighbors] != current[:, None],
+                axis=1
+            ))[0]
+        else:
+            candidates = np.union1d(
+                self._affected(np.where(current != self.labels)[0]),
+                self.pending
+            )
+
+        for _ in range(max_passes):
+            candidates = candidates[current[candidates] != -1]
+            if not len(candidates):
+                break
+            new_labels = self._vote(current, candidates)
+            flipped = new_labels != current[candidates]
+            current[candidates[flipped]] = new_labels[flipped]
+            candidates = self._affected(candidates[flipped])
+
+        self.labels = current
+        self.pending = candidates
+        return current[positions]
+
+
+def _flat_node_positions(dataset, flat_labels):
+    """Position in dataset of the node each label of dataset.flatten(1) names
+
+    flatten() labels points with their node's label when the labels are
+    unique and with the node's position otherwise
+    """
+    flat_labels = np.asarray(flat_labels)
+    if len(dataset.label_index) != len(dataset):
+        return flat_labels.astype(int)
+    unique_labels, inverse = np.unique(flat_labels, return_inverse=True)
+    positions = np.array(
+        [dataset.label_index[label][0] for label in unique_labels.tolist()],
+        dtype=int
+    )
+    return positions[inverse]
+
+
+def cleanup_cluster_assignments(dataset, n_neighbors=3, refit=False, cache=None, max_passes=1):
+    """Relabel datapoints by the labels of their nearest neighbors
+
+    Only the clusters that gained or lost points are replaced (by
+    clusters of the relabeled points of dataset.flatten(1)); the other
+    clusters are shared with dataset.
+
+    Args
+        dataset: ClusterDataset
+        n_neighbors: Number of neighbors (including the point itself)
+            that vote on the label of each point
+        refit: Refit local PCAs when projecting (see features.project)
+        cache: A CleanupCache. If provided, its projection and neighbor
+            graph are reused and only points near a label change are
+            re-evaluated.
+        max_passes: With a cache, repeat the cleanup until no point
+            changes label or max_passes passes were made
+    """
     flat = dataset.flatten(1)
-    projection = pca_time(flat, pcs=6, t_scale=1 * 60 * 60.0)
-    new_labels = cleanup_clusters(projection, flat.labels, n_neighbors=n_neighbors)
-    return flat.cluster(new_labels)
+    if cache is None:
+        projection = pca_time(flat, pcs=6, t_scale=1 * 60 * 60.0, refit=refit)
+        new_labels = cleanup_clusters(projection, flat.labels, n_neighbors=n_neighbors)
+    else:
+        positions = cache.prepare(flat, n_neighbors=n_neighbors, refit=refit)
+        new_labels = cache.cleanup(positions, flat.labels, max_passes=max_passes)
+
+    old_nodes = _flat_node_positions(dataset, flat.labels)
+    new_nodes = _flat_node_positions(dataset, new_labels)
+    flipped = new_nodes != old_nodes
+    changed = np.unique(np.concatenate([old_nodes[flipped], new_nodes[flipped]]))
+    remaining = [idx for idx in changed if np.any(new_nodes == idx)]
+    return dataset.derive(
+        remove=np.isin(np.arange(len(dataset)), changed),
+        nodes=[flat.select(new_nodes == idx) for idx in remaining],
+        labels=dataset.labels[remaining]
+    )
+
+
+# Per-node statistics used by suggest_merges(), kept for as long as the
+# node exists. Nodes are shared between edits of a dataset (see
+# ClusterDataset.derive()), so only new nodes need their stats computed.
+_node_stats = weakref.WeakKeyDictionary()
+
+
+def _get_node_stats(node, bin_size):
+    stats = _node_stats.get(node)
+    if stats is None or stats["bin_size"] != bin_size:
+        flat = node.flatten()
+        data = getattr(flat, flat.data_column)
+        centroid = np.mean(data, axis=0)
+        stats = dict(
+            bin_size=bin_size,
+            centroid=centroid,
+            spread=np.sqrt(np.mean((data - centroid) ** 2)),
+            counts=np.bincount((flat.times // bin_size).astype(int))
+        )
+        _node_stats[node] = stats
+    return stats
+
+
+def suggest_merges(
+        dataset,
+        n_candidates=20,
+        refractory_period=0.001,
+        bin_size=60.0,
+        max_distance=None):
+    """Rank pairs of clusters of a dataset as candidates for merging
+
+    Every pair of clusters is scored on
+        template_distance: Distance between the cluster means, relative to
+            the rms spread of the clusters around their means
+        refractory_ratio: Number of spikes of the two clusters closer than
+            refractory_period, relative to the number expected if the two
+            fired independently (NaN if fewer than one is expected). Near 0
+            when the clusters respect a shared refractory period.
+        temporal_overlap: Cosine similarity of the clusters' spike counts
+            over time bins of bin_size seconds
+
+    Pairs are ranked by
+        template_distance * (1 + refractory_ratio) * (2 - temporal_overlap)
+    where a NaN ratio counts as 0, so that of two otherwise equal pairs the
+    one that never fires at the same time ranks lower.
+
+    Args
+        dataset: ClusterDataset
+        n_candidates: Number of pairs to return (all if None)
+        refractory_period: Refractory period in seconds
+        bin_size: Size of time bins, in seconds, used to estimate firing
+            rates over time
+        max_distance: Leave out pairs with larger template distance
+
+    Returns
+        Structured array of candidate pairs ordered from best to worst,
+        with fields label_a, label_b, score, template_distance,
+        refractory_ratio and temporal_overlap
+    """
+    result_dtype = [
+        ("label_a", "int32"),
+        ("label_b", "int32"),
+        ("score", "float64"),
+        ("template_distance", "float64"),
+        ("refractory_ratio", "float64"),
+        ("temporal_overlap", "float64"),
+    ]
+    n_clusters = len(dataset)
+    if n_clusters < 2:
+        return np.zeros(0, dtype=result_dtype)
+
+    stats = [_get_node_stats(node, bin_size) for node in dataset.nodes]
+
+    centroids = np.array([s["centroid"] for s in stats])
+    spread = np.array([s["spread"] for s in stats])
+    distance = cdist(centroids, centroids) / np.sqrt(
+        (spread[:, None] ** 2 + spread[None, :] ** 2) / 2
+    ).clip(min=1e-12)
+
+    n_bins = max(len(s["counts"]) for s in stats)
+    counts = np.zeros((n_clusters, n_bins))
+    for i, s in enumerate(stats):
+        counts[i, :len(s["counts"])] = s["counts"]
+    norms = np.linalg.norm(counts, axis=1).clip(min=1e-12)
+    overlap = np.dot(counts, counts.T) / np.outer(norms, norms)
+
+    # Under independence, the expected number of coincidences within the
+    # window is the product of the rates in each bin times the window size
+    expected = np.dot(counts, counts.T) * (2 * refractory_period) / bin_size
+    observed = refractory_counts(
+        *correlograms(dataset, window=refractory_period, bin_size=refractory_period),
+        refractory_period=refractory_period)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ratio = np.where(expected >= 1, observed / expected, np.nan)
+
+    a, b = np.triu_indices(n_clusters, k=1)
+    score = distance[a, b] * (1 + np.nan_to_num(ratio[a, b])) * (2 - overlap[a, b])
+
+    result = np.zeros(len(a), dtype=result_dtype)
+    result["label_a"] = dataset.labels[a]
+    result["label_b"] = dataset.labels[b]
+    result["score"] = score
+    result["template_distance"] = distance[a, b]
+    result["refractory_ratio"] = ratio[a, b]
+    result["temporal_overlap"] = overlap[a, b]
+
+    if max_distance is not None:
+        result = result[result["template_distance"] <= max_distance]
+
+    result = result[np.argsort(result["score"], kind="mergesort")]
+    return result[:n_candidates]
 
-    
 
 '''
     def split_node(
@@ -288,7 +784,7 @@ def cleanup_cluster_assignments(dataset, n_neighbors=3):
         else:
             idx = match[0]
 
-        selector = np.eye(len(self))[idx].astype(np.bool)
+        selector = np.eye(len(self))[idx].astype(bool)
         in_range, out_range = self.nodes[idx].time_split(t_start, t_stop)
         new_dataset = self.select(np.logical_not(selector), child=False)
 
@@ -0,0 +1,146 @@
+"""Preprocessing of spike waveforms before sorting
+
+Detection jitter moves the peak of a spike's waveform by a fraction of a
+sample or more, which spreads each cluster along its first derivative
+and can flip the sign of the sample the sorting splits on. Here all
+waveforms are realigned so their extremum falls exactly on the center
+sample: the extremum is located with sub-sample precision (parabolic
+interpolation around the largest sample) and each waveform is resampled
+with cubic convolution at the shifted sample positions. Everything is
+computed on whole chunks of the waveform matrix at once.
+"""
+
+import numpy as np
+
+from suss.core import SpikeDataset
+
+
+def _cubic_weights(frac):
+    """Keys cubic convolution weights (a = -0.5) of the 4 nearest samples"""
+    a = -0.5
+    x = np.stack([1 + frac, frac, 1 - frac, 2 - frac])
+    near = x <= 1
+    return np.where(
+        near,
+        (a + 2) * x ** 3 - (a + 3) * x ** 2 + 1,
+        a * x ** 3 - 5 * a * x ** 2 + 8 * a * x - 4 * a
+    )
+
+
+def shift_waveforms(waveforms, shifts):
+    """Resample waveforms at positions shifted by a (fractional) number of samples
+
+    The value at sample i of the result is the value of the waveform at
+    i + shift, interpolated with cubic convolution. Samples beyond the
+    ends of a waveform take the value of its first or last sample.
+
+    Args
+        waveforms: (n_spikes, n_samples) array
+        shifts: Array of n_spikes shifts in samples
+    """
+    n_spikes, n_samples = waveforms.shape
+    # The fractional part of the shift, and so the weights, are the same
+    # for every sample of a waveform
+    whole = np.floor(shifts)
+    weights = _cubic_weights(shifts - whole)
+    base = np.arange(n_samples)[None, :] + whole.astype(int)[:, None]
+
+    rows = n_samples * np.arange(n_spikes)[:, None]
+    flat = waveforms.ravel()
+    result = np.zeros(waveforms.shape)
+    for k, offset in enumerate(range(-1, 3)):
+        idx = np.clip(base + offset, 0, n_samples - 1)
+        result += weights[k][:, None] * flat[rows + idx]
+    return result
+
+
+def find_extrema(waveforms, center, max_shift, sign="auto"):
+    """Sub-sample position of the extremum of each waveform near center
+
+    Args
+        waveforms: (n_spikes, n_samples) array
+        center: Sample the peaks are expected at
+        max_shift: Largest distance (in samples) of a peak from center
+        sign: "neg" or "pos" to find minima or maxima, or "auto" to use
+            whichever is larger in magnitude for each waveform
+
+    Returns
+        Array of fractional peak positions
+    """
+    lo = max(1, center - max_shift)
+    hi = min(waveforms.shape[1] - 1, center + max_shift + 1)
+    window = waveforms[:, lo:hi]
+
+    if sign == "neg":
+        signs = -np.ones(len(waveforms))
+    elif sign == "pos":
+        signs = np.ones(len(waveforms))
+    elif sign == "auto":
+        signs = np.where(np.max(window, axis=1) >= -np.min(window, axis=1), 1.0, -1.0)
+    else:
+        raise ValueError("sign must be one of neg, pos or auto")
+
+    peaks = lo + np.argmax(window * signs[:, None], axis=1)
+    rows = np.arange(len(waveforms))
+    before, at, after = (
+        signs * waveforms[rows, peaks - 1],
+        signs * waveforms[rows, peaks],
+        signs * waveforms[rows, peaks + 1]
+    )
+    curvature = before - 2 * at + after
+    with np.errstate(invalid="ignore", divide="ignore"):
+        offset = np.where(curvature < 0, 0.5 * (before - after) / curvature, 0.0)
+    return peaks + np.clip(offset, -0.5, 0.5)
+
+
+def realign_waveforms(waveforms, center=None, max_shift=3, sign="auto", chunk_size=10000):
+    """Realign waveforms so that their extremum is on the center sample
+
+    Args
+        waveforms: (n_spikes, n_samples) array
+        center: Sample to align peaks to (defaults to the middle sample)
+        max_shift: Largest distance (in samples) a peak is searched
+            (and moved) from center
+        sign: See find_extrema()
+        chunk_size: Number of waveforms processed at once
+
+    Returns
+        Realigned waveforms and the shift (in samples) of each waveform
+    """
+    if center is None:
+        center = waveforms.shape[1] // 2
+
+    aligned = np.empty(waveforms.shape)
+    shifts = np.empty(len(waveforms))
+    for start in range(0, len(waveforms), chunk_size):
+        chunk = np.asarray(waveforms[start:start + chunk_size], dtype=float)
+        chunk_shifts = find_extrema(chunk, center, max_shift, sign=sign) - center
+        aligned[start:start + chunk_size] = shift_waveforms(chunk, chunk_shifts)
+        shifts[start:start + chunk_size] = chunk_shifts
+
+    return aligned, shifts
+
+
+def realign(dataset, **kwargs):
+    """A SpikeDataset with the waveforms of dataset realigned
+
+    Spike times are left unchanged so that spikes keep their order (and
+    ids), and times and waveforms are stored as in dataset. The result
+    keeps the FeatureBasis of dataset's recording, if it has one.
+
+    Args
+        dataset: A SpikeDataset
+        **kwargs: Passed to realign_waveforms()
+    """
+    aligned, _ = realign_waveforms(dataset.waveforms, **kwargs)
+    storage = getattr(dataset.recording, "storage", None)
+    sample_times = dataset.has_sample_times
+    realigned = SpikeDataset(
+        times=dataset.samples if sample_times else dataset.times,
+        waveforms=aligned,
+        sample_rate=getattr(dataset.recording, "sample_rate", None),
+        labels=dataset.labels,
+        storage="float64" if storage is None else storage.name,
+        sample_times=sample_times)
+    realigned.feature_basis = dataset.feature_basis
+    return realigned
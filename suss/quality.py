@@ -0,0 +1,224 @@
+"""Quality metrics of all clusters of a sort in a shared feature space
+
+All clusters are scored against each other in the same projection of
+their waveforms (the recording's FeatureBasis, see features.project),
+computed once on a time stratified subsample of the flattened dataset.
+The metrics are returned as a table with one row per cluster label.
+
+    isolation_distance: Squared Mahalanobis distance from a cluster to the
+        n-th closest spike outside it, where n is the cluster size
+        (Harris et al. 2001). Larger is better; nan if the cluster has
+        more spikes than there are spikes outside of it.
+    l_ratio: Sum over spikes outside the cluster of their chi-squared
+        probability of belonging to it, divided by the cluster size
+        (Schmitzer-Torbert et al. 2005). Smaller is better.
+    knn_purity: Fraction of the nearest neighbors of a cluster's spikes
+        that are in the same cluster (estimated on a random subset of them)
+    silhouette: Mean silhouette score of the cluster's spikes in a smaller
+        random subsample
+"""
+
+import numpy as np
+import scipy.linalg
+import scipy.stats
+from sklearn.metrics import silhouette_samples
+from sklearn.neighbors import NearestNeighbors
+
+from .features import project
+from .sort import stratified_subsample
+
+
+QUALITY_DTYPE = [
+    ("label", int),
+    ("count", int),
+    ("isolation_distance", float),
+    ("l_ratio", float),
+    ("knn_purity", float),
+    ("silhouette", float)
+]
+
+
+def mahalanobis_distances(features, cluster_features):
+    """Squared Mahalanobis distance of all points to a cluster
+
+    The cluster covariance is factored once and all points are whitened
+    with a single triangular solve.
+
+    Args
+        features: (n_points, n_features) array of all points
+        cluster_features: (n_cluster_points, n_features) array
+
+    Returns
+        Array of n_points squared distances, or None if the cluster
+        covariance is singular (e.g. fewer points than features)
+    """
+    mean = np.mean(cluster_features, axis=0)
+    cov = np.cov(cluster_features, rowvar=False)
+    try:
+        chol = scipy.linalg.cholesky(np.atleast_2d(cov), lower=True)
+    except scipy.linalg.LinAlgError:
+        return None
+
+    whitened = scipy.linalg.solve_triangular(
+        chol, (features - mean).T, lower=True, check_finite=False)
+    return np.sum(whitened ** 2, axis=0)
+
+
+def knn_purity(
+        features,
+        cluster_idx,
+        n_clusters,
+        n_neighbors=10,
+        n_queries=20000,
+        include=None):
+    """Mean fraction of same-cluster neighbors of each cluster's points
+
+    The index is built on all points once; the neighbors of at most
+    n_queries randomly chosen points are looked up.
+
+    Args
+        features: (n_points, n_features) array
+        cluster_idx: Cluster index (0 to n_clusters - 1) of each point
+        n_clusters: Number of clusters
+        n_neighbors: Neighbors considered per point (excluding itself)
+        n_queries: Number of points whose neighbors are looked up
+        include: Optional boolean array over clusters; only points of
+            included clusters are looked up, the others get nan
+    """
+    n_neighbors = min(n_neighbors, len(features) - 1)
+    if n_neighbors < 1:
+        return np.full(n_clusters, np.nan)
+
+    queries = np.arange(len(features))
+    if include is not None:
+        queries = queries[include[cluster_idx]]
+    if len(queries) > n_queries:
+        queries = np.random.choice(queries, size=n_queries, replace=False)
+
+    _, indices = NearestNeighbors(
+        n_neighbors=n_neighbors + 1
+    ).fit(features).kneighbors(features[queries])
+    query_idx = cluster_idx[queries]
+    # Drop each query point itself (or an exact duplicate of it)
+    same = np.mean(cluster_idx[indices[:, 1:]] == query_idx[:, None], axis=1)
+
+    counts = np.bincount(query_idx, minlength=n_clusters)
+    sums = np.bincount(query_idx, weights=same, minlength=n_clusters)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return sums / counts
+
+
+def sampled_silhouette(features, cluster_idx, n_clusters, n=5000):
+    """Mean silhouette score of each cluster on a random subsample
+
+    Clusters with no points in the subsample get nan.
+    """
+    if len(features) > n:
+        sample = np.random.choice(len(features), size=n, replace=False)
+        features = features[sample]
+        cluster_idx = cluster_idx[sample]
+
+    if len(np.unique(cluster_idx)) < 2:
+        return np.full(n_clusters, np.nan)
+
+    scores = silhouette_samples(features, cluster_idx)
+    counts = np.bincount(cluster_idx, minlength=n_clusters)
+    sums = np.bincount(cluster_idx, weights=scores, minlength=n_clusters)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return sums / counts
+
+
+def cluster_quality_table(
+        dataset,
+        n_components=8,
+        n_neighbors=10,
+        max_points=100000,
+        knn_points=20000,
+        silhouette_points=5000,
+        basis=None,
+        refit=False,
+        labels=None):
+    """Compute quality metrics of every cluster of a dataset
+
+    Args
+        dataset: ClusterDataset whose nodes are the clusters to score
+        n_components: Dimensions of the shared feature space
+        n_neighbors: Neighbors per point for the kNN purity
+        max_points: Points (stratified over time) used for the
+            Mahalanobis metrics and kNN purity index
+        knn_points: Points of the subsample whose neighbors are looked up
+        silhouette_points: Points used for the silhouette scores
+        basis: FeatureBasis to project with (defaults to the recording's)
+        refit: Fit a PCA to the subsample instead of using the basis
+        labels: Only compute the Mahalanobis metrics and kNN purity of
+            these labels (the other rows get nan). The clusters are still
+            scored against all others.
+
+    Returns
+        Structured array (see QUALITY_DTYPE) with one row per label,
+        sorted by label. Counts are of the full dataset, the metrics are
+        computed on the subsample.
+    """
+    if not len(dataset):
+        return np.zeros(0, dtype=QUALITY_DTYPE)
+
+    flat = dataset.flatten()
+    all_labels = flat.labels.astype(int)
+    unique_labels, counts = np.unique(all_labels, return_counts=True)
+    table = np.zeros(len(unique_labels), dtype=QUALITY_DTYPE)
+    table["label"] = unique_labels
+    table["count"] = counts
+
+    sample_idx = stratified_subsample(flat, max_points)
+    sample = flat.select(sample_idx)
+    cluster_idx = np.searchsorted(unique_labels, all_labels[sample_idx])
+    n_components = min(n_components, *sample.data_shape)
+    features = project(sample, n_components, basis=basis, refit=refit)
+    n_features = features.shape[1]
+
+    include = None
+    scored = np.arange(len(unique_labels))
+    if labels is not None:
+        include = np.isin(unique_labels, labels)
+        scored = np.where(include)[0]
+        table["isolation_distance"] = np.nan
+        table["l_ratio"] = np.nan
+
+    for i in scored:
+        in_cluster = cluster_idx == i
+        n_cluster = np.sum(in_cluster)
+        outside = np.logical_not(in_cluster)
+        n_outside = np.sum(outside)
+        distances = None
+        if n_cluster > n_features:
+            distances = mahalanobis_distances(features, features[in_cluster])
+
+        if distances is None or n_outside == 0:
+            table["isolation_distance"][i] = np.nan
+            table["l_ratio"][i] = np.nan
+            continue
+
+        outside_distances = distances[outside]
+        if n_cluster <= n_outside:
+            table["isolation_distance"][i] = np.partition(
+                outside_distances, n_cluster - 1)[n_cluster - 1]
+        else:
+            table["isolation_distance"][i] = np.nan
+        table["l_ratio"][i] = np.sum(
+            scipy.stats.chi2.sf(outside_distances, n_features)) / n_cluster
+
+    table["knn_purity"] = knn_purity(
+        features, cluster_idx, len(unique_labels),
+        n_neighbors=n_neighbors, n_queries=knn_points, include=include)
+    table["silhouette"] = sampled_silhouette(
+        features, cluster_idx, len(unique_labels), n=silhouette_points)
+
+    return table
+
+
+def quality_row(table, label):
+    """Row of a quality table for a cluster label, or None if missing"""
+    idx = np.searchsorted(table["label"], label)
+    if idx < len(table) and table["label"][idx] == label:
+        return table[idx]
+    return None
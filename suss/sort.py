@@ -9,6 +9,7 @@ from scipy.sparse import csr_matrix
 from scipy.sparse.csgraph import minimum_spanning_tree
 from sklearn.cluster import MiniBatchKMeans as KMeans
 from sklearn.decomposition import PCA
+from sklearn.metrics import adjusted_rand_score
 from sklearn.neighbors import KNeighborsClassifier, NearestNeighbors, kneighbors_graph
 from sklearn.mixture import BayesianGaussianMixture
 
@@ -17,7 +18,9 @@ try:
 except ImportError:
     from sklearn.manifold import TSNE
 
+from .analysis import isi_violations
 from .core import SpikeDataset
+from .features import project
 
 
 def threshold_graph(g, threshold):
@@ -437,8 +440,7 @@ def denoising_sort(times, waveforms):
 
 
 def isi(node):
-    dt = np.diff(node.flatten().times)
-    return np.sum(dt < 0.001) / len(dt)
+    return isi_violations(node)
 
 
 def cluster_quality(data, labels, n_neighbors=20):
@@ -448,41 +450,31 @@ def cluster_quality(data, labels, n_neighbors=20):
     ).fit(data)
 
     _, indices = neighbors.kneighbors(data)
+    unique_labels, label_idx, cluster_sizes = np.unique(
+        labels, return_inverse=True, return_counts=True)
+
+    # Only the first min(n_neighbors, cluster_size) - 1 neighbors count
+    take_n = np.minimum(n_neighbors, cluster_sizes)[label_idx]
+    considered = np.arange(1, n_neighbors)[None, :] < take_n[:, None]
+    same_label = labels[indices[:, 1:]] == labels[:, None]
+    has_bad_neighbor = np.any(same_label & considered, axis=1)
+    isolation = np.bincount(
+        label_idx,
+        weights=has_bad_neighbor,
+        minlength=len(unique_labels)
+    ) / cluster_sizes
+
     quality = {}
-    for label in np.unique(labels):
-        cluster_size = len(np.where(labels == label)[0])
-        take_n = min(n_neighbors, cluster_size)
-        neighbor_idx = indices[labels == label, 1:take_n]
-        has_bad_neighbor = np.any(labels[neighbor_idx] == label, axis=1)
+    for label, cluster_size, cluster_isolation in zip(
+            unique_labels, cluster_sizes, isolation):
         quality[label] = {
             "count": cluster_size,
-            "isolation": np.mean(has_bad_neighbor)
+            "isolation": cluster_isolation
         }
 
     return quality
 
 
-def point_quality(data, labels, n_neighbors=3):
-    badness = np.zeros(len(labels))
-    for label in np.unique(labels):
-        cluster_size = len(np.where(labels == label)[0])
-        if cluster_size == 1:
-            continue
-
-        take_n = min(n_neighbors, cluster_size)
-        neighbors = NearestNeighbors(
-            n_neighbors=take_n,
-            algorithm="ball_tree"
-        ).fit(data[labels == label])
-
-        dist, indices = neighbors.kneighbors(data[labels == label])
-        dists = dist[:, 1:take_n]
-
-        badness[labels == label] = np.mean(dists, axis=1)
-
-    return scipy.stats.zscore(badness)
-
-
 def get_flippable_points(data, labels, n_neighbors=10):
     neighbors = NearestNeighbors(
         n_neighbors=n_neighbors,
@@ -490,10 +482,7 @@ def get_flippable_points(data, labels, n_neighbors=10):
     ).fit(data)
 
     _, indices = neighbors.kneighbors(data)
-    return np.array([
-        np.mean(labels[indices[idx, 1:]] != label) > 0.5
-        for idx, label in enumerate(labels)
-    ])
+    return np.mean(labels[indices[:, 1:]] != labels[:, None], axis=1) > 0.5
 
 
 def cleanup_clusters(data, labels, n_neighbors=20):
@@ -505,6 +494,190 @@ def cleanup_clusters(data, labels, n_neighbors=20):
     return labels
 
 
+def stratified_subsample(dataset, n, n_strata=100):
+    """Choose n indexes of a dataset spread evenly over time
+
+    Datasets are kept sorted by time, so the dataset is split into
+    n_strata contiguous blocks and each block contributes points in
+    proportion to its size. This keeps slow drifts in waveform shape
+    represented in the subsample.
+
+    Args
+        dataset: An instance of core.BaseDataset
+        n: Number of points to choose
+        n_strata: Number of time blocks to sample from
+
+    Returns
+        Sorted integer array of (at most n) indexes into dataset
+    """
+    n_points = len(dataset)
+    if n >= n_points:
+        return np.arange(n_points)
+
+    n_strata = max(1, min(n_strata, n))
+    blocks = np.array_split(np.arange(n_points), n_strata)
+    block_sizes = np.array([len(block) for block in blocks])
+    quota = (n * block_sizes) // n_points
+    remainder = n - np.sum(quota)
+    quota[np.random.choice(len(blocks), size=remainder, replace=False)] += 1
+
+    return np.sort(np.concatenate([
+        np.random.choice(block, size=count, replace=False)
+        for block, count in zip(blocks, quota)
+    ]))
+
+
+def propagation_features(dataset, fit_idx, pcs=6, t_scale=2 * 60 * 60):
+    """Cheap waveform + time features for label propagation
+
+    The PCA is fit only on the points at fit_idx but every point of
+    the dataset is projected, so a classifier trained on the subsample
+    can be applied to the rest.
+    """
+    pcs = min(pcs, len(fit_idx), dataset.data_shape[1])
+    pca = PCA(n_components=pcs).fit(dataset.select(fit_idx).waveforms)
+    projected = np.concatenate(
+        [pca.transform(chunk) for chunk in dataset.iter_chunks()] or [np.zeros((0, pcs))])
+
+    mean = np.mean(projected[fit_idx], axis=0)
+    std = np.std(projected[fit_idx], axis=0)
+    std[std == 0] = 1.0
+    t_arr = (dataset.times - np.mean(dataset.times[fit_idx])) / t_scale
+
+    return np.hstack([(projected - mean) / std, t_arr[:, None]])
+
+
+def sample_neighbors(features, sample_idx, n_neighbors=10):
+    """Nearest subsample points of each point outside a subsample
+
+    Returns
+        rest: Boolean mask of the points outside the subsample
+        neighbors: Array of shape (rest.sum(), n_neighbors), positions in
+            sample_idx of the nearest subsample points to each of them
+    """
+    rest = np.ones(len(features), dtype=bool)
+    rest[sample_idx] = False
+    if not np.any(rest):
+        return rest, np.zeros((0, 0), dtype=int)
+    _, neighbors = NearestNeighbors(
+        n_neighbors=min(n_neighbors, len(sample_idx))
+    ).fit(features[sample_idx]).kneighbors(features[rest])
+    return rest, neighbors
+
+
+def propagate_labels(features, sample_idx, sample_labels, n_neighbors=10, neighbors=None):
+    """Assign labels to all points from the labels of a subsample
+
+    Points in the subsample keep their labels, the remaining points
+    are labeled by a kNN classifier trained on the subsample. The
+    neighbor search can be done ahead of time with sample_neighbors()
+    and passed as neighbors.
+    """
+    sample_labels = np.asarray(sample_labels)
+    labels = np.empty(len(features), dtype=sample_labels.dtype)
+    labels[sample_idx] = sample_labels
+
+    if neighbors is None:
+        neighbors = sample_neighbors(features, sample_idx, n_neighbors=n_neighbors)
+    rest, neighbors = neighbors
+    if np.any(rest):
+        # Majority vote of the neighbors (ties go to the smallest label, as
+        # in KNeighborsClassifier), counted with one bincount for all points
+        classes, encoded = np.unique(sample_labels, return_inverse=True)
+        votes = encoded[neighbors]
+        counts = np.bincount(
+            (np.arange(len(votes))[:, None] * len(classes) + votes).ravel(),
+            minlength=len(votes) * len(classes)
+        ).reshape(len(votes), len(classes))
+        labels[rest] = classes[np.argmax(counts, axis=1)]
+
+    return labels
+
+
+def subsample_agreement(dataset, labels, cluster_fn, validation_size, exclude=None):
+    """Compare propagated labels with a full clustering of a validation split
+
+    Runs cluster_fn directly on a time stratified validation split of
+    the dataset (excluding the indexes in exclude, typically the points
+    the propagated labels were learned from) and scores its agreement
+    with labels on the same points.
+
+    Returns
+        Adjusted rand index between the two labelings of the split
+    """
+    candidates = np.arange(len(dataset))
+    if exclude is not None:
+        candidates = np.setdiff1d(candidates, exclude)
+    validation_idx = candidates[
+        stratified_subsample(dataset.select(candidates), validation_size)
+    ]
+    full_labels = cluster_fn(dataset.select(validation_idx))
+
+    return adjusted_rand_score(full_labels, labels[validation_idx])
+
+
+def subsample_cluster(
+        dataset,
+        cluster_fn,
+        max_points,
+        n_strata=100,
+        n_neighbors=10,
+        t_scale=2 * 60 * 60,
+        validation_size=None,
+        return_agreement=False):
+    """Cluster a time stratified subsample and propagate to the rest
+
+    Bounds the cost of expensive clustering functions (t-SNE, UMAP,
+    HDBSCAN, SPC) regardless of the size of the dataset.
+
+    Args
+        dataset: An instance of core.BaseDataset to be labeled
+        cluster_fn: Function mapping a dataset to an array of labels
+        max_points: Maximum number of points to pass to cluster_fn
+        n_strata: Number of time blocks used in stratified_subsample
+        n_neighbors: Number of neighbors used when propagating labels
+        t_scale: Scale of time in the propagation feature space
+        validation_size (optional): If provided, cluster_fn is also run
+            on a held out split of this many points and the agreement
+            with the propagated labels is reported
+        return_agreement (optional): Also return the adjusted rand index
+            of the validation (None if it was not run)
+
+    Returns
+        Numpy array of labels for each point in dataset, and the
+        agreement if return_agreement is True
+    """
+    agreement = None
+    if len(dataset) <= max_points:
+        labels = cluster_fn(dataset)
+        return (labels, agreement) if return_agreement else labels
+
+    sample_idx = stratified_subsample(dataset, max_points, n_strata=n_strata)
+    sample_labels = cluster_fn(dataset.select(sample_idx))
+
+    features = propagation_features(dataset, sample_idx, t_scale=t_scale)
+    labels = propagate_labels(
+        features,
+        sample_idx,
+        sample_labels,
+        n_neighbors=n_neighbors
+    )
+
+    if validation_size:
+        agreement = subsample_agreement(
+            dataset,
+            labels,
+            cluster_fn,
+            validation_size,
+            exclude=sample_idx
+        )
+        print("Subsampled {}/{} points; agreement with full run on "
+            "{} held out points: ARI={:.3f}".format(
+                max_points, len(dataset), validation_size, agreement))
+
+    return (labels, agreement) if return_agreement else labels
+
+
 def flip_points(data, labels, flippable, n_neighbors=10, create_labels=False):
     raise Exception("Currently not in use")
 
@@ -533,11 +706,9 @@ def flip_points(data, labels, flippable, n_neighbors=10, create_labels=False):
         return labels
 
 
-def tsne_time(dataset, perplexity=30, t_scale=2 * 60 * 60, pcs=12):
-    if pcs >= min(dataset.waveforms.shape):
-        pcaed = PCA(n_components=min(dataset.waveforms.shape)).fit_transform(dataset.waveforms)
-    else:
-        pcaed = PCA(n_components=pcs).fit_transform(dataset.waveforms)
+def tsne_time(dataset, perplexity=30, t_scale=2 * 60 * 60, pcs=12, basis=None, refit=False):
+    pcs = min(pcs, *dataset.data_shape)
+    pcaed = project(dataset, pcs, basis=basis, refit=refit)
     wf_arr = scipy.stats.zscore(pcaed)
     t_arr = dataset.times / t_scale
     t_arr = t_arr - np.mean(t_arr)
@@ -550,8 +721,8 @@ def tsne_time(dataset, perplexity=30, t_scale=2 * 60 * 60, pcs=12):
     ).fit_transform(np.hstack([wf_arr, t_arr[:, None]]))
 
 
-def pca_time(dataset, t_scale=2 * 60 * 60, pcs=6):
-    pcaed = PCA(n_components=pcs).fit_transform(dataset.waveforms)
+def pca_time(dataset, t_scale=2 * 60 * 60, pcs=6, basis=None, refit=False):
+    pcaed = project(dataset, pcs, basis=basis, refit=refit)
     wf_arr = scipy.stats.zscore(pcaed, axis=0)
     t_arr = dataset.times / t_scale
     t_arr = t_arr - np.mean(t_arr)
@@ -632,7 +803,15 @@ def denoise(times, waveforms):
     return denoised
 
 
-def _vote_on_labels(dataset):
+def _vote_on_labels(dataset, max_points=None, validation_size=None):
+    if max_points is not None and len(dataset) > max_points:
+        return subsample_cluster(
+            dataset,
+            _vote_on_labels,
+            max_points=max_points,
+            validation_size=validation_size
+        )
+
     tsned = tsne_time(dataset, pcs=6, t_scale=2 * 60 * 60)
     spc = SPC(n_neighbors=min(10, len(dataset) - 1))
     spc.fit(tsned)
@@ -642,7 +821,7 @@ def _vote_on_labels(dataset):
     return cleanup_clusters(tsned, labels, n_neighbors=3)
 
 
-def sort(denoised):
+def sort(denoised, max_points=None):
     denoised_pcaed = pca_time(denoised, t_scale=6 * 60 * 60, pcs=3)
     # denoised_pcaed = scipy.stats.zscore(denoised_pcaed, axis=0)
 
@@ -653,7 +832,7 @@ def sort(denoised):
 
     labels = []
     for _ in range(4):
-        labels.append(_vote_on_labels(denoised))
+        labels.append(_vote_on_labels(denoised, max_points=max_points))
 
     label_map = {}
     next_label = 0
@@ -1,17 +1,26 @@
+import copy
+import functools
 import time
+from concurrent.futures import ProcessPoolExecutor
 
 import networkx as nx
 import numpy as np
 import scipy.stats
 import umap
+from scipy.optimize import linear_sum_assignment
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from scipy.spatial.distance import cdist
 from sklearn.cluster import MiniBatchKMeans as KMeans
 from sklearn.decomposition import PCA
 from sklearn.neighbors import KNeighborsClassifier, NearestNeighbors
 from sklearn.mixture import GaussianMixture
 from sklearn.mixture import BayesianGaussianMixture
 
-from .core import SpikeDataset, ClusterDataset
-from .sort import SPC
+from .core import SpikeDataset, ClusterDataset, SubDataset
+from .features import FeatureBasis, get_basis, project
+from .preprocess import realign as realign_dataset
+from .sort import SPC, stratified_subsample, subsample_cluster
 
 
 def _compute_overlap(neighbors, labels, A, B):
@@ -79,17 +88,33 @@ def relabel(dataset, n_components=4):
 
 def umap_time(dataset, pcs, n_components=3, t_scale=(60.0 * 60.0),
         wf_start=0,
-        wf_end=None):
+        wf_end=None,
+        basis=None,
+        refit=False):
 
     # FIXME: probably doesnt work with 1 datapoint...
     pcs = min(pcs, min(*dataset.waveforms.shape) - 1)
     n_components = min(n_components, len(dataset.waveforms) - 2)
 
     wf_slice = slice(wf_start, wf_end)
+    basis = get_basis(dataset, basis=basis, refit=refit)
+    if (
+            basis is not None and
+            pcs <= basis.n_components and
+            wf_start == 0 and
+            wf_end is None):
+        pcaed = scipy.stats.zscore(basis.project(dataset, n_components=pcs), axis=0)
+    else:
+        # The recording's basis spans whole waveforms, so a slice of
+        # the waveform needs its own PCA
+        pcaed = PCA(n_components=pcs).fit_transform(
+            scipy.stats.zscore(dataset.waveforms[:, wf_slice], axis=0)
+        )
+
     return umap.UMAP(n_components=n_components).fit_transform(
         np.hstack([
             dataset.times[:, None] / t_scale,
-            PCA(n_components=pcs).fit_transform(scipy.stats.zscore(dataset.waveforms[:, wf_slice], axis=0))
+            pcaed
         ])
     )
 
@@ -117,10 +142,18 @@ def vote_on_labels_hdb(dataset, min_cluster_size=10):
     return labels
 
 
-def spc_clustering(dataset, threshold=1.0, repeat=5):
+def spc_clustering(dataset, threshold=1.0, repeat=5, max_points=None, validation_size=None):
     if len(dataset) == 0:
         return np.array([])
 
+    if max_points is not None and len(dataset) > max_points:
+        return subsample_cluster(
+            dataset,
+            functools.partial(spc_clustering, threshold=threshold, repeat=repeat),
+            max_points=max_points,
+            validation_size=validation_size
+        )
+
     votes = []
     for _ in range(repeat):
         votes.append(vote_on_labels(dataset, threshold=threshold))
@@ -137,7 +170,14 @@ def spc_clustering(dataset, threshold=1.0, repeat=5):
     return labels
 
 
-def eliminate_small_clusters(dataset, labels, mode="high_snr"):
+def eliminate_small_clusters(dataset, labels, mode="high_snr", count_scale=1.0):
+    """Reassign points in small clusters to the nearest large clusters
+
+    Args
+        count_scale: Number of original datapoints each point of dataset
+            stands for (e.g. when dataset is a subsample), applied to
+            cluster counts before comparing them to the minimum sizes
+    """
     if not len(dataset):
         return np.array([])
 
@@ -159,7 +199,7 @@ def eliminate_small_clusters(dataset, labels, mode="high_snr"):
     clustered = dataset.cluster(labels)
     solid_labels = []
     for label, node in clustered.labeled_nodes:
-        if node.count >= real_min_cluster_size / 4.0:
+        if node.count * count_scale >= real_min_cluster_size / 4.0:
             solid_labels.append(label)
 
     if len(solid_labels) and len(solid_labels) != len(np.unique(labels)):
@@ -173,7 +213,7 @@ def eliminate_small_clusters(dataset, labels, mode="high_snr"):
     clustered = dataset.cluster(labels)
     solid_labels = []
     for label, node in clustered.labeled_nodes:
-        if node.count >= real_min_cluster_size / 2.0:
+        if node.count * count_scale >= real_min_cluster_size / 2.0:
             solid_labels.append(label)
 
     if len(solid_labels) and len(solid_labels) != len(np.unique(labels)):
@@ -187,7 +227,7 @@ def eliminate_small_clusters(dataset, labels, mode="high_snr"):
     clustered = dataset.cluster(labels)
     solid_labels = []
     for label, node in clustered.labeled_nodes:
-        if node.count >= real_min_cluster_size:
+        if node.count * count_scale >= real_min_cluster_size:
             solid_labels.append(label)
 
     if len(solid_labels) and len(solid_labels) != len(np.unique(labels)):
@@ -200,10 +240,34 @@ def eliminate_small_clusters(dataset, labels, mode="high_snr"):
     return labels
 
 
-def hdb_clustering(dataset, min_cluster_size=10, real_min_cluster_size=1000, repeat=5):
+def hdb_clustering(
+        dataset,
+        min_cluster_size=10,
+        real_min_cluster_size=1000,
+        repeat=5,
+        max_points=None,
+        validation_size=None,
+        count_scale=1.0):
     if len(dataset) == 0:
         return np.array([])
 
+    if max_points is not None and len(dataset) > max_points:
+        def _cluster_subset(subset):
+            return hdb_clustering(
+                subset,
+                min_cluster_size=min_cluster_size,
+                real_min_cluster_size=real_min_cluster_size,
+                repeat=repeat,
+                count_scale=count_scale * len(dataset) / len(subset)
+            )
+
+        return subsample_cluster(
+            dataset,
+            _cluster_subset,
+            max_points=max_points,
+            validation_size=validation_size
+        )
+
     votes = []
     for _ in range(repeat):
         votes.append(vote_on_labels_hdb(dataset, min_cluster_size=10))
@@ -218,7 +282,7 @@ def hdb_clustering(dataset, min_cluster_size=10, real_min_cluster_size=1000, rep
             next_label += 1
         labels[idx] = label_map[key]
 
-    labels = eliminate_small_clusters(dataset, labels, mode="low_snr")
+    labels = eliminate_small_clusters(dataset, labels, mode="low_snr", count_scale=count_scale)
 
     return labels
 
@@ -287,13 +351,95 @@ class SplitDataset(object):
         return self._skip(len(self.dataset), n)
 
 
+class TrackingKMeans(object):
+    """K-means over consecutive time windows that follows drifting clusters
+
+    Each window is initialized from the centroids of the previous window,
+    so slowly drifting units converge in a few iterations instead of
+    being refit from scratch. Clusters are linked to the previous window's
+    clusters by matching centroids, which gives every cluster a track id
+    that persists across windows.
+
+    All windows must be projected into the same feature space.
+    """
+    def __init__(self, n_clusters, max_iter=20, link_scale=1.0, first_track=0):
+        """
+        Args
+            n_clusters: Number of clusters fit in each window
+            max_iter: Maximum iterations for windows that are warm started
+            link_scale: A cluster is linked to its matched cluster in the
+                previous window only if their centroids are closer than
+                link_scale times the rms spread of the cluster
+            first_track: Track id to start counting from
+        """
+        self.n_clusters = n_clusters
+        self.max_iter = max_iter
+        self.link_scale = link_scale
+        self.centroids = None
+        self.track_ids = None
+        self.next_track = first_track
+
+    def fit_window(self, data, sample_weight=None):
+        """Fit the next window and return its labels
+
+        After this call, track_ids[label] is the track id of each cluster
+        found in the window.
+        """
+        n_clusters = min(self.n_clusters, len(data))
+        if self.centroids is None or len(self.centroids) != n_clusters:
+            clusterer = KMeans(n_clusters=n_clusters)
+            previous = None
+        else:
+            clusterer = KMeans(
+                n_clusters=n_clusters,
+                init=self.centroids,
+                n_init=1,
+                max_iter=self.max_iter
+            )
+            previous = self.centroids
+
+        clusterer.fit(data, sample_weight=sample_weight)
+        labels = clusterer.predict(data, sample_weight=sample_weight)
+
+        self.track_ids = self._link(previous, clusterer.cluster_centers_, data, labels)
+        self.centroids = clusterer.cluster_centers_
+        return labels
+
+    def _link(self, previous, centroids, data, labels):
+        track_ids = -1 * np.ones(len(centroids)).astype(int)
+
+        if previous is not None:
+            # rms distance of each cluster's members to its centroid
+            sq_dist = np.sum((data - centroids[labels]) ** 2, axis=1)
+            counts = np.bincount(labels, minlength=len(centroids))
+            spread = np.sqrt(
+                np.bincount(labels, weights=sq_dist, minlength=len(centroids)) /
+                np.maximum(counts, 1)
+            )
+
+            cost = cdist(centroids, previous)
+            rows, cols = linear_sum_assignment(cost)
+            linked = (counts[rows] > 0) & (cost[rows, cols] <= self.link_scale * spread[rows])
+            track_ids[rows[linked]] = self.track_ids[cols[linked]]
+
+        unlinked = track_ids == -1
+        track_ids[unlinked] = np.arange(
+            self.next_track,
+            self.next_track + np.sum(unlinked)
+        )
+        self.next_track += np.sum(unlinked)
+        return track_ids
+
+
 def cluster_step(
         dataset,
         dpoints=None,
         n_components=2,
         mode="kmeans",
         min_cluster_size=10,
-        levels=4
+        levels=4,
+        return_tracks=False,
+        refit=False
     ):
     """Implement a first step of the hierarchical clustering algorithm
 
@@ -304,20 +450,31 @@ def cluster_step(
         n_clusters: An integer number representing the (maximum) number
             of clusters to generate
         mode (default: "kmeans"): the clustering algorithm to apply. Can be
-            'kmeans' or 'spc' or 'umap'
+            'kmeans' or 'spc' or 'umap' or 'track'. 'track' projects all
+            windows of a level into one PCA basis and runs a TrackingKMeans
+            that is warm started from the previous window's centroids
         transform (optional): function that maps waveforms to a new
             feature space
         min_cluster_size: Integer indicating minimum cluster size. Clusters smaller
             than this value will be assigned the label -1.
+        return_tracks (default: False): Also return the track id of each
+            point (mode 'track' only; -1 for points that were not tracked)
+        refit (default: False): Fit a PCA to each window (or level, in
+            mode 'track') instead of using the recording's FeatureBasis
 
     Returns:
-        Numpy integer array representing labels for each cluster found
+        Numpy integer array representing labels for each cluster found,
+        and the array of track ids if return_tracks is True
     """
     _fn_start = time.time()
     _new_labels = -1 * np.ones(len(dataset)).astype(np.int)
+    _new_tracks = -1 * np.ones(len(dataset)).astype(np.int)
+    next_track = 0
     # len_last_window = dpoints
 
     if not len(dataset):
+        if return_tracks:
+            return np.array([]), np.array([])
         return np.array([])
 
     for level in range(levels):
@@ -325,6 +482,20 @@ def cluster_step(
         # that haven't been clustered by a lower level yet
         remaining_data = dataset.select(_new_labels == -1)
         remaining_labels = _new_labels[_new_labels == -1]
+        remaining_tracks = _new_tracks[_new_labels == -1]
+
+        if mode == "track":
+            if len(remaining_data) < n_components:
+                break
+            # One feature basis shared by every window of this level
+            basis = get_basis(remaining_data, refit=refit)
+            if basis is None:
+                basis_idx = stratified_subsample(remaining_data, 10 * dpoints)
+                basis = FeatureBasis.from_pca(
+                    PCA(n_components=6).fit(remaining_data.select(basis_idx).waveforms)
+                )
+            tracker = TrackingKMeans(n_clusters=n_components, first_track=next_track)
+
         for i in range(0, len(remaining_data), dpoints):
             # Indexes relative to remaining_data
             next_window = np.arange(i, min(i + dpoints, len(remaining_data)))
@@ -345,7 +516,12 @@ def cluster_step(
             else:
                 weights = None
 
-            decomp = PCA(n_components=6).fit_transform(window_data.waveforms)
+            window_tracks = None
+            if mode == "track":
+                decomp = basis.transform(window_data.waveforms, n_components=6)
+            else:
+                decomp = project(window_data, 6, refit=refit)
+
             if mode == "kmeans":
                 clusterer = KMeans(n_clusters=n_components)
                 clusterer.fit(decomp, sample_weight=weights)
@@ -365,8 +541,11 @@ def cluster_step(
                 labels = clusterer.predict(decomp, sample_weight=weights)
                 neighbor_cleaner = KNeighborsClassifier(n_neighbors=10).fit(decomp, labels)
                 labels = neighbor_cleaner.predict(decomp)
-
-
+            elif mode == "track":
+                labels = tracker.fit_window(decomp, sample_weight=weights)
+                neighbor_cleaner = KNeighborsClassifier(n_neighbors=10).fit(decomp, labels)
+                labels = neighbor_cleaner.predict(decomp)
+                window_tracks = tracker.track_ids[labels]
 
             for label, count in zip(*np.unique(labels, return_counts=True)):
                 # At the last level, only give isolated datapoints the -1 label
@@ -380,15 +559,23 @@ def cluster_step(
                     ) + 1
 
             remaining_labels[next_window] = labels
+            if window_tracks is not None:
+                window_tracks[labels == -1] = -1
+                remaining_tracks[next_window] = window_tracks
             print(
                 "Completed {}/{} in {:.1f}s.".format(
                     np.max(next_window),
                     len(remaining_data), time.time() - _fn_start
                 ),
                 end="\r")
+        _new_tracks[_new_labels == -1] = remaining_tracks
         _new_labels[_new_labels == -1] = remaining_labels
+        if mode == "track":
+            next_track = tracker.next_track
 
     print("Completed clustering in {:.1f}s\n".format(time.time() - _fn_start))
+    if return_tracks:
+        return _new_labels, _new_tracks
     return _new_labels
 
 
@@ -405,13 +592,55 @@ def compute_snr(node):
     return snr
 
 
-def sort(dataset, resume_from=None):
+def _smooth_labels(dataset, labels, max_points=None):
+    """Smooth labels with a kNN classifier in a UMAP embedding
+
+    Skipped when labels were already propagated from a subsample
+    of at most max_points points.
+    """
+    if max_points is not None and len(dataset) > max_points:
+        return labels
+    umapped = umap.UMAP(n_components=3).fit_transform(dataset.waveforms)
+    knn = KNeighborsClassifier(n_neighbors=10).fit(umapped, labels)
+    return knn.predict(umapped)
+
+
+def sort(dataset, resume_from=None, max_points=None, realign=False, validation_size=None):
+    """Run the sorting pipeline, yielding the result of each stage
+
+    Args
+        dataset: A core.SpikeDataset to sort
+        resume_from (optional): List of results of stages already
+            computed, which will be yielded again instead of recomputed
+        max_points (optional): Maximum number of points clustered
+            directly in the final stages. Larger sets are clustered on a
+            time stratified subsample and the labels propagated to the
+            remaining points (see sort.subsample_cluster)
+        validation_size (optional): When subsampling, also cluster a
+            held out split of this many points directly and report its
+            agreement with the propagated labels
+        realign (optional): Realign waveforms to their extremum with
+            sub-sample precision before clustering (see
+            preprocess.realign()). The results are then clusters of a
+            new SpikeDataset holding the realigned waveforms, in the
+            order of dataset and with its feature basis, rather than of
+            dataset itself. Results saved to a ChannelGroup then hold a
+            copy of the realigned waveforms instead of a reference to
+            their channel.
+    """
     if resume_from is None:
         resume_from = []
 
     if len(resume_from) != 0:
         clustered = resume_from[0]
     else:
+        if realign:
+            print("Realigning waveforms of {}".format(dataset))
+            dataset = realign_dataset(dataset)
+
+        if dataset.feature_basis is None:
+            dataset.feature_basis = FeatureBasis.fit(dataset)
+
         print("Clustering {}".format(dataset))
         split = SplitDataset(dataset, (dataset.waveforms[:, dataset.waveforms.shape[1] // 2]) > 20)
 
@@ -464,18 +693,22 @@ def sort(dataset, resume_from=None):
         split_2 = SplitDataset(clustered, (clustered.waveforms[:, clustered.waveforms.shape[1] // 2]) > 0)
 
         if len(split_2.set_1) > 10:
-            upgoing_labels = spc_clustering(split_2.set_1)
-            umapped_upgoing = umap.UMAP(n_components=3).fit_transform(split_2.set_1.waveforms)
-            knn = KNeighborsClassifier(n_neighbors=10).fit(umapped_upgoing, upgoing_labels)
-            upgoing_labels = knn.predict(umapped_upgoing)
+            upgoing_labels = spc_clustering(
+                split_2.set_1,
+                max_points=max_points,
+                validation_size=validation_size
+            )
+            upgoing_labels = _smooth_labels(split_2.set_1, upgoing_labels, max_points=max_points)
         else:
             upgoing_labels = split_2.set_1.labels
 
         if len(split_2.set_2) > 10:
-            downgoing_labels = spc_clustering(split_2.set_2)
-            umapped_downgoing = umap.UMAP(n_components=3).fit_transform(split_2.set_2.waveforms)
-            knn = KNeighborsClassifier(n_neighbors=10).fit(umapped_downgoing, downgoing_labels)
-            downgoing_labels = knn.predict(umapped_downgoing)
+            downgoing_labels = spc_clustering(
+                split_2.set_2,
+                max_points=max_points,
+                validation_size=validation_size
+            )
+            downgoing_labels = _smooth_labels(split_2.set_2, downgoing_labels, max_points=max_points)
         else:
             downgoing_labels = split_2.set_2.labels
 
@@ -516,7 +749,9 @@ def sort(dataset, resume_from=None):
                 split_3.set_2,
                 min_cluster_size=20,
                 repeat=5,
-                real_min_cluster_size=10000
+                real_min_cluster_size=10000,
+                max_points=max_points,
+                validation_size=validation_size
             )
         else:
             high_skew_labels = np.array([])
@@ -562,3 +797,527 @@ def sort(dataset, resume_from=None):
         print("Finished:\n{}".format(clustered))
         yield clustered
     '''
+
+
+def time_shards(times, shard_duration, overlap):
+    """Split sorted times into overlapping shards
+
+    Each shard owns a core time range of length shard_duration and
+    extends overlap seconds into its neighbors on either side.
+
+    Returns
+        List of (core, extended) pairs of index arrays into times, empty
+        if there are no times
+    """
+    if not len(times):
+        return []
+
+    t_start = times[0]
+    n_shards = max(1, int(np.ceil((times[-1] - t_start) / shard_duration)))
+    edges = t_start + shard_duration * np.arange(n_shards + 1)
+    edges[-1] = np.inf
+
+    shards = []
+    for core_start, core_stop in zip(edges[:-1], edges[1:]):
+        core = np.arange(*np.searchsorted(times, [core_start, core_stop]))
+        extended = np.arange(*np.searchsorted(
+            times,
+            [core_start - overlap, core_stop + overlap]
+        ))
+        shards.append((core, extended))
+
+    return shards
+
+
+def _cluster_templates(waveforms, labels, min_count):
+    """Mean waveform and rms spread of each label with at least min_count points"""
+    unique_labels, inverse, counts = np.unique(
+        labels,
+        return_inverse=True,
+        return_counts=True
+    )
+    templates = np.zeros((len(unique_labels), waveforms.shape[1]))
+    np.add.at(templates, inverse, waveforms)
+    templates /= counts[:, None]
+
+    sq_dist = np.sum((waveforms - templates[inverse]) ** 2, axis=1)
+    spread = np.sqrt(np.bincount(inverse, weights=sq_dist) / counts)
+
+    keep = (counts >= min_count) & (unique_labels != -1)
+    return unique_labels[keep], templates[keep], spread[keep]
+
+
+def link_clusters(waveforms, labels_a, labels_b, max_distance=1.0, min_count=20):
+    """Match two labelings of the same spikes by their cluster templates
+
+    Templates of each labeling are matched one to one, and a pair of
+    clusters is linked when their templates are closer than max_distance
+    times the larger of their spreads.
+
+    Args
+        waveforms: Waveforms of the spikes
+        labels_a, labels_b: Two label arrays for the spikes. Label -1
+            marks unclustered points
+        max_distance: Maximum template distance, relative to the cluster
+            spread, for two clusters to be linked
+        min_count: Minimum number of spikes for a cluster to be linked
+
+    Returns
+        Arrays of the linked labels of labels_a and of labels_b
+    """
+    labels_a, templates_a, spread_a = _cluster_templates(
+        waveforms, labels_a, min_count)
+    labels_b, templates_b, spread_b = _cluster_templates(
+        waveforms, labels_b, min_count)
+    if not len(labels_a) or not len(labels_b):
+        return labels_a[:0], labels_b[:0]
+
+    cost = cdist(templates_a, templates_b)
+    rows, cols = linear_sum_assignment(cost)
+    linked = cost[rows, cols] <= max_distance * np.maximum(spread_a[rows], spread_b[cols])
+    return labels_a[rows[linked]], labels_b[cols[linked]]
+
+
+def stitch_shards(waveforms, shards, shard_labels, max_distance=1.0, min_count=20):
+    """Link cluster labels of neighboring shards by template matching
+
+    For each pair of consecutive shards, the clusters of the spikes that
+    fall in both shards (their overlap) are linked with link_clusters().
+
+    Args
+        waveforms: Waveforms of the whole dataset
+        shards: List of (core, extended) index arrays from time_shards()
+        shard_labels: List of label arrays, one per extended shard.
+            Label -1 marks unclustered points
+        max_distance: Maximum template distance, relative to the cluster
+            spread, for two clusters to be linked
+        min_count: Minimum number of spikes in the overlap for a cluster
+            to be considered for linking
+
+    Returns
+        Array of global labels for every point in waveforms, -1 for points
+        left unclustered by the shard owning them
+    """
+    # Enumerate every (shard, label) pair as a node of a graph whose
+    # connected components are the global clusters
+    node_offsets = np.cumsum([0] + [
+        int(np.max(labels)) + 1 if len(labels) else 0
+        for labels in shard_labels
+    ])
+    edges = []
+
+    for k in range(len(shards) - 1):
+        (_, ext_a), (_, ext_b) = shards[k], shards[k + 1]
+        overlap, in_a, in_b = np.intersect1d(ext_a, ext_b, return_indices=True)
+        if not len(overlap):
+            continue
+
+        linked_a, linked_b = link_clusters(
+            waveforms[overlap],
+            shard_labels[k][in_a],
+            shard_labels[k + 1][in_b],
+            max_distance=max_distance,
+            min_count=min_count
+        )
+        edges.append(np.array([
+            node_offsets[k] + linked_a,
+            node_offsets[k + 1] + linked_b
+        ]))
+
+    edges = np.concatenate(edges, axis=1) if edges else np.zeros((2, 0), dtype=int)
+    graph = coo_matrix(
+        (np.ones(edges.shape[1]), (edges[0], edges[1])),
+        shape=(node_offsets[-1], node_offsets[-1])
+    )
+    _, components = connected_components(graph, directed=False)
+
+    global_labels = -1 * np.ones(len(waveforms)).astype(int)
+    for k, ((core, extended), labels) in enumerate(zip(shards, shard_labels)):
+        core_labels = labels[np.searchsorted(extended, core)]
+        assigned = core_labels != -1
+        global_labels[core[assigned]] = components[node_offsets[k] + core_labels[assigned]]
+
+    return global_labels
+
+
+def _sort_shard(times, waveforms, sample_rate, basis, sort_kwargs, min_size=1000):
+    """Run sort() on one shard, returning the final label of each spike
+
+    Shards with fewer than min_size spikes (e.g. in a gap of the
+    recording) are not sorted, and all their labels are -1
+    """
+    labels = -1 * np.ones(len(times)).astype(int)
+    if len(times) < max(min_size, 1):
+        return labels
+
+    shard = SpikeDataset(times=times, waveforms=waveforms, sample_rate=sample_rate)
+    shard.feature_basis = basis
+    result = None
+    for result in sort(shard, **sort_kwargs):
+        pass
+    if result is None:
+        return labels
+
+    flat = result.flatten()
+    labels[flat.ids] = flat.labels
+    return labels
+
+
+def sharded_sort(
+        dataset,
+        shard_duration=2 * 60 * 60.0,
+        overlap=10 * 60.0,
+        n_jobs=None,
+        max_distance=1.0,
+        min_count=20,
+        min_shard_size=1000,
+        **sort_kwargs):
+    """Sort a long recording in overlapping time shards in parallel
+
+    The dataset is split into shards of shard_duration seconds that
+    overlap their neighbors by overlap seconds on each side. Each shard
+    is sorted with sort() in its own process, and clusters are stitched
+    together across shard boundaries by matching their templates in the
+    overlap (see stitch_shards()). Each spike takes its label from the
+    shard whose core time range contains it.
+
+    Args
+        dataset: A core.SpikeDataset
+        shard_duration: Duration of the core of each shard in seconds
+        overlap: Time each shard extends into its neighbors in seconds
+        n_jobs: Number of worker processes (defaults to the cpu count)
+        max_distance, min_count: Passed to stitch_shards()
+        min_shard_size: Shards with fewer spikes are not sorted; their
+            spikes are left unassigned
+        **sort_kwargs: Passed to sort() for each shard
+
+    Returns
+        A ClusterDataset with one node per stitched cluster. Spikes that
+        were not assigned to a cluster by their shard are dropped.
+    """
+    _fn_start = time.time()
+
+    if not len(dataset):
+        return dataset.cluster(np.zeros(0, dtype=int))
+
+    if dataset.feature_basis is None:
+        dataset.feature_basis = FeatureBasis.fit(dataset)
+
+    shards = time_shards(dataset.times, shard_duration, overlap)
+    print("Sorting {} in {} shards".format(dataset, len(shards)))
+
+    with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+        futures = [
+            executor.submit(
+                _sort_shard,
+                dataset.times[extended],
+                dataset.waveforms[extended],
+                getattr(dataset, "sample_rate", None),
+                dataset.feature_basis,
+                sort_kwargs,
+                min_shard_size
+            )
+            for _, extended in shards
+        ]
+        shard_labels = []
+        for k, future in enumerate(futures):
+            shard_labels.append(future.result())
+            print("Completed shard {}/{} in {:.1f}s".format(
+                k + 1, len(shards), time.time() - _fn_start))
+
+    labels = stitch_shards(
+        dataset.waveforms,
+        shards,
+        shard_labels,
+        max_distance=max_distance,
+        min_count=min_count
+    )
+
+    print("Stitched shards in {:.1f}s".format(time.time() - _fn_start))
+    return dataset.select(labels != -1).cluster(labels[labels != -1])
+
+
+def _rebase(node, memo):
+    """Copy a dataset hierarchy, replacing datasets it refers to
+
+    Args
+        node: Dataset to copy
+        memo: Dict mapping the id() of datasets to their replacement; the
+            copies made are added to it
+
+    Records of the copies are the same arrays as the original's, except
+    for records holding nodes, which are copied to hold the copied nodes.
+    """
+    if id(node) in memo:
+        return memo[id(node)]
+
+    clone = copy.copy(node)
+    memo[id(node)] = clone
+    clone._tags = set(node.tags)
+    if node.has_children:
+        clone._data = node._data.copy()
+        clone._data["nodes"] = [_rebase(child, memo) for child in node._data["nodes"]]
+    clone.source = clone if node.source is node else _rebase(node.source, memo)
+    if "parent" in vars(node):
+        clone.parent = _rebase(node.parent, memo)
+    if isinstance(clone, ClusterDataset):
+        clone._build_index()
+    return clone
+
+
+def link_appended(
+        previous,
+        dataset,
+        segment_start,
+        segment_labels,
+        max_distance=1.0,
+        min_count=20):
+    """Add the clusters of an appended segment to a previous sort result
+
+    The segment's clusters are linked to the previous clusters by
+    matching their templates on the spikes both sorts contain (see
+    link_clusters()). Spikes added to a linked cluster join it under its
+    label; the other clusters of the segment are added with new labels.
+    Template distance is the only criterion; the clusters are compared on
+    the spikes at the end of the previous sort, so both must be active
+    there. The previous sort is not modified.
+
+    Clusters that gained no spikes keep the same spikes and labels. Their
+    bottom level nodes share their records with the previous sort; nodes
+    grouping child nodes are copies whose children have dataset as their
+    source. New nodes are added at the depth of the nodes next to them, so
+    each level of the hierarchy still has a single source (see flatten()).
+
+    Args
+        previous: ClusterDataset of the sort of the first spikes of dataset
+        dataset: SpikeDataset of the whole recording
+        segment_start: Index of the first spike of dataset that was sorted
+            again. Must be at most the number of spikes previously sorted
+        segment_labels: Labels of dataset[segment_start:] from the sort of
+            the segment, -1 for unclustered spikes
+
+    Returns
+        A ClusterDataset of dataset
+    """
+    old_recording = previous.recording
+    n_old = len(old_recording)
+    if (len(dataset) < n_old or
+            not np.array_equal(dataset.times[:n_old], old_recording.times)):
+        raise ValueError(
+            "The first spikes of dataset must be the spikes of the previous sort")
+    if segment_start > n_old:
+        raise ValueError("The segment must start within the previous sort")
+
+    segment_labels = np.asarray(segment_labels).astype(int)
+    old_labels = _previous_labels(previous)
+
+    linked_old, linked_new = link_clusters(
+        dataset.waveforms[segment_start:n_old],
+        old_labels[segment_start:],
+        segment_labels[:n_old - segment_start],
+        max_distance=max_distance,
+        min_count=min_count
+    )
+    label_map = dict(zip(linked_new.tolist(), linked_old.tolist()))
+
+    # Spikes of each new cluster that were not previously sorted
+    new_labels = segment_labels[n_old - segment_start:]
+    new_ids = np.arange(n_old, len(dataset))
+    next_label = (np.max(previous.labels) if len(previous) else 0) + 1
+    additions = []
+    for label in np.unique(new_labels[new_labels != -1]):
+        if label in label_map:
+            target = label_map[label]
+        else:
+            target = next_label
+            next_label += 1
+        additions.append((target, new_ids[new_labels == label]))
+
+    # Spikes joining or added next to previous clusters whose nodes group
+    # child nodes are added as new nodes at every level of the hierarchy,
+    # so that all nodes of a level keep the same source and depth. The new
+    # nodes are later in time than all existing ones, so the positions of
+    # the existing nodes in their sources are kept.
+    label_index = previous.label_index
+    memo = {id(old_recording): dataset}
+    additions_to = {}
+    made = {}
+
+    def add_to_source(source, like, ids):
+        """Add a node like the node like to source; its index among the additions"""
+        children = additions_to.setdefault(id(source), (source, []))[1]
+        children.append(new_branch(like, ids))
+        return len(children) - 1
+
+    def position(source, index):
+        """Position of an added node in the extended source
+
+        The extended source orders its nodes by time, so the position of
+        an added node is only known once the source has been derived.
+        """
+        return memo[id(source)].node_index[id(made[id(source)][index])]
+
+    def new_branch(like, ids):
+        """A function making a node of ids at the same depth as like"""
+        if not like.has_children:
+            return lambda: dataset.select(ids)
+        index = add_to_source(like.source, like.nodes[0], ids)
+        return lambda: SubDataset(
+            memo[id(like.source)], ids=[position(like.source, index)])
+
+    new_nodes = []
+    for target, ids in additions:
+        if target not in label_index:
+            like = previous.nodes[0] if len(previous) else None
+            if like is None or not like.has_children:
+                new_nodes.append(lambda ids=ids: dataset.select(ids))
+            else:
+                new_nodes.append(new_branch(like, ids))
+            continue
+
+        node = previous.nodes[label_index[target][0]]
+        if not node.has_children:
+            new_nodes.append(lambda node=node, ids=ids: SubDataset(
+                dataset, ids=np.concatenate([node.ids, ids])))
+        else:
+            index = add_to_source(node.source, node.nodes[0], ids)
+            new_nodes.append(lambda node=node, index=index: SubDataset(
+                memo[id(node.source)],
+                ids=np.concatenate([node.ids, [position(node.source, index)]])))
+
+    # Sources closest to the recording are extended first, as the new
+    # nodes of the sources above refer to theirs
+    for source, children in sorted(
+            additions_to.values(), key=lambda item: _depth(item[0])):
+        nodes = [make_node() for make_node in children]
+        made[id(source)] = nodes
+        rebased = _rebase(source, memo)
+        start_at = (np.max(rebased.labels) if len(rebased) else 0) + 1
+        memo[id(source)] = rebased.derive(
+            nodes=nodes,
+            labels=np.arange(start_at, start_at + len(nodes))
+        )
+
+    result = _rebase(previous, memo)
+    remove = np.isin(
+        np.arange(len(previous)),
+        [label_index[target][0] for target, _ in additions if target in label_index])
+    return result.derive(
+        remove=remove,
+        nodes=[make_node() for make_node in new_nodes],
+        labels=[target for target, _ in additions])
+
+
+def _previous_labels(previous):
+    """Label of each spike of a sort's recording, -1 if unclustered"""
+    labels = -1 * np.ones(len(previous.recording)).astype(int)
+    for label, node in previous.labeled_nodes:
+        labels[node.flatten().ids] = label
+    return labels
+
+
+def _template_labels(previous, dataset, segment_start, min_count=20):
+    """Segment labels that assign appended spikes to previous templates
+
+    The previously sorted spikes of the segment keep their labels, and
+    each appended spike takes the label of the nearest template of the
+    previous clusters with at least min_count spikes in the segment.
+    """
+    n_old = len(previous.recording)
+    old_labels = _previous_labels(previous)[segment_start:]
+    labels, templates, _ = _cluster_templates(
+        dataset.waveforms[segment_start:n_old], old_labels, min_count)
+    if not len(labels):
+        raise ValueError(
+            "No previous cluster has {} spikes in the overlap to assign "
+            "the appended spikes to; increase the overlap".format(min_count))
+    nearest = np.argmin(cdist(dataset.waveforms[n_old:], templates), axis=1)
+    return np.concatenate([old_labels, labels[nearest]])
+
+
+def _depth(node):
+    """Levels of nodes between a dataset and its recording's spikes"""
+    if not node.has_children:
+        return 0
+    return 1 + _depth(node.nodes[0])
+
+
+def sort_appended(
+        previous,
+        dataset,
+        overlap=10 * 60.0,
+        max_distance=1.0,
+        min_count=20,
+        min_segment_size=1000,
+        **sort_kwargs):
+    """Sort the spikes appended to a recording since a previous sort
+
+    Only the spikes after the previously sorted ones, plus the last
+    overlap seconds of the previously sorted spikes, are sorted with
+    sort(). The clusters found are linked to the previous clusters on the
+    overlapping spikes and added to the previous result (see
+    link_appended()). Clusters are linked by template matching only; they
+    are continuous in time in that both must have at least min_count
+    spikes in the overlap, just before the appended spikes.
+
+    When the segment has fewer than min_segment_size spikes (or its
+    sort finds no clusters), it is not sorted and each appended spike
+    joins the previous cluster with the nearest template in the overlap.
+
+    Args
+        previous: ClusterDataset of the final result of sort() on the
+            recording before it grew
+        dataset: SpikeDataset of the whole recording; its first spikes
+            must be those of the previous sort's recording
+        overlap: Seconds of previously sorted spikes sorted again to link
+            clusters across the boundary
+        max_distance, min_count: Passed to link_clusters()
+        min_segment_size: Fewest spikes of the segment to sort
+        **sort_kwargs: Passed to sort(). With realign=True, the whole of
+            dataset is realigned once and the segment is sorted and
+            linked on the realigned waveforms.
+
+    Returns
+        A ClusterDataset of dataset, or with realign=True of the
+        realigned dataset (as sort() returns)
+    """
+    _fn_start = time.time()
+    old_recording = previous.recording
+    n_old = len(old_recording)
+    if len(dataset) == n_old:
+        print("No spikes were appended since the previous sort")
+        return previous
+
+    if dataset.feature_basis is None:
+        dataset.feature_basis = old_recording.feature_basis or FeatureBasis.fit(dataset)
+    if sort_kwargs.pop("realign", False):
+        print("Realigning waveforms of {}".format(dataset))
+        dataset = realign_dataset(dataset)
+
+    segment_start = np.searchsorted(
+        dataset.times[:n_old], dataset.times[n_old] - overlap)
+    print("Sorting {} appended spikes with {} previously sorted spikes".format(
+        len(dataset) - n_old, n_old - segment_start))
+    segment_labels = _sort_shard(
+        dataset.times[segment_start:],
+        dataset.waveforms[segment_start:],
+        getattr(dataset, "sample_rate", None),
+        dataset.feature_basis,
+        sort_kwargs,
+        min_size=min_segment_size
+    )
+    if np.all(segment_labels == -1):
+        print("Too few spikes to sort; assigning appended spikes to the "
+              "nearest previous templates")
+        segment_labels = _template_labels(previous, dataset, segment_start, min_count)
+
+    result = link_appended(
+        previous,
+        dataset,
+        segment_start,
+        segment_labels,
+        max_distance=max_distance,
+        min_count=min_count
+    )
+    print("Sorted appended spikes in {:.1f}s".format(time.time() - _fn_start))
+    return result
@@ -0,0 +1,128 @@
+"""Compact storage of the waveforms of a SpikeDataset
+
+A SpikeDataset stores its waveforms as float64 by default. A storage
+object can instead encode them into a smaller column of the dataset's
+records, and decodes them back to float64 whenever they are accessed
+(e.g. through dataset.waveforms). Because every SubDataset copies the
+records of the spikes it contains, the saving applies to all datasets
+derived from the recording too.
+
+    "float32": Single precision floats (2x smaller)
+    "int16": Integers with one scale factor per dataset (4x smaller),
+        i.e. the precision of most acquisition systems
+    "pca": Coefficients of a PCA of the waveforms, as float32. Waveforms
+        are reconstructed from the coefficients (and are approximate).
+"""
+
+import numpy as np
+
+
+class Float32Storage(object):
+    name = "float32"
+
+    def column_dtype(self, n_samples):
+        return ("float32", n_samples)
+
+    def encode(self, waveforms):
+        return np.asarray(waveforms, dtype=np.float32)
+
+    def decode(self, stored):
+        return stored.astype(np.float64)
+
+
+class Int16Storage(object):
+    name = "int16"
+
+    def __init__(self, scale):
+        """
+        Args
+            scale: Value of one integer step
+        """
+        self.scale = scale
+
+    @classmethod
+    def fit(cls, waveforms, chunk_size=100000):
+        peak = 0.0
+        for start in range(0, len(waveforms), chunk_size):
+            peak = max(peak, np.max(np.abs(waveforms[start:start + chunk_size])))
+        return cls(peak / 32767.0 if peak > 0 else 1.0)
+
+    def column_dtype(self, n_samples):
+        return ("int16", n_samples)
+
+    def encode(self, waveforms):
+        return np.clip(
+            np.round(np.asarray(waveforms) / self.scale),
+            -32767,
+            32767
+        ).astype(np.int16)
+
+    def decode(self, stored):
+        return stored * self.scale
+
+
+class PCAStorage(object):
+    name = "pca"
+
+    def __init__(self, mean, components):
+        """
+        Args
+            mean: Mean waveform
+            components: (n_components, n_samples) orthonormal components
+        """
+        self.mean = np.asarray(mean)
+        self.components = np.asarray(components)
+
+    @classmethod
+    def fit(cls, waveforms, n_components=12, chunk_size=10000):
+        from sklearn.decomposition import IncrementalPCA
+
+        n_components = min(n_components, *waveforms.shape)
+        n_chunks = max(1, len(waveforms) // max(chunk_size, n_components))
+        ipca = IncrementalPCA(n_components=n_components)
+        for chunk in np.array_split(np.arange(len(waveforms)), n_chunks):
+            ipca.partial_fit(waveforms[chunk])
+        return cls(ipca.mean_, ipca.components_)
+
+    def column_dtype(self, n_samples):
+        return ("float32", len(self.components))
+
+    def encode(self, waveforms):
+        return np.dot(waveforms - self.mean, self.components.T).astype(np.float32)
+
+    def decode(self, stored):
+        return np.dot(stored.astype(np.float64), self.components) + self.mean
+
+
+def make_storage(mode, waveforms, n_components=12):
+    """Create the storage of a given mode fit to waveforms
+
+    Args
+        mode: One of "float64", "float32", "int16" or "pca"
+        waveforms: (n_spikes, n_samples) array of the waveforms to store
+        n_components: Number of PCA components kept by the "pca" mode
+
+    Returns
+        A storage object, or None for the default float64 storage
+    """
+    if mode == "float64":
+        return None
+    elif mode == "float32":
+        return Float32Storage()
+    elif mode == "int16":
+        return Int16Storage.fit(waveforms)
+    elif mode == "pca":
+        return PCAStorage.fit(waveforms, n_components=n_components)
+    else:
+        raise ValueError("Unknown storage mode {}".format(mode))
+
+
+def encode_chunks(storage, waveforms, chunk_size=100000):
+    """Encode waveforms chunk by chunk to limit the float64 copies made"""
+    n_samples = waveforms.shape[1]
+    dtype, width = storage.column_dtype(n_samples)
+    encoded = np.empty((len(waveforms), width), dtype=dtype)
+    for start in range(0, len(waveforms), chunk_size):
+        encoded[start:start + chunk_size] = storage.encode(
+            waveforms[start:start + chunk_size])
+    return encoded
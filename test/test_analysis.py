@@ -0,0 +1,193 @@
+import tracemalloc
+import unittest
+
+import numpy as np
+from numpy.testing import assert_array_equal
+
+from suss.analysis import (
+    align,
+    align_times,
+    bin_spikes,
+    binned_counts,
+    correlograms,
+    isi_histogram,
+    isi_violations,
+    psth,
+    refractory_counts
+)
+from suss.core import SpikeDataset
+from suss.operations import merge_nodes
+
+
+class TestAlign(unittest.TestCase):
+
+    def setUp(self):
+        self.times = np.sort(np.random.uniform(0, 100, 1000))
+        self.stimulus_times = np.array([50.0, 10.0, 99.5, 200.0])
+
+    def test_align_times(self):
+        offsets, relative_times, indices = align_times(
+                self.times, self.stimulus_times, -1, 2)
+        self.assertEqual(len(offsets), 5)
+        for i, stimulus_time in enumerate(self.stimulus_times):
+            window = self.times[
+                (self.times >= stimulus_time - 1) &
+                (self.times < stimulus_time + 2)
+            ]
+            assert_array_equal(
+                    relative_times[offsets[i]:offsets[i + 1]],
+                    window - stimulus_time)
+        assert_array_equal(self.times[indices], relative_times + np.repeat(
+            self.stimulus_times, np.diff(offsets)))
+
+    def test_align(self):
+        dataset = SpikeDataset(
+            times=self.times,
+            waveforms=np.arange(1000)[:, None] * np.ones((1000, 3))
+        )
+        spikes, waveforms = align(dataset, self.stimulus_times, -1, 2)
+        self.assertEqual(len(spikes), 4)
+        self.assertEqual(len(spikes[3]), 0)
+        assert_array_equal(
+                waveforms[0][:, 0],
+                np.where((self.times >= 49) & (self.times < 52))[0])
+
+
+class TestPSTH(unittest.TestCase):
+
+    def test_psth(self):
+        times = np.sort(np.random.uniform(0, 100, 2000))
+        spikes = SpikeDataset(times=times, waveforms=np.zeros((2000, 2)))
+        clusters = spikes.cluster(np.random.randint(0, 3, 2000))
+        stimulus_times = np.array([5.0, 40.0, 41.0, 90.0])
+        bin_edges = np.linspace(-1, 2, 7)
+
+        counts = psth(clusters, stimulus_times, bin_edges, chunk_size=3, n_jobs=2)
+        self.assertEqual(counts.shape, (3, 4, 6))
+        for i, node in enumerate(clusters.nodes):
+            for j, stimulus_time in enumerate(stimulus_times):
+                expected, _ = np.histogram(node.times - stimulus_time, bins=bin_edges)
+                assert_array_equal(counts[i, j], expected)
+
+        sparse_counts = psth(clusters, stimulus_times, bin_edges, sparse=True)
+        assert_array_equal(sparse_counts.toarray(), counts.reshape(3, 24))
+
+
+class TestCorrelograms(unittest.TestCase):
+
+    def setUp(self):
+        times = np.sort(np.random.uniform(0, 20, 3000))
+        spikes = SpikeDataset(times=times, waveforms=np.zeros((3000, 2)))
+        self.clusters = spikes.cluster(np.random.randint(0, 3, 3000))
+
+    def brute_force(self, a, b, bin_edges):
+        lags = (b.times[None, :] - a.times[:, None]).ravel()
+        if a is b:
+            lags = lags[lags != 0]
+        return np.histogram(lags, bins=bin_edges)[0]
+
+    def test_correlograms(self):
+        counts, bin_edges = correlograms(self.clusters, window=0.02, bin_size=0.002)
+        self.assertEqual(counts.shape, (3, 3, 20))
+        for i, a in enumerate(self.clusters.nodes):
+            for j, b in enumerate(self.clusters.nodes):
+                assert_array_equal(counts[i, j], self.brute_force(a, b, bin_edges))
+
+        refractory = refractory_counts(counts, bin_edges, 0.002)
+        assert_array_equal(refractory, np.sum(counts[:, :, 9:11], axis=2))
+
+    def test_correlograms_cached(self):
+        correlograms(self.clusters, window=0.02, bin_size=0.002)
+        merged = merge_nodes(self.clusters, labels=[0, 1])
+        counts, bin_edges = correlograms(merged, window=0.02, bin_size=0.002)
+        for i, a in enumerate(merged.nodes):
+            for j, b in enumerate(merged.nodes):
+                assert_array_equal(counts[i, j], self.brute_force(a, b, bin_edges))
+
+
+    def test_correlograms_sample_times(self):
+        samples = self.clusters.flatten()
+        dataset = SpikeDataset(
+            times=samples.times,
+            waveforms=samples.waveforms,
+            sample_rate=30000.0,
+            labels=samples.labels,
+            sample_times=True)
+        clusters = dataset.cluster(dataset.labels)
+        counts, bin_edges = correlograms(clusters, window=0.02, bin_size=0.002)
+        sample_edges = np.round(bin_edges * 30000.0)
+        for i, a in enumerate(clusters.nodes):
+            for j, b in enumerate(clusters.nodes):
+                lags = b.samples[None, :] - a.samples[:, None]
+                if a is b:
+                    lags = lags[~np.eye(len(lags), dtype=bool)]
+                # Bins are half open, also the last one
+                lags = lags[lags != sample_edges[-1]]
+                assert_array_equal(counts[i, j], np.histogram(lags, bins=sample_edges)[0])
+
+
+class TestISI(unittest.TestCase):
+
+    def test_isi(self):
+        samples = np.array([0, 10, 40, 100, 1000, 1029])
+        dataset = SpikeDataset(
+            times=samples,
+            waveforms=np.zeros((6, 2)),
+            sample_rate=30000.0,
+            sample_times=True)
+        float_dataset = SpikeDataset(times=samples / 30000.0, waveforms=np.zeros((6, 2)))
+
+        # Intervals of 10, 30, 60, 900 and 29 samples
+        self.assertEqual(isi_violations(dataset), 2 / 5.0)
+        self.assertEqual(isi_violations(dataset, refractory_period=0.002), 3 / 5.0)
+        self.assertEqual(isi_violations(float_dataset), 2 / 5.0)
+        self.assertTrue(np.isnan(isi_violations(dataset.select([0]))))
+
+        counts, bin_edges = isi_histogram(dataset, t_max=0.004, bin_size=0.001)
+        assert_array_equal(counts, [2, 1, 1, 0])
+        np.testing.assert_allclose(bin_edges, [0, 0.001, 0.002, 0.003, 0.004])
+        float_counts, _ = isi_histogram(float_dataset, t_max=0.004, bin_size=0.001)
+        assert_array_equal(float_counts, counts)
+
+
+class TestBinnedCounts(unittest.TestCase):
+
+    def edges(self, bins):
+        t_start, bin_size, n_bins = bins
+        return t_start + bin_size * np.arange(n_bins + 1)
+
+    def test_bin_spikes(self):
+        times = np.sort(np.random.uniform(0, 10, 5000))
+        labels = np.random.choice([3, 5, 9], 5000)
+        counts, bins = bin_spikes(
+                times, labels, bin_size=0.01, row_labels=[9, 3], chunk_duration=0.55)
+        self.assertEqual(bins[:2], (0.0, 0.01))
+        self.assertEqual(counts.shape, (2, bins[2]))
+        for row, label in enumerate([9, 3]):
+            expected, _ = np.histogram(times[labels == label], bins=self.edges(bins))
+            assert_array_equal(counts[row].toarray()[0], expected)
+
+    def test_bin_spikes_memory(self):
+        # 10^10 bins of 1us over ~3 hours; anything with one entry per
+        # bin would take at least 10GB
+        times = np.sort(np.random.uniform(0, 10000, 1000))
+        labels = np.random.randint(0, 3, 1000)
+        tracemalloc.start()
+        try:
+            counts, bins = bin_spikes(times, labels, bin_size=1e-6, t_stop=10000.0)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        self.assertEqual(bins[2], 10 ** 10)
+        self.assertEqual(counts.data.sum(), 1000)
+        self.assertLess(peak, 10 * 1024 ** 2)
+
+    def test_binned_counts(self):
+        times = np.sort(np.random.uniform(0, 10, 1000))
+        spikes = SpikeDataset(times=times, waveforms=np.zeros((1000, 2)))
+        clusters = spikes.cluster(np.random.randint(0, 3, 1000))
+        counts, bins = binned_counts(clusters, bin_size=0.5, t_stop=10.0)
+        self.assertEqual(counts.shape, (3, 20))
+        for row, node in enumerate(clusters.nodes):
+            expected, _ = np.histogram(node.times, bins=self.edges(bins))
+            assert_array_equal(counts[row].toarray()[0], expected)
@@ -0,0 +1,134 @@
+import csv
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+import numpy as np
+
+import suss.io
+from suss.batch import find_jobs, output_filename, run_batch
+from suss.core import SpikeDataset
+from suss.features import FeatureBasis, basis_filename
+
+
+def fake_sort(dataset, log=None, fail_size=None, crash_size=None, duration=0.0):
+    """Stands in for sort3.sort; behaves according to the dataset's size"""
+    if log is not None:
+        with open(log, "a") as log_file:
+            log_file.write("start {} {}\n".format(len(dataset), time.time()))
+    time.sleep(duration)
+    if len(dataset) == fail_size:
+        raise ValueError("Cannot sort")
+    if len(dataset) == crash_size:
+        # Like a worker killed for running out of memory
+        os._exit(1)
+    if log is not None:
+        with open(log, "a") as log_file:
+            log_file.write("stop {} {}\n".format(len(dataset), time.time()))
+    yield dataset.cluster(np.arange(len(dataset)) % 2)
+
+
+class TestBatch(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.summary_file = os.path.join(self.directory, "summary.csv")
+        self.log = os.path.join(self.directory, "log.txt")
+        self.paths = []
+        for size in (10, 20, 30):
+            path = os.path.join(self.directory, "ch{}.pkl".format(size))
+            suss.io.save_pickle(path, SpikeDataset(
+                times=np.arange(size, dtype=float),
+                waveforms=np.zeros((size, 200))))
+            self.paths.append(path)
+        self.jobs = find_jobs([os.path.join(self.directory, "*.pkl")])
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def run_batch(self, **kwargs):
+        with mock.patch("suss.batch.sort", fake_sort):
+            return run_batch(self.jobs, summary_file=self.summary_file, **kwargs)
+
+    def read_log(self):
+        """(start, stop) time of each sorted dataset, by size"""
+        times = {}
+        with open(self.log) as log_file:
+            for line in log_file:
+                event, size, t = line.split()
+                times.setdefault(int(size), {})[event] = float(t)
+        return times
+
+    def test_summary(self):
+        summary = self.run_batch(n_jobs=2)
+        self.assertEqual(len(summary), 3)
+        for row in summary:
+            self.assertEqual(row["status"], "done")
+            self.assertEqual(row["n_clusters"], 2)
+            self.assertTrue(os.path.exists(row["output"]))
+
+        with open(self.summary_file, newline="") as summary_fd:
+            rows = list(csv.DictReader(summary_fd))
+        self.assertEqual(
+            sorted(row["input"] for row in rows), sorted(self.paths))
+        self.assertEqual(
+            sorted(int(row["n_spikes"]) for row in rows), [10, 20, 30])
+        result = suss.io.read_pickle(output_filename(self.paths[1]))
+        self.assertEqual(result.count, 20)
+
+    def test_feature_basis(self):
+        self.run_batch(n_jobs=1)
+        for path in self.paths:
+            self.assertTrue(os.path.exists(basis_filename(path)))
+        self.assertEqual(
+            FeatureBasis.load(basis_filename(self.paths[0])).components.shape[1], 200)
+
+    def test_skip_existing(self):
+        suss.io.save_pickle(output_filename(self.paths[0]), "done before")
+        summary = self.run_batch(n_jobs=1)
+        status = {row["input"]: row["status"] for row in summary}
+        self.assertEqual(status[self.paths[0]], "skipped")
+        self.assertEqual(status[self.paths[1]], "done")
+        self.assertEqual(suss.io.read_pickle(output_filename(self.paths[0])), "done before")
+
+        summary = self.run_batch(n_jobs=1, overwrite=True)
+        self.assertEqual([row["status"] for row in summary], ["done"] * 3)
+
+    def test_failure(self):
+        summary = self.run_batch(n_jobs=2, fail_size=20)
+        status = {row["input"]: row for row in summary}
+        self.assertEqual(status[self.paths[1]]["status"], "failed")
+        self.assertIn("Cannot sort", status[self.paths[1]]["error"])
+        self.assertFalse(os.path.exists(output_filename(self.paths[1])))
+        self.assertEqual(status[self.paths[0]]["status"], "done")
+        self.assertEqual(status[self.paths[2]]["status"], "done")
+
+    def test_broken_pool(self):
+        summary = self.run_batch(n_jobs=1, crash_size=30)
+        status = {row["input"]: row for row in summary}
+        self.assertEqual(status[self.paths[2]]["status"], "failed")
+        self.assertIn("BrokenProcessPool", status[self.paths[2]]["error"])
+        # The jobs after the crash run on a new pool
+        self.assertEqual(status[self.paths[0]]["status"], "done")
+        self.assertEqual(status[self.paths[1]]["status"], "done")
+
+    def test_memory_limit(self):
+        # Each job's estimate is its file size; the two largest do not fit
+        # under the limit together, so they never run at the same time
+        sizes = [os.path.getsize(path) for path in self.paths]
+        self.run_batch(
+            n_jobs=3,
+            memory_factor=1.0,
+            memory_limit=sizes[2] + sizes[0] + 1,
+            log=self.log,
+            duration=0.5)
+        times = self.read_log()
+        first, second = sorted([times[20], times[30]], key=lambda t: t["start"])
+        self.assertLessEqual(first["stop"], second["start"])
+        # The smallest job fits next to the largest and runs alongside it
+        self.assertLess(
+            max(times[10]["start"], times[30]["start"]),
+            min(times[10]["stop"], times[30]["stop"]))
@@ -0,0 +1,150 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+from numpy.testing import assert_array_equal
+
+from suss.batch import estimate_memory, find_jobs, output_exists, sort_file
+from suss.channels import ChannelGroup, channel_filename, channel_path, split_channel_path
+from suss.core import SpikeDataset
+from suss.features import basis_filename
+
+
+class TestChannelGroup(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, "site.suss")
+        self.datasets = {
+            "ch{}".format(channel): SpikeDataset(
+                times=np.sort(np.random.randint(0, 300000, 500)),
+                waveforms=np.random.normal(size=(500, 20)),
+                sample_rate=30000.0,
+                sample_times=True,
+                storage="int16")
+            for channel in range(4)
+        }
+        self.group = ChannelGroup.create(self.filename, self.datasets)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_open(self):
+        group = ChannelGroup(self.filename)
+        self.assertEqual(group.channels, ["ch0", "ch1", "ch2", "ch3"])
+        dataset = group.open("ch2")
+        self.assertIsInstance(dataset._data, np.memmap)
+        self.assertIs(group.open("ch2"), dataset)
+
+        expected = self.datasets["ch2"]
+        assert_array_equal(dataset.waveforms, expected.waveforms)
+        assert_array_equal(dataset.samples, expected.samples)
+        self.assertEqual(dataset.sample_rate, 30000.0)
+        self.assertEqual(dataset.storage.scale, expected.storage.scale)
+
+        with self.assertRaises(ValueError):
+            group.open("ch9")
+
+    def test_add(self):
+        self.group.add("ch4", self.datasets["ch0"].cluster(np.zeros(500)))
+        assert_array_equal(
+            ChannelGroup(self.filename).open("ch4").waveforms,
+            self.datasets["ch0"].waveforms)
+        with self.assertRaises(ValueError):
+            self.group.add("ch4", self.datasets["ch1"])
+
+    def test_sorted(self):
+        dataset = self.group.open("ch1")
+        clustered = dataset.cluster(np.arange(500) % 3)
+        self.assertFalse(self.group.has_sorted("ch1"))
+        self.assertIsNone(self.group.load_sorted("ch1"))
+
+        size = os.path.getsize(self.filename)
+        self.group.save_sorted("ch1", clustered)
+        # The channel's waveforms are not saved again
+        self.assertLess(os.path.getsize(self.filename) - size, self.group.nbytes("ch1"))
+
+        group = ChannelGroup(self.filename)
+        loaded = group.load_sorted("ch1")
+        self.assertIs(loaded.recording, group.open("ch1"))
+        assert_array_equal(loaded.labels, clustered.labels)
+        for node, expected in zip(loaded.nodes, clustered.nodes):
+            assert_array_equal(node.ids, expected.ids)
+            assert_array_equal(node.waveforms, expected.waveforms)
+        assert_array_equal(loaded.flatten().labels, clustered.flatten().labels)
+
+    def test_header(self):
+        # Only the locations of blocks are kept in the header, so reading
+        # it does not unpickle the channels' storage or feature basis
+        for entry in ChannelGroup(self.filename).header["channels"].values():
+            self.assertIsInstance(entry["attrs"], tuple)
+
+    def test_compact(self):
+        clustered = self.group.open("ch1").cluster(np.arange(500) % 3)
+        for _ in range(3):
+            self.group.save_sorted("ch1", clustered)
+        self.group.save_sorted("ch2", self.group.open("ch2").cluster(np.zeros(500)))
+        size = os.path.getsize(self.filename)
+
+        freed = ChannelGroup(self.filename).compact()
+        self.assertGreater(freed, 0)
+        self.assertEqual(os.path.getsize(self.filename), size - freed)
+
+        group = ChannelGroup(self.filename)
+        self.assertEqual(group.channels, ["ch0", "ch1", "ch2", "ch3"])
+        for channel, expected in self.datasets.items():
+            dataset = group.open(channel)
+            assert_array_equal(dataset.waveforms, expected.waveforms)
+            self.assertEqual(dataset.storage.scale, expected.storage.scale)
+        assert_array_equal(group.load_sorted("ch1").labels, clustered.labels)
+        self.assertEqual(len(group.load_sorted("ch2")), 1)
+        self.assertIsNone(group.load_sorted("ch3"))
+
+        # A group opened before the file was compacted writes to the new file
+        self.group.save_sorted("ch3", self.group.open("ch3").cluster(np.zeros(500)))
+        self.assertTrue(ChannelGroup(self.filename).has_sorted("ch3"))
+        assert_array_equal(
+            ChannelGroup(self.filename).open("ch0").waveforms, self.datasets["ch0"].waveforms)
+
+    def test_without_locks(self):
+        # Platforms with neither flock nor msvcrt write without a lock
+        with mock.patch.dict(sys.modules, {"fcntl": None, "msvcrt": None}):
+            self.group.add("ch4", self.datasets["ch0"])
+        assert_array_equal(
+            ChannelGroup(self.filename).open("ch4").waveforms,
+            self.datasets["ch0"].waveforms)
+
+    def test_not_a_group(self):
+        path = os.path.join(self.directory, "other.suss")
+        with open(path, "wb") as f:
+            f.write(b"not a group file")
+        with self.assertRaises(ValueError):
+            ChannelGroup(path)
+
+    def test_batch_jobs(self):
+        self.assertEqual(
+            split_channel_path(channel_path(self.filename, "ch3")),
+            (self.filename, "ch3"))
+        jobs = find_jobs([os.path.join(self.directory, "*.suss")])
+        self.assertEqual(
+            [path for path, _ in jobs],
+            [channel_path(self.filename, channel) for channel in self.group.channels])
+        self.assertEqual(jobs[0][0], jobs[0][1])
+        self.assertEqual(estimate_memory(jobs[0][0], factor=1.0), self.group.nbytes("ch0"))
+
+        self.assertFalse(output_exists(jobs[1][1]))
+        self.group.save_sorted("ch1", self.group.open("ch1").cluster(np.zeros(500)))
+        self.assertTrue(output_exists(jobs[1][1]))
+
+    def test_sort_file_basis(self):
+        def fake_sort(dataset):
+            yield dataset.cluster(np.zeros(len(dataset)))
+
+        with mock.patch("suss.batch.sort", fake_sort):
+            sort_file(channel_path(self.filename, "ch2"))
+        self.assertTrue(os.path.exists(basis_filename(channel_filename(self.filename, "ch2"))))
+        self.assertTrue(ChannelGroup(self.filename).has_sorted("ch2"))
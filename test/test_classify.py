@@ -0,0 +1,53 @@
+import unittest
+
+import numpy as np
+from numpy.testing import assert_array_equal
+
+from suss.classify import TemplateClassifier
+from suss.core import SpikeDataset
+
+
+class TestTemplateClassifier(unittest.TestCase):
+
+    def setUp(self):
+        self.templates = np.random.normal(size=(3, 20)) * 50
+
+    def make_dataset(self, n, t_start, t_stop, drift=0.0):
+        labels = np.random.randint(0, 3, n)
+        times = np.sort(np.random.uniform(t_start, t_stop, n))
+        waveforms = (
+            self.templates[labels] +
+            drift * times[:, None] / t_stop +
+            np.random.normal(size=(n, 20)) * 5
+        )
+        dataset = SpikeDataset(times=times, waveforms=waveforms)
+        return dataset, labels + 10
+
+    def test_predict(self):
+        dataset, labels = self.make_dataset(3000, 0, 100)
+        classifier = TemplateClassifier.fit(
+            dataset.cluster(labels), n_components=4, window=20.0)
+        self.assertEqual(len(classifier.templates), 5)
+
+        new_dataset, new_labels = self.make_dataset(2000, 100, 200)
+        predicted = classifier.predict(new_dataset, chunk_size=300)
+        self.assertGreater(np.mean(predicted == new_labels), 0.99)
+
+    def test_time_local_templates(self):
+        # Drift larger than the separation of templates in the first window
+        dataset, labels = self.make_dataset(6000, 0, 100, drift=100.0)
+        classifier = TemplateClassifier.fit(
+            dataset.cluster(labels), n_components=4, window=10.0)
+        predicted = classifier.predict(dataset, reject_threshold=None)
+        self.assertGreater(np.mean(predicted == labels), 0.99)
+
+    def test_reject(self):
+        dataset, labels = self.make_dataset(3000, 0, 100)
+        classifier = TemplateClassifier.fit(dataset.cluster(labels), n_components=4)
+        outliers = SpikeDataset(
+            times=np.arange(5.0),
+            waveforms=np.ones((5, 20)) * 1000)
+        assert_array_equal(classifier.predict(outliers), -np.ones(5))
+
+        clustered = classifier.cluster(dataset)
+        assert_array_equal(np.sort(clustered.labels), [10, 11, 12])
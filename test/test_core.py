@@ -1,3 +1,4 @@
+import pickle
 import unittest
 
 import numpy as np
@@ -150,3 +151,104 @@ class TestSpikeDataset(unittest.TestCase):
                 dataset.labels,
                 np.array([0, 1, 1, 1])
         )
+
+
+class TestSampleTimes(unittest.TestCase):
+
+    def setUp(self):
+        self.samples = np.array([30, 45, 15000, 30000, 30031])
+        self.dataset = SpikeDataset(
+            times=self.samples,
+            waveforms=np.zeros((5, 4)),
+            sample_rate=30000.0,
+            labels=np.array([0, 0, 1, 1, 1]),
+            sample_times=True)
+
+    def test_init(self):
+        self.assertEqual(self.dataset._data.dtype["times"], np.int32)
+        assert_array_equal(self.dataset.samples, self.samples)
+        assert_array_equal(self.dataset.times, self.samples / 30000.0)
+        self.assertTrue(self.dataset.has_sample_times)
+
+        from_seconds = SpikeDataset(
+            times=self.samples / 30000.0,
+            waveforms=np.zeros((5, 4)),
+            sample_rate=30000.0,
+            sample_times=True)
+        assert_array_equal(from_seconds.samples, self.samples)
+
+        with self.assertRaises(ValueError):
+            SpikeDataset(times=self.samples, waveforms=np.zeros((5, 4)), sample_times=True)
+
+    def test_int64(self):
+        dataset = SpikeDataset(
+            times=np.array([0, 2 ** 33]),
+            waveforms=np.zeros((2, 4)),
+            sample_rate=30000.0,
+            sample_times=True)
+        self.assertEqual(dataset._data.dtype["times"], np.int64)
+
+    def test_derived(self):
+        clustered = self.dataset.cluster(self.dataset.labels)
+        assert_array_equal(clustered.nodes[1].samples, [15000, 30000, 30031])
+        assert_array_equal(clustered.nodes[1].times, [0.5, 1.0, 30031 / 30000.0])
+        self.assertAlmostEqual(clustered.times[1], 1.0)
+        self.assertTrue(clustered.has_sample_times)
+        assert_array_equal(clustered.flatten().samples, self.samples)
+
+    def test_time_range(self):
+        assert_array_equal(self.dataset.time_range(0.0015, 1.0).samples, [45, 15000])
+        assert_array_equal(self.dataset.time_range(0.5, 2.0).samples, [15000, 30000, 30031])
+
+        float_dataset = SpikeDataset(times=self.samples / 30000.0, waveforms=np.zeros((5, 4)))
+        assert_array_equal(
+            float_dataset.time_range(0.5, 2.0).times, self.samples[2:] / 30000.0)
+        with self.assertRaises(ValueError):
+            float_dataset.samples
+
+
+class TestClusterDataset(unittest.TestCase):
+
+    def setUp(self):
+        times = np.arange(20.0)
+        self.spikes = SpikeDataset(
+            times=times,
+            waveforms=np.random.normal(size=(20, 4))
+        )
+        self.clusters = self.spikes.cluster(np.repeat([0, 1, 2, 3], 5))
+
+    def test_derive_matches_constructor(self):
+        remove = np.array([False, True, False, True])
+        new_node = self.spikes.select(np.arange(5, 20, 3))
+        derived = self.clusters.derive(
+            remove=remove,
+            nodes=[new_node],
+            labels=[7])
+        expected = ClusterDataset(
+            list(self.clusters.nodes[~remove]) + [new_node],
+            data_column="waveforms",
+            labels=[0, 2, 7]
+        )
+        assert_array_equal(derived.times, expected.times)
+        assert_array_equal(derived.ids, expected.ids)
+        assert_array_equal(derived.labels, expected.labels)
+        self.assertEqual(list(derived.nodes), list(expected.nodes))
+
+    def test_derive_shares_nodes(self):
+        derived = self.clusters.select(np.array([0, 2]), child=False)
+        self.assertIs(derived.nodes[0], self.clusters.nodes[0])
+        self.assertIs(derived.nodes[1], self.clusters.nodes[2])
+        self.assertEqual(len(self.clusters), 4)
+
+    def test_index(self):
+        derived = self.clusters.derive(
+            remove=np.array([True, False, False, False]),
+            nodes=[self.clusters.nodes[0]],
+            labels=[2])
+        self.assertEqual(derived.label_index[2], [0, 2])
+        self.assertEqual(derived.node_index[id(self.clusters.nodes[3])], 3)
+
+    def test_index_pickle(self):
+        restored = pickle.loads(pickle.dumps(self.clusters))
+        self.assertEqual(restored.label_index, self.clusters.label_index)
+        self.assertEqual(restored.node_index[id(restored.nodes[1])], 1)
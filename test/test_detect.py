@@ -0,0 +1,82 @@
+import os
+import tempfile
+import unittest
+
+import numpy as np
+from numpy.testing import assert_array_equal
+
+from suss.detect import detect_chunks, detect_spikes, read_raw
+
+
+class TestDetect(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(0)
+        self.sample_rate = 20000.0
+        n_samples = 20000 * 10
+        signal = np.random.normal(size=n_samples) * 20
+        spike = -200 * np.exp(-np.linspace(-3, 3, 20) ** 2)
+        self.spike_samples = np.arange(500, n_samples - 500, 997)
+        for sample in self.spike_samples:
+            signal[sample - 10:sample + 10] += spike
+
+        # Two interleaved channels, the spikes are on the second
+        raw = np.zeros((n_samples, 2), dtype=np.int16)
+        raw[:, 1] = signal
+        _, self.filename = tempfile.mkstemp()
+        raw.tofile(self.filename)
+
+    def tearDown(self):
+        os.remove(self.filename)
+
+    def test_read_raw(self):
+        data = read_raw(self.filename, n_channels=2, channel=1)
+        self.assertEqual(len(data), 200000)
+        self.assertEqual(data.dtype, np.int16)
+
+    def test_detect_spikes(self):
+        data = read_raw(self.filename, n_channels=2, channel=1)
+        dataset = detect_spikes(data, self.sample_rate, chunk_duration=1.0)
+        self.assertEqual(dataset.waveforms.shape[1], 30)
+        self.assertEqual(dataset.sample_rate, self.sample_rate)
+
+        detected = np.round(dataset.times * self.sample_rate).astype(int)
+        distance = np.abs(detected[:, None] - self.spike_samples[None, :])
+        self.assertTrue(np.all(np.min(distance, axis=0) <= 3))
+        # A few noise crossings (e.g. on the filter's ringing) are allowed
+        self.assertLess(np.sum(np.min(distance, axis=1) > 3), 10)
+
+        # Peaks are aligned to the middle of the waveform
+        self.assertEqual(np.argmin(np.mean(dataset.waveforms, axis=0)), 10)
+
+    def test_chunks_match_whole_signal(self):
+        data = read_raw(self.filename, n_channels=2, channel=1)
+        whole = detect_spikes(data, self.sample_rate, threshold=80.0, chunk_duration=100.0)
+        chunks = list(detect_chunks(
+            data, self.sample_rate, threshold=80.0, chunk_duration=0.37, n_jobs=2))
+        self.assertEqual(len(chunks), 28)
+        assert_array_equal(
+            np.concatenate([chunk.times for chunk in chunks]),
+            whole.times)
+        np.testing.assert_allclose(
+            np.concatenate([chunk.waveforms for chunk in chunks]),
+            whole.waveforms,
+            atol=1e-3)
+
+    def test_no_spikes(self):
+        noise = np.random.RandomState(0).normal(size=50000).astype(np.float32) * 20
+        dataset = detect_spikes(noise, self.sample_rate, threshold=200.0, chunk_duration=1.0)
+        self.assertEqual(len(dataset), 0)
+        self.assertEqual(dataset.waveforms.shape, (0, 30))
+        self.assertEqual(dataset.sample_rate, self.sample_rate)
+
+        # Shorter than a chunk, and empty
+        for data in (noise[:1000], noise[:0]):
+            dataset = detect_spikes(
+                data, self.sample_rate, chunk_duration=1.0, n_before=5, n_after=15)
+            self.assertEqual(dataset.waveforms.shape, (0, 20))
+
+    def test_dc_offset(self):
+        noise = np.random.RandomState(0).normal(size=50000).astype(np.float32) * 20
+        dataset = detect_spikes(noise + 800, self.sample_rate, threshold=100.0, chunk_duration=1.0)
+        self.assertEqual(len(dataset), 0)
@@ -0,0 +1,55 @@
+import os
+import tempfile
+import unittest
+
+import numpy as np
+from numpy.testing import assert_array_almost_equal
+from sklearn.decomposition import PCA
+
+from suss.core import SpikeDataset
+from suss.features import FeatureBasis, project
+
+
+class TestFeatureBasis(unittest.TestCase):
+
+    def setUp(self):
+        scales = np.concatenate([[10.0, 5.0, 2.5], 0.1 * np.ones(17)])
+        self.waveforms = np.random.normal(size=(2000, 20)) * scales
+        self.dataset = SpikeDataset(
+            times=np.arange(2000) / 100.0,
+            waveforms=self.waveforms
+        )
+
+    def test_fit_matches_pca(self):
+        basis = FeatureBasis.fit(self.dataset, n_components=3, chunk_size=500)
+        pca = PCA(n_components=3).fit(self.waveforms)
+        assert_array_almost_equal(
+                np.abs(basis.components),
+                np.abs(pca.components_),
+                decimal=1
+        )
+
+    def test_save_load(self):
+        basis = FeatureBasis.fit(self.dataset, n_components=3)
+        with tempfile.TemporaryDirectory() as tmp:
+            filename = os.path.join(tmp, "basis.npz")
+            basis.save(filename)
+            loaded = FeatureBasis.load(filename)
+        assert_array_almost_equal(
+                loaded.transform(self.waveforms),
+                basis.transform(self.waveforms)
+        )
+
+    def test_shared_by_derived_datasets(self):
+        labels = (self.dataset.times > 10.0).astype(int)
+        clustered = self.dataset.cluster(labels)
+        self.assertIsNone(clustered.feature_basis)
+
+        basis = FeatureBasis.fit(self.dataset, n_components=3)
+        clustered.feature_basis = basis
+        self.assertIs(self.dataset.feature_basis, basis)
+        self.assertIs(clustered.nodes[1].feature_basis, basis)
+        assert_array_almost_equal(
+                project(clustered.nodes[0], 2),
+                basis.transform(clustered.nodes[0].waveforms, n_components=2)
+        )
@@ -0,0 +1,44 @@
+import unittest
+
+import numpy as np
+from numpy.testing import assert_array_equal
+
+from suss.core import SpikeDataset
+from suss.journal import CurationJournal
+
+
+class TestCurationJournal(unittest.TestCase):
+
+    def setUp(self):
+        self.spikes = SpikeDataset(
+            times=np.arange(100.0),
+            waveforms=np.random.normal(size=(100, 4))
+        )
+        self.truth = np.repeat([0, 1, 2, 3, 4], 20)
+        self.clusters = self.spikes.cluster(self.truth)
+
+    def test_replay(self):
+        journal = CurationJournal(len(self.spikes))
+        journal.record(self.clusters, "merge", [0, 1])
+        journal.record(self.clusters, "delete", [4])
+
+        # A new sort with different labels and a few spikes moved
+        new_labels = np.array([7, 3, 5, 2, 9])[self.truth]
+        new_labels[[0, 25, 50]] = 9
+        resorted = self.spikes.cluster(new_labels)
+
+        curated, skipped = journal.replay(resorted)
+        self.assertEqual(skipped, [])
+        self.assertEqual(len(curated), 3)
+        merged = curated.nodes[curated.label_index[10][0]]
+        assert_array_equal(merged.ids, np.delete(np.arange(1, 40), 24))
+        self.assertNotIn(9, curated.labels)
+
+    def test_replay_unmatched(self):
+        journal = CurationJournal(len(self.spikes))
+        journal.record(self.clusters, "merge", [0, 1])
+        resorted = self.spikes.cluster(np.arange(100) // 5)
+
+        curated, skipped = journal.replay(resorted)
+        self.assertEqual(len(skipped), 1)
+        self.assertEqual(len(curated), 20)
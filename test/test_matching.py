@@ -0,0 +1,72 @@
+import unittest
+
+import numpy as np
+from numpy.testing import assert_array_equal
+
+from suss.core import SpikeDataset
+from suss.gui.tags import ClusterTag
+from suss.matching import TemplateIndex
+
+
+class TestTemplateIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.templates = np.random.normal(size=(5, 20)) * 50
+        self.sessions = []
+        self.permutations = []
+        for session in range(4):
+            labels = np.random.randint(0, 5, 1000)
+            # Templates drift slowly and labels differ between sessions
+            waveforms = (
+                self.templates[labels] + 2.0 * session +
+                np.random.normal(size=(1000, 20)) * 5
+            )
+            permutation = np.random.permutation(5)
+            dataset = SpikeDataset(
+                times=np.sort(np.random.uniform(0, 100, 1000)),
+                waveforms=waveforms
+            ).cluster(permutation[labels])
+            self.sessions.append(dataset)
+            self.permutations.append(permutation)
+
+    def true_units(self, index):
+        return np.array([
+            list(self.permutations[session]).index(label)
+            for session, label in zip(index.sessions, index.labels)
+        ])
+
+    def test_from_datasets(self):
+        index = TemplateIndex.from_datasets(self.sessions)
+        self.assertEqual(len(index), 20)
+        self.assertEqual(index.centroids.shape, (20, 20))
+        assert_array_equal(index.sessions, np.repeat(np.arange(4), 5))
+        self.assertTrue(np.all(index.firing_rates > 0))
+
+    def test_exclude_tags(self):
+        self.sessions[0].nodes[0].add_tag(ClusterTag.NOISY)
+        index = TemplateIndex.from_datasets(
+            self.sessions, exclude_tags=[ClusterTag.NOISY])
+        self.assertEqual(len(index), 19)
+        self.assertEqual(len(index.units(0)), 4)
+
+    def test_match_sessions(self):
+        index = TemplateIndex.from_datasets(self.sessions)
+        matches = index.match_sessions(0, 1)
+        self.assertEqual(len(matches), 5)
+        for label_0, label_1, _ in matches:
+            self.assertEqual(
+                list(self.permutations[0]).index(label_0),
+                list(self.permutations[1]).index(label_1))
+
+    def test_track(self):
+        index = TemplateIndex.from_datasets(self.sessions)
+        tracks = index.track()
+        true_units = self.true_units(index)
+        self.assertEqual(len(np.unique(tracks)), 5)
+        for track in np.unique(tracks):
+            self.assertEqual(len(np.unique(true_units[tracks == track])), 1)
+
+    def test_track_unmatched(self):
+        index = TemplateIndex.from_datasets(self.sessions)
+        tracks = index.track(max_distance=0.0)
+        assert_array_equal(tracks, np.arange(20))
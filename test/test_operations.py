@@ -0,0 +1,245 @@
+import unittest
+from unittest import mock
+
+import numpy as np
+from numpy.testing import assert_array_equal
+from sklearn.mixture import BayesianGaussianMixture
+
+from suss.core import SpikeDataset
+from suss.operations import (
+    CleanupCache,
+    apply_operations,
+    cleanup_cluster_assignments,
+    cleanup_node,
+    delete_nodes,
+    fast_recluster_node,
+    match_one,
+    match_several,
+    merge_nodes,
+    suggest_merges
+)
+
+
+class TestOperations(unittest.TestCase):
+
+    def setUp(self):
+        self.spikes = SpikeDataset(
+            times=np.arange(20.0),
+            waveforms=np.random.normal(size=(20, 4))
+        )
+        self.clusters = self.spikes.cluster(np.repeat([0, 1, 2, 3], 5))
+
+    def test_match_one(self):
+        assert_array_equal(
+                match_one(self.clusters, label=2),
+                [False, False, True, False])
+        assert_array_equal(
+                match_one(self.clusters, node=self.clusters.nodes[1]),
+                [False, True, False, False])
+        with self.assertRaises(ValueError):
+            match_one(self.clusters, label=5)
+
+    def test_match_several(self):
+        assert_array_equal(
+                match_several(self.clusters, labels=[0, 3, 5]),
+                [True, False, False, True])
+        assert_array_equal(
+                match_several(self.clusters, nodes=self.clusters.nodes[1:3]),
+                [False, True, True, False])
+
+    def test_merge_and_delete(self):
+        merged = merge_nodes(self.clusters, labels=[1, 2])
+        self.assertEqual(sorted(merged.labels), [0, 3, 4])
+        self.assertEqual(merged.count, 20)
+        assert_array_equal(
+                merged.nodes[merged.label_index[4][0]].times,
+                np.arange(5.0, 15.0))
+
+        deleted = delete_nodes(merged, labels=[0, 4])
+        assert_array_equal(deleted.labels, [3])
+        self.assertIs(deleted.nodes[0], self.clusters.nodes[3])
+
+    def test_apply_operations(self):
+        operations = [
+            ("merge", dict(labels=[0, 1])),
+            ("cleanup", dict(label=4)),
+            ("delete", dict(labels=[2, 5])),
+            ("merge", dict(labels=[3, 6])),
+        ]
+        batched, changed = apply_operations(self.clusters, operations)
+
+        expected = merge_nodes(self.clusters, labels=[0, 1])
+        expected = cleanup_node(expected, label=4)
+        expected = delete_nodes(expected, labels=[2, 5])
+        expected = merge_nodes(expected, labels=[3, 6])
+
+        assert_array_equal(batched.labels, expected.labels)
+        for node, expected_node in zip(batched.nodes, expected.nodes):
+            assert_array_equal(node.ids, expected_node.ids)
+        self.assertEqual(changed, set([0, 1, 2, 3]).union(expected.labels))
+
+    def test_apply_operations_unknown(self):
+        with self.assertRaises(ValueError):
+            apply_operations(self.clusters, [("split", dict(label=0))])
+
+    def test_suggest_merges(self):
+        # A regular neuron split in two alternating clusters, and another
+        # neuron with a different waveform firing independently
+        times = np.concatenate([np.arange(0, 100, 0.01), np.random.uniform(0, 100, 5000)])
+        labels = np.concatenate([np.arange(10000) % 2, 2 * np.ones(5000)])
+        templates = np.array([[1.0, 0, 0], [1.0, 0, 0], [0, 1.0, 0]])
+        order = np.argsort(times, kind="stable")
+        spikes = SpikeDataset(
+            times=times[order],
+            waveforms=templates[labels[order].astype(int)] + 0.1 * np.random.normal(size=(15000, 3))
+        )
+        clusters = spikes.cluster(labels[order])
+
+        candidates = suggest_merges(clusters, n_candidates=None)
+        self.assertEqual(len(candidates), 3)
+        self.assertEqual(
+                set([candidates[0]["label_a"], candidates[0]["label_b"]]),
+                set([0, 1]))
+        self.assertEqual(candidates[0]["refractory_ratio"], 0)
+        self.assertGreater(candidates[1]["template_distance"], 5)
+
+    def test_suggest_merges_overlap(self):
+        # Two pairs of clusters with the same waveforms, one pair firing
+        # together and the other one after the other
+        noise = 0.1 * np.random.normal(size=(2, 2500, 3))
+        times = np.concatenate([
+            np.arange(0, 100, 0.04),
+            np.arange(0.02, 100, 0.04),
+            np.arange(0.005, 50, 0.02),
+            np.arange(50.005, 100, 0.02)
+        ])
+        waveforms = np.concatenate([
+            noise[0],
+            noise[1],
+            noise[0] + [0, 0, 5.0],
+            noise[1] + [0, 0, 5.0]
+        ])
+        labels = np.repeat([0, 1, 2, 3], 2500)
+        order = np.argsort(times, kind="stable")
+        spikes = SpikeDataset(times=times[order], waveforms=waveforms[order])
+        clusters = spikes.cluster(labels[order])
+
+        candidates = suggest_merges(clusters, n_candidates=2, bin_size=10.0)
+        self.assertEqual(
+                [set(pair) for pair in candidates[["label_a", "label_b"]].tolist()],
+                [set([0, 1]), set([2, 3])])
+        self.assertAlmostEqual(
+                candidates[0]["template_distance"],
+                candidates[1]["template_distance"])
+        self.assertEqual(candidates[1]["temporal_overlap"], 0)
+        self.assertLess(candidates[0]["score"], candidates[1]["score"])
+
+    def test_fast_recluster_node(self):
+        templates = np.array([[5.0, 0, 0, 0], [0, 0, 5.0, 0]])
+        which = np.random.randint(0, 2, 5000)
+        spikes = SpikeDataset(
+            times=np.linspace(0, 100, 5000),
+            waveforms=templates[which] + np.random.normal(size=(5000, 4))
+        )
+        clusters = spikes.cluster(np.zeros(5000))
+
+        reclustered = fast_recluster_node(
+            clusters,
+            label=0,
+            n_clusters=2,
+            max_points=500,
+            time_budget=5.0)
+        self.assertEqual(len(reclustered), 2)
+        for node in reclustered.nodes:
+            counts = np.bincount(which[node.ids], minlength=2)
+            self.assertGreater(np.max(counts) / np.sum(counts), 0.99)
+
+    def test_fast_recluster_budget(self):
+        spikes = SpikeDataset(
+            times=np.linspace(0, 100, 3000),
+            waveforms=np.random.RandomState(0).normal(size=(3000, 4))
+        )
+        clusters = spikes.cluster(np.zeros(3000))
+
+        fit = BayesianGaussianMixture.fit
+        with mock.patch.object(
+                BayesianGaussianMixture, "fit", autospec=True, side_effect=fit) as spy:
+            # The budget is used up before the mixture is fit, so only the
+            # first round of iterations is run
+            reclustered = fast_recluster_node(
+                clusters, label=0, n_clusters=3, max_points=500, time_budget=0.0)
+        self.assertEqual(spy.call_count, 1)
+        self.assertEqual(sum(len(node) for node in reclustered.nodes), 3000)
+
+    def test_incremental_cleanup(self):
+        # Well separated clusters with a tenth of the points mislabeled
+        truth = np.random.randint(0, 4, 2000)
+        labels = truth.copy()
+        labels[::10] = np.random.randint(0, 4, 200)
+        spikes = SpikeDataset(
+            times=np.linspace(0, 100, 2000),
+            waveforms=10 * np.eye(6)[truth] + np.random.normal(size=(2000, 6))
+        )
+        clusters = spikes.cluster(labels)
+
+        expected = cleanup_cluster_assignments(clusters)
+        cache = CleanupCache()
+        cleaned = cleanup_cluster_assignments(clusters, cache=cache)
+        assert_array_equal(cleaned.labels, expected.labels)
+        for node, expected_node in zip(cleaned.nodes, expected.nodes):
+            assert_array_equal(node.ids, expected_node.ids)
+        assert_array_equal(cleaned.flatten().labels, expected.flatten().labels)
+
+        # Converges when repeated; a converged dataset is left unchanged
+        converged = cleanup_cluster_assignments(clusters, cache=cache, max_passes=50)
+        again = cleanup_cluster_assignments(converged, cache=cache)
+        self.assertEqual(list(again.nodes), list(converged.nodes))
+        flat = converged.flatten()
+        self.assertGreater(np.mean(flat.labels == truth[flat.ids]), 0.98)
+
+    def test_cleanup_unchanged_clusters(self):
+        # Cluster 5 is far from the others and has no mislabeled points
+        truth = np.random.RandomState(0).randint(0, 3, 1500)
+        labels = truth.copy()
+        labels[:300:10] = (labels[:300:10] + 1) % 2
+        truth[1200:] = labels[1200:] = 5
+        waveforms = 10 * np.eye(6)[truth] + np.random.RandomState(1).normal(size=(1500, 6))
+        spikes = SpikeDataset(times=np.linspace(0, 100, 1500), waveforms=waveforms)
+        clusters = spikes.cluster(labels)
+
+        for cache in (None, CleanupCache()):
+            cleaned = cleanup_cluster_assignments(clusters, cache=cache)
+            self.assertIn(clusters.nodes[clusters.labels == 5][0], list(cleaned.nodes))
+
+    def test_cleanup_duplicate_labels(self):
+        # Two nodes share label 1; flatten() labels their points by position
+        which = np.random.RandomState(0).randint(0, 3, 1500)
+        waveforms = 10 * np.eye(6)[which] + np.random.RandomState(1).normal(size=(1500, 6))
+        spikes = SpikeDataset(times=np.linspace(0, 100, 1500), waveforms=waveforms)
+        clusters = spikes.cluster(which)
+        labels = np.array([7, 1, 1])
+        duplicate = clusters.derive(
+            remove=np.ones(3, dtype=bool),
+            nodes=list(clusters.nodes),
+            labels=labels[clusters.labels])
+
+        for cache in (None, CleanupCache()):
+            cleaned = cleanup_cluster_assignments(duplicate, cache=cache)
+            self.assertEqual(sorted(cleaned.labels), [1, 1, 7])
+            for node, label in zip(cleaned.nodes, cleaned.labels):
+                counts = np.bincount(which[node.ids], minlength=3)
+                self.assertEqual(label, labels[np.argmax(counts)])
+                self.assertGreater(np.max(counts) / np.sum(counts), 0.99)
+
+    def test_cleanup_cache_refit(self):
+        spikes = SpikeDataset(
+            times=np.linspace(0, 100, 500),
+            waveforms=np.random.normal(size=(500, 6)))
+        clusters = spikes.cluster(np.random.randint(0, 2, 500))
+        cache = CleanupCache()
+        cleanup_cluster_assignments(clusters, cache=cache)
+        neighbors = cache.neighbors
+        cleanup_cluster_assignments(clusters, cache=cache)
+        self.assertIs(cache.neighbors, neighbors)
+        cleanup_cluster_assignments(clusters, cache=cache, refit=True)
+        self.assertIsNot(cache.neighbors, neighbors)
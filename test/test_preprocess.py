@@ -0,0 +1,54 @@
+import unittest
+
+import numpy as np
+
+from suss.core import SpikeDataset
+from suss.preprocess import find_extrema, realign, realign_waveforms, shift_waveforms
+
+
+class TestRealign(unittest.TestCase):
+
+    def setUp(self):
+        self.samples = np.arange(30)
+        self.true_shifts = np.random.uniform(-2, 2, 500)
+        self.waveforms = self.spikes(15 + self.true_shifts)
+
+    def spikes(self, peaks):
+        return (
+            -100 * np.exp(-((self.samples[None, :] - peaks[:, None]) / 2.0) ** 2) +
+            30 * np.exp(-((self.samples[None, :] - peaks[:, None] - 6) / 3.0) ** 2)
+        )
+
+    def test_shift_waveforms(self):
+        shifted = shift_waveforms(self.waveforms, self.true_shifts)
+        np.testing.assert_allclose(
+            shifted[:, 5:25],
+            self.spikes(15 * np.ones(500))[:, 5:25],
+            atol=2.0)
+
+        integer = shift_waveforms(self.waveforms, np.ones(500))
+        np.testing.assert_allclose(integer[:, :-1], self.waveforms[:, 1:])
+
+    def test_find_extrema(self):
+        peaks = find_extrema(self.waveforms, 15, 3)
+        np.testing.assert_allclose(peaks, 15 + self.true_shifts, atol=0.2)
+        np.testing.assert_allclose(
+            find_extrema(-self.waveforms, 15, 3, sign="pos"), peaks)
+
+    def test_realign_waveforms(self):
+        aligned, shifts = realign_waveforms(self.waveforms, chunk_size=64)
+        np.testing.assert_allclose(shifts, self.true_shifts, atol=0.2)
+        self.assertTrue(np.all(np.argmin(aligned, axis=1) == 15))
+        self.assertLess(
+            np.mean(np.std(aligned, axis=0)),
+            0.2 * np.mean(np.std(self.waveforms, axis=0)))
+
+    def test_realign(self):
+        dataset = SpikeDataset(
+            times=np.linspace(0, 10, 500),
+            waveforms=self.waveforms,
+            sample_rate=30000.0)
+        realigned = realign(dataset)
+        np.testing.assert_array_equal(realigned.times, dataset.times)
+        self.assertEqual(realigned.sample_rate, 30000.0)
+        self.assertTrue(np.all(np.argmin(realigned.waveforms, axis=1) == 15))
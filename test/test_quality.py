@@ -0,0 +1,62 @@
+import unittest
+
+import numpy as np
+from numpy.testing import assert_allclose, assert_array_equal
+
+from suss.core import SpikeDataset
+from suss.quality import cluster_quality_table, mahalanobis_distances, quality_row
+
+
+class TestQuality(unittest.TestCase):
+
+    def setUp(self):
+        random = np.random.RandomState(0)
+        n = 3000
+        labels = np.repeat([1, 4, 9], n // 3)
+        # Clusters 1 and 4 overlap, cluster 9 is far from both
+        centers = np.zeros((10, 12))
+        centers[4, 0] = 2.0
+        centers[9, 0] = 40.0
+        waveforms = centers[labels] + random.normal(size=(n, 12))
+        order = random.permutation(n)
+        self.dataset = SpikeDataset(
+            times=np.linspace(0, 100, n),
+            waveforms=waveforms[order]
+        ).cluster(labels[order])
+
+    def test_mahalanobis_distances(self):
+        cluster = np.random.RandomState(0).normal(size=(50000, 3)) * np.array([1.0, 2.0, 4.0])
+        points = np.array([[1.0, 0, 0], [0, 2.0, 0], [0, 0, 8.0]])
+        distances = mahalanobis_distances(points, cluster)
+        np.testing.assert_allclose(distances, [1.0, 1.0, 4.0], rtol=0.1)
+
+    def test_cluster_quality_table(self):
+        table = cluster_quality_table(self.dataset, n_components=4, refit=True)
+        assert_array_equal(table["label"], [1, 4, 9])
+        assert_array_equal(table["count"], [1000, 1000, 1000])
+
+        isolated = quality_row(table, 9)
+        overlapping = quality_row(table, 1)
+        self.assertGreater(
+            isolated["isolation_distance"], overlapping["isolation_distance"])
+        self.assertLess(isolated["l_ratio"], overlapping["l_ratio"])
+        self.assertGreater(isolated["knn_purity"], 0.99)
+        self.assertLess(overlapping["knn_purity"], 0.99)
+        self.assertGreater(isolated["silhouette"], overlapping["silhouette"])
+        self.assertIsNone(quality_row(table, 2))
+
+    def test_cluster_quality_table_subsampled(self):
+        table = cluster_quality_table(
+            self.dataset, n_components=4, max_points=600, knn_points=100,
+            silhouette_points=100, refit=True)
+        assert_array_equal(table["count"], [1000, 1000, 1000])
+        self.assertFalse(np.any(np.isnan(table["isolation_distance"])))
+
+    def test_cluster_quality_table_labels(self):
+        table = cluster_quality_table(self.dataset, n_components=4, refit=True)
+        partial = cluster_quality_table(
+            self.dataset, n_components=4, refit=True, labels=[9])
+        assert_array_equal(partial["count"], table["count"])
+        for column in ("isolation_distance", "l_ratio", "knn_purity"):
+            assert_allclose(quality_row(partial, 9)[column], quality_row(table, 9)[column])
+            self.assertTrue(np.isnan(quality_row(partial, 1)[column]))
@@ -0,0 +1,67 @@
+import unittest
+
+import numpy as np
+from numpy.testing import assert_array_equal
+
+from suss.core import SpikeDataset
+from suss.sort import propagate_labels, stratified_subsample, subsample_cluster
+
+
+class TestSubsampling(unittest.TestCase):
+
+    def setUp(self):
+        self.times = np.linspace(0.0, 100.0, 1000)
+        self.waveforms = np.zeros((1000, 4))
+        self.dataset = SpikeDataset(times=self.times, waveforms=self.waveforms)
+
+    def test_stratified_subsample(self):
+        idx = stratified_subsample(self.dataset, 100, n_strata=10)
+        self.assertEqual(len(idx), 100)
+        self.assertEqual(len(np.unique(idx)), 100)
+        assert_array_equal(
+                np.histogram(self.dataset.times[idx], bins=10, range=(0, 100))[0],
+                10 * np.ones(10)
+        )
+
+    def test_stratified_subsample_too_small(self):
+        idx = stratified_subsample(self.dataset, 5000)
+        assert_array_equal(idx, np.arange(1000))
+
+    def test_propagate_labels(self):
+        features = np.concatenate([
+            np.zeros((50, 2)),
+            10 * np.ones((50, 2))
+        ]) + np.random.normal(size=(100, 2))
+        sample_idx = np.array([0, 1, 2, 50, 51, 52])
+        labels = propagate_labels(
+                features,
+                sample_idx,
+                np.array([3, 3, 3, 7, 7, 7]),
+                n_neighbors=3)
+        assert_array_equal(labels[:50], 3 * np.ones(50))
+        assert_array_equal(labels[50:], 7 * np.ones(50))
+
+    def test_subsample_cluster_agreement(self):
+        waveforms = np.zeros((1000, 4))
+        waveforms[::2] = 10.0
+        waveforms += np.random.normal(size=waveforms.shape)
+        dataset = SpikeDataset(times=self.times, waveforms=waveforms)
+
+        def cluster_fn(subset):
+            return (subset.waveforms[:, 0] > 5.0).astype(int)
+
+        labels, agreement = subsample_cluster(
+                dataset,
+                cluster_fn,
+                max_points=200,
+                validation_size=100,
+                return_agreement=True)
+        assert_array_equal(labels, cluster_fn(dataset))
+        self.assertAlmostEqual(agreement, 1.0)
+
+        labels, agreement = subsample_cluster(
+                dataset,
+                cluster_fn,
+                max_points=200,
+                return_agreement=True)
+        self.assertIsNone(agreement)
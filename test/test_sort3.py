@@ -0,0 +1,343 @@
+import unittest
+from unittest import mock
+
+import numpy as np
+from numpy.testing import assert_allclose, assert_array_equal
+
+import suss.sort3
+from suss.core import ClusterDataset, SpikeDataset
+from suss.features import FeatureBasis
+from suss.preprocess import realign
+from suss.sort3 import (
+    TrackingKMeans,
+    _sort_shard,
+    cluster_step,
+    link_appended,
+    sharded_sort,
+    sort_appended,
+    stitch_shards,
+    time_shards
+)
+
+
+class TestShards(unittest.TestCase):
+
+    def setUp(self):
+        self.times = np.linspace(0.0, 300.0, 3000)
+        self.labels = np.arange(3000) % 3
+        templates = np.array([
+            np.linspace(-1, 1, 10),
+            np.linspace(1, -1, 10),
+            np.ones(10)
+        ]) * 10.0
+        self.waveforms = (
+            templates[self.labels] +
+            np.random.normal(size=(3000, 10))
+        )
+
+    def test_time_shards(self):
+        shards = time_shards(self.times, 100.0, 10.0)
+        self.assertEqual(len(shards), 3)
+        assert_array_equal(
+                np.concatenate([core for core, _ in shards]),
+                np.arange(3000)
+        )
+        for core, extended in shards:
+            self.assertTrue(np.all(np.isin(core, extended)))
+        self.assertTrue(self.times[shards[1][1][0]] < 100.0 - 9.0)
+
+    def test_empty(self):
+        self.assertEqual(time_shards(np.zeros(0), 100.0, 10.0), [])
+        dataset = SpikeDataset(times=np.zeros(0), waveforms=np.zeros((0, 10)))
+        result = sharded_sort(dataset, shard_duration=100.0, overlap=10.0)
+        self.assertIsInstance(result, ClusterDataset)
+        self.assertEqual(len(result), 0)
+
+    def test_stitch_shards(self):
+        shards = time_shards(self.times, 100.0, 10.0)
+        # Each shard labels the same units with different labels
+        shard_labels = [
+            ((self.labels[extended] + k) % 3) + 5 * k
+            for k, (_, extended) in enumerate(shards)
+        ]
+        stitched = stitch_shards(self.waveforms, shards, shard_labels)
+        self.assertEqual(len(np.unique(stitched)), 3)
+        for label in range(3):
+            self.assertEqual(len(np.unique(stitched[self.labels == label])), 1)
+
+
+    def test_gap(self):
+        # No spikes between 100s and 500s; shards in the gap are empty
+        times = np.concatenate([self.times[:1000], self.times[:1000] + 500.0])
+        waveforms = np.concatenate([self.waveforms[:1000], self.waveforms[:1000]])
+        labels = np.concatenate([self.labels[:1000], self.labels[:1000]])
+        shards = time_shards(times, 100.0, 10.0)
+        self.assertEqual(len(shards[2][1]), 0)
+
+        shard_labels = []
+        for core, extended in shards:
+            if len(extended) < 100:
+                shard_labels.append(_sort_shard(
+                    times[extended], waveforms[extended], None, None, {}, min_size=100))
+            else:
+                shard_labels.append(labels[extended])
+        self.assertEqual(len(shard_labels[2]), 0)
+
+        # Nothing overlaps across the gap to link clusters through
+        stitched = stitch_shards(waveforms, shards, shard_labels)
+        for side in (slice(0, 1000), slice(1000, 2000)):
+            self.assertEqual(len(np.unique(stitched[side])), 3)
+            for label in range(3):
+                self.assertEqual(len(np.unique(stitched[side][labels[side] == label])), 1)
+
+    def test_sort_shard_no_result(self):
+        with mock.patch("suss.sort3.sort", return_value=iter([])):
+            labels = _sort_shard(self.times, self.waveforms, None, None, {}, min_size=10)
+        assert_array_equal(labels, -np.ones(3000))
+
+
+class TestTracking(unittest.TestCase):
+
+    def setUp(self):
+        self.random = np.random.RandomState(0)
+        self.centers = np.array([[0.0, 0.0], [20.0, 0.0], [0.0, 20.0]])
+
+    def window(self, centers, n=300):
+        """Points around centers, shuffled, and the center of each point"""
+        which = self.random.randint(0, len(centers), n)
+        return centers[which] + self.random.normal(size=(n, 2)), which
+
+    def test_warm_start(self):
+        tracker = TrackingKMeans(n_clusters=3, max_iter=5)
+        tracker.fit_window(self.window(self.centers)[0])
+        previous = tracker.centroids.copy()
+
+        with mock.patch("suss.sort3.KMeans", wraps=suss.sort3.KMeans) as spy:
+            tracker.fit_window(self.window(self.centers + 0.5)[0])
+        _, kwargs = spy.call_args
+        assert_array_equal(kwargs["init"], previous)
+        self.assertEqual(kwargs["n_init"], 1)
+        self.assertEqual(kwargs["max_iter"], 5)
+
+    def test_drifting_unit(self):
+        tracker = TrackingKMeans(n_clusters=3)
+        tracks = []
+        for step in range(6):
+            # Unit 1 drifts further than its spread over the windows
+            centers = self.centers + np.array([[0, 0], [0, 1.0 * step], [0, 0]])
+            data, which = self.window(centers)
+            labels = tracker.fit_window(data)
+            track_of_unit = [
+                np.bincount(tracker.track_ids[labels[which == unit]]).argmax()
+                for unit in range(3)
+            ]
+            self.assertEqual(len(set(track_of_unit)), 3)
+            tracks.append(track_of_unit)
+        self.assertEqual(tracks, [tracks[0]] * 6)
+        self.assertEqual(tracker.next_track, 3)
+
+    def test_new_and_retired_tracks(self):
+        tracker = TrackingKMeans(n_clusters=2, first_track=10)
+        data, which = self.window(self.centers[:2])
+        labels = tracker.fit_window(data)
+        first = tracker.track_ids[labels[which == 0][0]]
+        self.assertEqual(sorted(tracker.track_ids), [10, 11])
+
+        # Unit 1 stops firing and a unit far from both starts
+        data, which = self.window(np.array([[0.0, 0.0], [-40.0, -40.0]]))
+        labels = tracker.fit_window(data)
+        self.assertEqual(tracker.track_ids[labels[which == 0][0]], first)
+        self.assertEqual(tracker.track_ids[labels[which == 1][0]], 12)
+        self.assertEqual(tracker.next_track, 13)
+
+    def make_dataset(self, n=3000):
+        templates = self.random.normal(size=(3, 20)) * 10
+        which = self.random.randint(0, 3, n)
+        drift = np.linspace(0, 1, n)[:, None] * templates[0] * 0.05
+        dataset = SpikeDataset(
+            times=np.linspace(0, 300, n),
+            waveforms=templates[which] + drift + self.random.normal(size=(n, 20)))
+        return dataset, which
+
+    def test_cluster_step_tracks(self):
+        dataset, which = self.make_dataset()
+        labels, tracks = cluster_step(
+            dataset, dpoints=1000, n_components=3, mode="track", levels=1,
+            return_tracks=True)
+        self.assertEqual(len(tracks), len(dataset))
+        for unit in range(3):
+            unit_tracks = tracks[which == unit]
+            self.assertGreater(
+                np.mean(unit_tracks == np.bincount(unit_tracks + 1).argmax() - 1), 0.99)
+        self.assertEqual(len(np.unique(tracks[tracks >= 0])), 3)
+        # Labels are per window, tracks span windows
+        self.assertGreater(len(np.unique(labels[labels >= 0])), 3)
+
+    def test_cluster_step_refit(self):
+        dataset, which = self.make_dataset()
+        dataset.feature_basis = FeatureBasis.fit(dataset, n_components=6)
+        with mock.patch.object(
+                FeatureBasis, "from_pca", wraps=FeatureBasis.from_pca) as spy:
+            cluster_step(dataset, dpoints=1000, n_components=3, mode="track", levels=1)
+            self.assertEqual(spy.call_count, 0)
+            labels, tracks = cluster_step(
+                dataset, dpoints=1000, n_components=3, mode="track", levels=1,
+                return_tracks=True, refit=True)
+            self.assertEqual(spy.call_count, 1)
+        self.assertEqual(len(np.unique(tracks[tracks >= 0])), 3)
+
+
+class TestAppended(unittest.TestCase):
+
+    def setUp(self):
+        self.times = np.linspace(0.0, 300.0, 3000)
+        self.labels = np.arange(3000) % 3
+        # A fourth unit only fires before the appended segment
+        self.labels[:500:10] = 3
+        templates = np.array([
+            np.linspace(-1, 1, 10),
+            np.linspace(1, -1, 10),
+            np.ones(10),
+            -np.ones(10)
+        ]) * 10.0
+        self.waveforms = templates[self.labels] + np.random.normal(size=(3000, 10))
+        self.dataset = SpikeDataset(times=self.times, waveforms=self.waveforms)
+        self.previous_recording = SpikeDataset(
+            times=self.times[:2000],
+            waveforms=self.waveforms[:2000])
+
+        # The segment sort relabels the units, and finds a new cluster
+        self.segment_labels = (self.labels[1800:] + 1) % 3 + 10
+        self.segment_labels[-200:][self.labels[-200:] == 2] = 20
+
+    def hierarchy(self, dataset, labels):
+        """Clusters of small clusters of labels, as produced by sort()"""
+        unique_labels, idx = np.unique(labels, return_inverse=True)
+        windows = np.arange(len(dataset)) // 50
+        small_clusters = dataset.cluster(len(unique_labels) * windows + idx)
+        return small_clusters.cluster(
+            unique_labels[small_clusters.labels % len(unique_labels)])
+
+    def fake_sort(self, dataset, **kwargs):
+        """Sorts like the segment sort of setUp, from the true units"""
+        self.sort_kwargs = kwargs
+        units = self.labels[np.searchsorted(self.times, dataset.times)]
+        labels = (units + 1) % 3 + 10
+        labels[(units == 2) & (dataset.times >= self.times[2800])] = 20
+        yield self.hierarchy(dataset, labels)
+
+    def check_levels(self, result, recording=None):
+        """Every level of the hierarchy has a single source"""
+        level = list(result.nodes)
+        while len(level) and level[0].has_children:
+            self.assertEqual(len(set(id(node.source) for node in level)), 1)
+            level = [child for node in level for child in node.nodes]
+        self.assertEqual(len(set(id(node.source) for node in level)), 1)
+        self.assertIs(level[0].source, recording or self.dataset)
+
+    def check_result(self, previous, result):
+        flat = result.flatten()
+        self.assertEqual(flat.count, 3000)
+        self.assertEqual(len(result), 5)
+        new_cluster = np.arange(2800, 3000)[self.labels[2800:] == 2]
+        for label in np.unique(flat.labels):
+            ids = flat.ids[flat.labels == label]
+            self.assertEqual(len(np.unique(self.labels[ids])), 1)
+            if np.any(np.isin(ids, new_cluster)):
+                assert_array_equal(ids, new_cluster)
+                self.assertNotIn(label, previous.labels)
+            else:
+                self.assertIn(label, previous.labels)
+
+    def test_link_appended(self):
+        previous = self.previous_recording.cluster(self.labels[:2000] + 1)
+        result = link_appended(previous, self.dataset, 1800, self.segment_labels)
+        self.check_result(previous, result)
+
+        # The cluster that gained no spikes is left as it was
+        old_node = previous.nodes[previous.label_index[4][0]]
+        node = result.nodes[result.label_index[4][0]]
+        self.assertIs(node._data, old_node._data)
+        self.assertIs(node.source, self.dataset)
+        self.assertEqual(len(previous.flatten()), 2000)
+
+    def test_link_appended_hierarchy(self):
+        previous = self.hierarchy(self.previous_recording, self.labels[:2000] + 1)
+        result = link_appended(previous, self.dataset, 1800, self.segment_labels)
+        self.check_result(previous, result)
+        self.check_levels(result)
+        self.assertEqual(result.flatten(1).count, 3000)
+
+        node = result.nodes[result.label_index[1][0]]
+        old_node = previous.nodes[previous.label_index[1][0]]
+        self.assertEqual(len(node.nodes), len(old_node.nodes) + 1)
+
+    def test_sort_appended(self):
+        previous = self.hierarchy(self.previous_recording, self.labels[:2000] + 1)
+        labels = previous.labels.copy()
+        nodes = [
+            (node, node.source, node.flatten().ids.copy(), list(node.nodes))
+            for node in previous.nodes
+        ]
+        with mock.patch("suss.sort3.sort", self.fake_sort):
+            result = sort_appended(previous, self.dataset, overlap=20.0)
+        self.check_result(previous, result)
+        self.check_levels(result)
+
+        # The previous sort is left as it was
+        assert_array_equal(previous.labels, labels)
+        self.assertIs(previous.recording, self.previous_recording)
+        for (node, source, ids, children), current in zip(nodes, previous.nodes):
+            self.assertIs(current, node)
+            self.assertIs(node.source, source)
+            assert_array_equal(node.flatten().ids, ids)
+            self.assertEqual(len(node.nodes), len(children))
+            for child, old_child in zip(node.nodes, children):
+                self.assertIs(child, old_child)
+                self.assertIs(child.source, self.previous_recording)
+
+        # The cluster that gained no spikes has the same spikes
+        node = result.nodes[result.label_index[4][0]]
+        old_node = previous.nodes[previous.label_index[4][0]]
+        assert_array_equal(node.flatten().ids, old_node.flatten().ids)
+
+    def test_sort_appended_small(self):
+        previous = self.hierarchy(self.previous_recording, self.labels[:2000] + 1)
+        dataset = SpikeDataset(times=self.times[:2100], waveforms=self.waveforms[:2100])
+        with mock.patch("suss.sort3.sort") as sort:
+            result = sort_appended(previous, dataset, overlap=20.0)
+        # Too few spikes to sort; they join the nearest previous cluster
+        sort.assert_not_called()
+        self.assertEqual(len(result), len(previous))
+        flat = result.flatten()
+        self.assertEqual(flat.count, 2100)
+        for label in np.unique(flat.labels):
+            ids = flat.ids[flat.labels == label]
+            self.assertEqual(len(np.unique(self.labels[ids])), 1)
+
+    def test_sort_appended_realign(self):
+        basis = FeatureBasis.fit(self.previous_recording)
+        self.previous_recording.feature_basis = basis
+        realigned = realign(self.previous_recording)
+        self.assertIs(realigned.feature_basis, basis)
+        previous = self.hierarchy(realigned, self.labels[:2000] + 1)
+
+        with mock.patch("suss.sort3.sort", self.fake_sort):
+            result = sort_appended(previous, self.dataset, overlap=20.0, realign=True)
+        # The segment is sorted on waveforms that are already realigned
+        self.assertNotIn("realign", self.sort_kwargs)
+        self.check_result(previous, result)
+
+        recording = result.recording
+        self.check_levels(result, recording)
+        self.assertIsNot(recording, self.dataset)
+        self.assertIs(recording.feature_basis, basis)
+        assert_array_equal(recording.times, self.dataset.times)
+        assert_allclose(recording.waveforms, realign(self.dataset).waveforms)
+        assert_allclose(recording.waveforms[:2000], realigned.waveforms)
+
+    def test_link_appended_mismatch(self):
+        previous = self.previous_recording.cluster(self.labels[:2000])
+        other = SpikeDataset(times=self.times + 1.0, waveforms=self.waveforms)
+        with self.assertRaises(ValueError):
+            link_appended(previous, other, 1800, self.segment_labels)
@@ -0,0 +1,76 @@
+import pickle
+import unittest
+
+import numpy as np
+from numpy.testing import assert_allclose, assert_array_equal
+
+from suss.core import SpikeDataset
+from suss.features import FeatureBasis
+
+
+class TestStorage(unittest.TestCase):
+
+    def setUp(self):
+        n = 2000
+        self.labels = np.repeat([0, 1, 2, 3], n // 4)
+        templates = np.random.normal(size=(4, 30)) * 50
+        self.times = np.linspace(0, 100, n)
+        self.waveforms = templates[self.labels] + np.random.normal(size=(n, 30))
+
+    def make_dataset(self, storage):
+        return SpikeDataset(
+            times=self.times, waveforms=self.waveforms, storage=storage, n_components=6)
+
+    def test_float32(self):
+        dataset = self.make_dataset("float32")
+        self.assertEqual(dataset.waveforms.dtype, np.float64)
+        assert_allclose(dataset.waveforms, self.waveforms, rtol=1e-6)
+
+    def test_int16(self):
+        dataset = self.make_dataset("int16")
+        scale = np.max(np.abs(self.waveforms)) / 32767.0
+        self.assertLessEqual(
+            np.max(np.abs(dataset.waveforms - self.waveforms)), 0.5 * scale + 1e-9)
+        self.assertLess(
+            dataset._data.nbytes, self.make_dataset("float64")._data.nbytes / 3)
+
+    def test_pca(self):
+        dataset = self.make_dataset("pca")
+        self.assertEqual(dataset._data["waveforms"].shape, (2000, 6))
+        # Only the noise outside of the components is lost
+        self.assertLess(np.std(dataset.waveforms - self.waveforms), 1.0)
+
+    def test_derived_datasets(self):
+        dataset = self.make_dataset("int16")
+        clustered = dataset.cluster(self.labels)
+        node = clustered.nodes[2]
+        assert_array_equal(node.waveforms, dataset.waveforms[self.labels == 2])
+        assert_array_equal(clustered.flatten().waveforms, dataset.waveforms)
+        assert_array_equal(
+            node.select(node.times < 60).waveforms,
+            dataset.waveforms[(self.labels == 2) & (self.times < 60)])
+
+        restored = pickle.loads(pickle.dumps(clustered))
+        assert_array_equal(restored.flatten().waveforms, dataset.waveforms)
+
+    def test_unknown_mode(self):
+        with self.assertRaises(ValueError):
+            self.make_dataset("int8")
+
+    def test_feature_basis(self):
+        dataset = self.make_dataset("int16")
+        basis = FeatureBasis.fit(dataset, n_components=3, chunk_size=300)
+        projected = basis.project(dataset, chunk_size=300)
+        self.assertEqual(projected.shape, (2000, 3))
+        assert_allclose(projected, basis.transform(dataset.waveforms), atol=1e-6)
+
+    def test_chunked_statistics(self):
+        dataset = self.make_dataset("pca")
+        self.assertEqual(dataset.data_shape, (2000, 30))
+        self.assertEqual(dataset.select(self.labels == 1).data_shape, (500, 30))
+        assert_allclose(dataset.centroid, np.mean(dataset.waveforms, axis=0), atol=1e-9)
+        clustered = dataset.cluster(self.labels)
+        assert_allclose(
+            clustered.nodes[3].centroid,
+            np.mean(dataset.waveforms[self.labels == 3], axis=0),
+            atol=1e-9)